@@ -23,6 +23,27 @@ target_metadata = None
 # ... etc.
 
 
+def database_urls():
+    """The databases to migrate.
+
+    By default the one in alembic.ini. With -x shard=all every shard in
+    the MINI_MAILGUN_CONFIG config is migrated in turn, shard 0 first, and
+    -x shard=<n> migrates just that one. Each shard keeps it's own
+    alembic_version so a shard that failed part way can be retried alone.
+
+    """
+    shard = context.get_x_argument(as_dictionary=True).get('shard')
+    if shard is None:
+        return [config.get_main_option("sqlalchemy.url")]
+    from mini_mailgun.api.app import get_config
+    app_config = get_config()
+    urls = [app_config['SQLALCHEMY_DATABASE_URI']] + \
+        list(app_config.get('SHARD_DATABASE_URIS') or ())
+    if shard == 'all':
+        return urls
+    return [urls[int(shard)]]
+
+
 def run_migrations_offline():
     """Run migrations in 'offline' mode.
 
@@ -35,12 +56,12 @@ def run_migrations_offline():
     script output.
 
     """
-    url = config.get_main_option("sqlalchemy.url")
-    context.configure(
-        url=url, target_metadata=target_metadata, literal_binds=True)
+    for url in database_urls():
+        context.configure(
+            url=url, target_metadata=target_metadata, literal_binds=True)
 
-    with context.begin_transaction():
-        context.run_migrations()
+        with context.begin_transaction():
+            context.run_migrations()
 
 
 def run_migrations_online():
@@ -50,19 +71,22 @@ def run_migrations_online():
     and associate a connection with the context.
 
     """
-    connectable = engine_from_config(
-        config.get_section(config.config_ini_section),
-        prefix='sqlalchemy.',
-        poolclass=pool.NullPool)
-
-    with connectable.connect() as connection:
-        context.configure(
-            connection=connection,
-            target_metadata=target_metadata
-        )
-
-        with context.begin_transaction():
-            context.run_migrations()
+    for url in database_urls():
+        section = config.get_section(config.config_ini_section)
+        section['sqlalchemy.url'] = url
+        connectable = engine_from_config(
+            section,
+            prefix='sqlalchemy.',
+            poolclass=pool.NullPool)
+
+        with connectable.connect() as connection:
+            context.configure(
+                connection=connection,
+                target_metadata=target_metadata
+            )
+
+            with context.begin_transaction():
+                context.run_migrations()
 
 
 if context.is_offline_mode():
@@ -0,0 +1,28 @@
+"""next attempt at
+
+Revision ID: 5e8b1c3f7a20
+Revises: 9c41d7e2a5b3
+Create Date: 2026-10-18 14:02:51.552190
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e8b1c3f7a20'
+down_revision = '9c41d7e2a5b3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('email', sa.Column('next_attempt_at', sa.DateTime(),
+                                     nullable=True))
+    op.create_index('ix_email_status_next_attempt_at', 'email',
+                    ['status', 'next_attempt_at'])
+
+
+def downgrade():
+    op.drop_index('ix_email_status_next_attempt_at', 'email')
+    op.drop_column('email', 'next_attempt_at')
@@ -0,0 +1,33 @@
+"""listing indexes
+
+Revision ID: 9c41d7e2a5b3
+Revises: f2dc9e2fc4fe
+Create Date: 2026-10-18 09:12:44.318206
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '9c41d7e2a5b3'
+down_revision = 'f2dc9e2fc4fe'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_email_created_at_uuid', 'email',
+                    ['created_at', 'uuid'])
+    op.create_index('ix_email_status_created_at', 'email',
+                    ['status', 'created_at', 'uuid'])
+    op.create_index('ix_email_from_addr_created_at', 'email',
+                    ['from_addr', 'created_at', 'uuid'])
+    op.create_index('ix_email_to_addr_created_at', 'email',
+                    ['to_addr', 'created_at', 'uuid'])
+
+
+def downgrade():
+    op.drop_index('ix_email_to_addr_created_at', 'email')
+    op.drop_index('ix_email_from_addr_created_at', 'email')
+    op.drop_index('ix_email_status_created_at', 'email')
+    op.drop_index('ix_email_created_at_uuid', 'email')
@@ -0,0 +1,96 @@
+"""binary uuid
+
+Stores email uuids as BINARY(16) instead of VARCHAR(37). The new column is
+filled from the old one, then every index holding the uuid is dropped and
+added back on the new column in a single ALTER so the table is only rebuilt
+once. The primary key keeps it's columns, so a partitioned email table
+stays keyed on (uuid, created_at). The unique key on uuid alone that the
+initial schema made is not added back, the primary key already covers it.
+
+Revision ID: a4f7c2e9b815
+Revises: e81b4c7f2d90
+Create Date: 2026-10-18 19:26:07.482913
+
+"""
+from collections import OrderedDict
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4f7c2e9b815'
+down_revision = 'e81b4c7f2d90'
+branch_labels = None
+depends_on = None
+
+TO_BINARY = "UNHEX(REPLACE({0}, '-', ''))"
+TO_TEXT = ("LOWER(CONCAT_WS('-', SUBSTR(HEX({0}), 1, 8), "
+           "SUBSTR(HEX({0}), 9, 4), SUBSTR(HEX({0}), 13, 4), "
+           "SUBSTR(HEX({0}), 17, 4), SUBSTR(HEX({0}), 21)))")
+
+
+def indexes(conn, table, column):
+    """
+    Get the indexes of a table that include a column.
+    Returns:
+        (OrderedDict) Index name mapped to whether it's unique and it's
+            columns in order.
+    """
+    rows = conn.execute(sa.sql.text(
+        'SELECT index_name, non_unique, column_name '
+        'FROM information_schema.statistics '
+        'WHERE table_schema = DATABASE() AND table_name = :table '
+        'ORDER BY index_name, seq_in_index;'), table=table).fetchall()
+    found = OrderedDict()
+    for name, non_unique, column_name in rows:
+        found.setdefault(name, (not non_unique, []))[1].append(column_name)
+    return OrderedDict((name, index) for name, index in found.items()
+                       if column in index[1])
+
+
+def convert(table, column, column_type, value_sql):
+    """
+    Replace a column with a copy of a different type, keeping it's indexes.
+    Args:
+        table (str): The table.
+        column (str): The uuid column.
+        column_type (str): MySQL type of the new column.
+        value_sql (str): Expression giving the new value from the old
+                         column, with {0} for the column.
+    """
+    conn = op.get_bind()
+    new = '{0}_new'.format(column)
+    conn.execute(sa.sql.text(
+        'ALTER TABLE {0} ADD COLUMN {1} {2} NULL AFTER {3};'.format(
+            table, new, column_type, column)))
+    conn.execute(sa.sql.text('UPDATE {0} SET {1} = {2};'.format(
+        table, new, value_sql.format(column))))
+    changes = []
+    added = []
+    for name, (unique, columns) in indexes(conn, table, column).items():
+        cols = ', '.join(columns)
+        if name == 'PRIMARY':
+            changes.append('DROP PRIMARY KEY')
+            added.append('ADD PRIMARY KEY ({0})'.format(cols))
+            continue
+        changes.append('DROP INDEX `{0}`'.format(name))
+        if unique and columns == [column]:
+            continue
+        added.append('ADD {0}INDEX `{1}` ({2})'.format(
+            'UNIQUE ' if unique else '', name, cols))
+    changes.append('DROP COLUMN {0}'.format(column))
+    changes.append('CHANGE {0} {1} {2} NOT NULL'.format(
+        new, column, column_type))
+    conn.execute(sa.sql.text('ALTER TABLE {0} {1};'.format(
+        table, ', '.join(changes + added))))
+
+
+def upgrade():
+    convert('email', 'uuid', 'BINARY(16)', TO_BINARY)
+    convert('outbox', 'email_uuid', 'BINARY(16)', TO_BINARY)
+
+
+def downgrade():
+    convert('outbox', 'email_uuid', 'VARCHAR(37)', TO_TEXT)
+    convert('email', 'uuid', 'VARCHAR(37)', TO_TEXT)
@@ -0,0 +1,33 @@
+"""finished at
+
+Revision ID: b7d4e9a1c6f3
+Revises: 5e8b1c3f7a20
+Create Date: 2026-10-18 15:21:07.904316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d4e9a1c6f3'
+down_revision = '5e8b1c3f7a20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('email', sa.Column('finished_at', sa.DateTime(),
+                                     nullable=True))
+    conn = op.get_bind()
+    conn.execute(sa.sql.text(
+        "UPDATE email SET finished_at = "
+        "COALESCE(deleted_at, last_attempt, created_at) "
+        "WHERE status IN ('SENT', 'FAILED', 'DELETED');"))
+    op.create_index('ix_email_status_finished_at', 'email',
+                    ['status', 'finished_at'])
+
+
+def downgrade():
+    op.drop_index('ix_email_status_finished_at', 'email')
+    op.drop_column('email', 'finished_at')
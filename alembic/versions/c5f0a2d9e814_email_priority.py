@@ -0,0 +1,25 @@
+"""email priority
+
+Revision ID: c5f0a2d9e814
+Revises: d3a8f61b0e47
+Create Date: 2026-10-18 16:40:12.518207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5f0a2d9e814'
+down_revision = 'd3a8f61b0e47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('email', sa.Column('priority', sa.SmallInteger(),
+                                     nullable=False, server_default='5'))
+
+
+def downgrade():
+    op.drop_column('email', 'priority')
@@ -0,0 +1,66 @@
+"""partition email by month
+
+Only runs when asked for, ie alembic -x partition=true upgrade head. If
+it was already skipped, alembic stamp b7d4e9a1c6f3 first. MySQL needs the
+partition column in every unique key so the primary key becomes
+(uuid, created_at) and the extra unique key on uuid is dropped. Once
+partitioned, PURGE_DROP_PARTITIONS_AFTER lets the purge task drop whole
+months at a time.
+
+Revision ID: d3a8f61b0e47
+Revises: b7d4e9a1c6f3
+Create Date: 2026-10-18 15:48:33.120584
+
+"""
+from datetime import datetime
+
+from alembic import context, op
+import sqlalchemy as sa
+
+from mini_mailgun.api.retention import next_month, partition_sql
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3a8f61b0e47'
+down_revision = 'b7d4e9a1c6f3'
+branch_labels = None
+depends_on = None
+
+
+def enabled():
+    args = context.get_x_argument(as_dictionary=True)
+    return args.get('partition', '').lower() in ('1', 'true', 'yes')
+
+
+def upgrade():
+    if not enabled():
+        return
+    conn = op.get_bind()
+    first = conn.execute(sa.sql.text(
+        'SELECT MIN(created_at) FROM email;')).scalar() or datetime.utcnow()
+    now = datetime.utcnow()
+    months = [datetime(first.year, first.month, 1)]
+    while months[-1] <= now:
+        months.append(next_month(months[-1]))
+    unique_keys = conn.execute(sa.sql.text(
+        "SELECT DISTINCT index_name FROM information_schema.statistics "
+        "WHERE table_schema = DATABASE() AND table_name = 'email' "
+        "AND non_unique = 0 AND index_name != 'PRIMARY';")).fetchall()
+    for row in unique_keys:
+        conn.execute(sa.sql.text(
+            'ALTER TABLE email DROP INDEX `{0}`;'.format(row[0])))
+    conn.execute(sa.sql.text(
+        'ALTER TABLE email DROP PRIMARY KEY, '
+        'ADD PRIMARY KEY (uuid, created_at);'))
+    conn.execute(sa.sql.text(
+        'ALTER TABLE email PARTITION BY RANGE (TO_DAYS(created_at)) '
+        '({0});'.format(partition_sql(months))))
+
+
+def downgrade():
+    if not enabled():
+        return
+    conn = op.get_bind()
+    conn.execute(sa.sql.text('ALTER TABLE email REMOVE PARTITIONING;'))
+    conn.execute(sa.sql.text(
+        'ALTER TABLE email DROP PRIMARY KEY, ADD PRIMARY KEY (uuid);'))
@@ -0,0 +1,34 @@
+"""outbox
+
+Revision ID: e81b4c7f2d90
+Revises: c5f0a2d9e814
+Create Date: 2026-10-18 18:02:44.130529
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e81b4c7f2d90'
+down_revision = 'c5f0a2d9e814'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'outbox',
+        sa.Column('id', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'),
+                  nullable=False, autoincrement=True),
+        sa.Column('email_uuid', sa.String(length=37), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('dispatched_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'))
+    op.create_index('ix_outbox_dispatched_at_id', 'outbox',
+                    ['dispatched_at', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_outbox_dispatched_at_id', 'outbox')
+    op.drop_table('outbox')
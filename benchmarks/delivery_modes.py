@@ -0,0 +1,147 @@
+"""
+Compare the chain and fused delivery modes.
+
+Runs an in process celery worker against the in memory broker and a
+sqlite database with DNS and SMTP stubbed out, so the numbers only
+reflect the cost of the delivery pipeline itself. For every mode it
+reports broker publishes per message and submit to SENT latency.
+
+Usage:
+    python benchmarks/delivery_modes.py [--messages 200] [--smtp-latency 0]
+"""
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+
+CONFIG = """
+SQLALCHEMY_DATABASE_URI = 'sqlite:///{db}'
+SQLALCHEMY_TRACK_MODIFICATIONS = False
+CELERY_BROKER_URL = 'memory://'
+CELERY_RESULT_BACKEND = 'cache+memory://'
+SMTP_PORT = 25
+USE_TLS = False
+MAX_RETRIES = 3
+RETRY_WAIT = 600
+DELETE_WAIT = 3600
+APP_LOG = '{log}'
+DELIVERY_MODE = 'chain'
+"""
+
+
+def configure(workdir):
+    """
+    Point mini_mailgun at a throw away config. Must run before any
+    mini_mailgun.api module is imported.
+    """
+    path = os.path.join(workdir, 'bench.conf')
+    with open(path, 'w') as f:
+        f.write(CONFIG.format(db=os.path.join(workdir, 'bench.db'),
+                              log=os.path.join(workdir, 'bench.log')))
+    os.environ['MINI_MAILGUN_CONFIG'] = path
+
+
+class FakeSMTPClient(object):
+    """
+    Stands in for a pooled SMTP connection.
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def send_message(self, from_addr, to_addr, message):
+        if self.latency:
+            time.sleep(self.latency)
+        return 250, 'OK'
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def run_mode(mode, messages, smtp_latency):
+    from celery.signals import after_task_publish, task_postrun
+    from mini_mailgun.api import tasks
+    from mini_mailgun.api.db import db
+    from mini_mailgun.api.models import Email
+
+    tasks.app.config['DELIVERY_MODE'] = mode
+    publishes = [0]
+    submitted = {}
+    finished = {}
+    done = threading.Event()
+
+    def on_publish(sender=None, **kwargs):
+        if sender != 'mini_mailgun.api.tasks.clean_db_record':
+            publishes[0] += 1
+
+    def on_postrun(sender=None, args=None, **kwargs):
+        if sender.name == 'mini_mailgun.api.tasks.clean_db_record':
+            return
+        if sender.name in ('mini_mailgun.api.tasks.update_status',
+                           'mini_mailgun.api.tasks.deliver_email'):
+            uuid = args[1] if sender.name.endswith('update_status') \
+                else args[0]
+            finished[uuid] = time.time()
+            if len(finished) == messages:
+                done.set()
+
+    after_task_publish.connect(on_publish, weak=False)
+    task_postrun.connect(on_postrun, weak=False)
+    with tasks.app.app_context():
+        emails = [Email('bench@example.com', 'rcpt{0}@example.com'.format(i),
+                        'Benchmark', 'Hello') for i in range(messages)]
+        db.session.add_all(emails)
+        db.session.commit()
+        start = time.time()
+        for email in emails:
+            submitted[email.uuid] = time.time()
+            tasks.schedule_email(email)
+    done.wait(600)
+    elapsed = time.time() - start
+    after_task_publish.disconnect(on_publish)
+    task_postrun.disconnect(on_postrun)
+    latencies = [(finished[u] - submitted[u]) * 1000 for u in finished]
+    return {'mode': mode,
+            'messages': len(finished),
+            'broker_publishes_per_message': publishes[0] / float(messages),
+            'messages_per_second': len(finished) / elapsed,
+            'latency_ms_p50': percentile(latencies, 50),
+            'latency_ms_p95': percentile(latencies, 95),
+            'latency_ms_p99': percentile(latencies, 99)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--smtp-latency', type=float, default=0,
+                        help='Seconds each stubbed SMTP send takes.')
+    args = parser.parse_args()
+    workdir = tempfile.mkdtemp()
+    configure(workdir)
+
+    import mock
+    from celery.contrib.testing.worker import start_worker
+    from mini_mailgun.api import tasks
+    from mini_mailgun.api.db import db
+
+    with tasks.app.app_context():
+        db.create_all()
+    tasks.mx_cache.set('example.com', [(10, 'mx.example.com.')], 3600)
+    smtp_client = FakeSMTPClient(args.smtp_latency)
+    results = []
+    with mock.patch.object(tasks.smtp_pool, 'acquire',
+                           return_value=smtp_client), \
+            mock.patch.object(tasks.smtp_pool, 'release'):
+        with start_worker(tasks.celery_app, perform_ping_check=False):
+            for mode in ('chain', 'fused'):
+                results.append(run_mode(mode, args.messages,
+                                        args.smtp_latency))
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
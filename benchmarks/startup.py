@@ -0,0 +1,118 @@
+"""
+Measure startup time and memory for each mini_mailgun process.
+
+Every target runs in a fresh interpreter that does the same setup its
+entry point does before serving. Reports the median seconds spent on
+imports and setup, max RSS and which heavy libraries ended up loaded.
+
+Usage:
+    python benchmarks/startup.py [--runs 5]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+CONFIG = """
+SQLALCHEMY_DATABASE_URI = 'sqlite:///{db}'
+SQLALCHEMY_TRACK_MODIFICATIONS = False
+CELERY_BROKER_URL = 'memory://'
+CELERY_RESULT_BACKEND = 'cache+memory://'
+SMTP_PORT = 25
+USE_TLS = False
+MAX_RETRIES = 3
+RETRY_WAIT = 600
+DELETE_WAIT = 3600
+APP_LOG = '{log}'
+DELIVERY_MODE = '{mode}'
+"""
+
+TARGETS = {
+    'api': ('chain', """
+from mini_mailgun.api.app import get_app, register_blueprints
+app = get_app()
+register_blueprints(app)
+from mini_mailgun.api import tasks
+"""),
+    'api_daemon_mode': ('daemon', """
+from mini_mailgun.api.app import get_app, register_blueprints
+app = get_app()
+register_blueprints(app)
+"""),
+    'worker': ('chain', """
+from mini_mailgun.api import tasks
+"""),
+    'delivery_daemon': ('daemon', """
+from mini_mailgun.api.app import get_app
+from mini_mailgun.delivery.engine import DeliveryEngine
+DeliveryEngine(get_app())
+"""),
+}
+
+HEAVY = ('celery', 'dns', 'flanker', 'redis', 'gevent')
+
+CHILD = """
+import json, resource, sys, time
+start = time.time()
+{setup}
+seconds = time.time() - start
+print(json.dumps({{
+    'seconds': seconds,
+    'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'loaded': sorted(m for m in {heavy!r} if m in sys.modules)}}))
+"""
+
+
+def configure(workdir, mode):
+    """
+    Write a throw away config for a delivery mode.
+    Returns:
+        (str) The config path.
+    """
+    path = os.path.join(workdir, '{0}.conf'.format(mode))
+    with open(path, 'w') as f:
+        f.write(CONFIG.format(db=os.path.join(workdir, 'bench.db'),
+                              log=os.path.join(workdir, 'bench.log'),
+                              mode=mode))
+    return path
+
+
+def run_target(setup, config, runs):
+    """
+    Start a fresh interpreter runs times.
+    Returns:
+        (dict) Median seconds, median max RSS and loaded heavy libraries.
+    """
+    env = dict(os.environ, MINI_MAILGUN_CONFIG=config)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.getcwd()] + [p for p in [env.get('PYTHONPATH')] if p])
+    code = CHILD.format(setup=setup, heavy=HEAVY)
+    samples = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         env=env, stderr=open(os.devnull, 'w'))
+        samples.append(json.loads(output.decode('utf-8').splitlines()[-1]))
+    middle = len(samples) // 2
+    return {'seconds': round(sorted(s['seconds']
+                                    for s in samples)[middle], 3),
+            'max_rss_kb': sorted(s['max_rss_kb'] for s in samples)[middle],
+            'loaded': samples[-1]['loaded']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+    workdir = tempfile.mkdtemp()
+    results = []
+    for name, (mode, setup) in sorted(TARGETS.items()):
+        result = run_target(setup, configure(workdir, mode), args.runs)
+        result['target'] = name
+        results.append(result)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
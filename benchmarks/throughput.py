@@ -0,0 +1,318 @@
+"""
+End to end throughput of the API, the celery pipeline and SMTP delivery.
+
+Everything runs on one box. The flask app comes from create_app, an in
+process celery worker consumes from the in memory broker (or
+--broker-url) and mail goes over real SMTP sessions to a local sink with
+configurable latency and failure rate. Emails are submitted through the
+batch endpoint and the run ends once every email is SENT or FAILED.
+
+Reports messages per second, p50/p95/p99 submit to SENT latency and the
+per stage cost recorded by mini_mailgun.metrics and celery's task
+signals, as JSON. With --baseline the run fails if it's slower than a
+previous --output by more than --tolerance.
+
+Usage:
+    python benchmarks/throughput.py [--messages 1000] [--smtp-latency 0]
+        [--failure-rate 0] [--output results.json]
+        [--baseline results.json]
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+
+CONFIG = """
+SQLALCHEMY_DATABASE_URI = '{database_url}'
+SQLALCHEMY_TRACK_MODIFICATIONS = False
+CELERY_BROKER_URL = '{broker_url}'
+CELERY_RESULT_BACKEND = 'cache+memory://'
+SMTP_PORT = {smtp_port}
+USE_TLS = False
+MAX_RETRIES = {max_retries}
+RETRY_WAIT = 0.1
+RETRY_BACKOFF = 1
+RETRY_JITTER = 0
+DELETE_WAIT = 3600
+APP_LOG = '{log}'
+LOG_LEVEL = 'WARNING'
+MAX_BATCH_SIZE = 10000
+DELIVERY_MODE = '{mode}'
+STATUS_WRITE_BEHIND = {write_behind}
+"""
+
+DOMAIN = 'bench.example'
+
+
+def configure(workdir, smtp_port, args):
+    """
+    Point mini_mailgun at a throw away config. Must run before any
+    mini_mailgun.api module is imported.
+    """
+    path = os.path.join(workdir, 'bench.conf')
+    database_url = args.database_url or 'sqlite:///{0}'.format(
+        os.path.join(workdir, 'bench.db'))
+    with open(path, 'w') as f:
+        f.write(CONFIG.format(database_url=database_url,
+                              broker_url=args.broker_url,
+                              smtp_port=smtp_port,
+                              max_retries=args.max_retries,
+                              log=os.path.join(workdir, 'bench.log'),
+                              mode=args.mode,
+                              write_behind=args.write_behind))
+    os.environ['MINI_MAILGUN_CONFIG'] = path
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def summarize(durations):
+    """
+    Count, mean and p95 in milliseconds for a list of seconds.
+    """
+    return {'count': len(durations),
+            'mean_ms': sum(durations) * 1000 / len(durations),
+            'p95_ms': percentile(durations, 95) * 1000}
+
+
+def stage_costs():
+    """
+    Read the mini_mailgun histograms out of the default registry.
+    Returns:
+        (dict) Series name and labels mapped to count and mean_ms.
+    """
+    from prometheus_client import REGISTRY
+    stages = {}
+    for family in REGISTRY.collect():
+        if family.type != 'histogram' or \
+                not family.name.startswith('mini_mailgun_'):
+            continue
+        totals = {}
+        for sample in family.samples:
+            if sample.name.endswith('_bucket'):
+                continue
+            labels = ','.join('{0}={1}'.format(k, v)
+                              for k, v in sorted(sample.labels.items()))
+            key = '{0}{{{1}}}'.format(family.name, labels) if labels \
+                else family.name
+            totals.setdefault(key, {})[sample.name.rsplit('_', 1)[1]] = \
+                sample.value
+        for key, total in totals.items():
+            if total.get('count'):
+                stages[key] = {'count': int(total['count']),
+                               'mean_ms': total['sum'] * 1000 /
+                               total['count']}
+    return stages
+
+
+class TaskTimer(object):
+    """
+    Times every task the worker runs using celery's task signals.
+    """
+
+    def __init__(self):
+        self.started = {}
+        self.durations = {}
+        self._lock = threading.Lock()
+
+    def prerun(self, task_id=None, **kwargs):
+        self.started[task_id] = time.time()
+
+    def postrun(self, task_id=None, task=None, **kwargs):
+        start = self.started.pop(task_id, None)
+        if start is not None:
+            with self._lock:
+                self.durations.setdefault(task.name.rsplit('.', 1)[-1],
+                                          []).append(time.time() - start)
+
+    def summary(self):
+        return dict((name, summarize(durations))
+                    for name, durations in self.durations.items())
+
+
+def submit(client, messages, batch_size):
+    """
+    Submit every email through the batch endpoint.
+    Returns:
+        (list) Per request seconds.
+    """
+    durations = []
+    for offset in range(0, messages, batch_size):
+        batch = [{'from_addr': 'bench@example.com',
+                  'to_addr': 'rcpt{0}@{1}'.format(i, DOMAIN),
+                  'subject': 'Benchmark',
+                  'body': 'Hello'}
+                 for i in range(offset, min(messages, offset + batch_size))]
+        start = time.time()
+        rv = client.post('/v1/emails', data=json.dumps(batch),
+                         content_type='application/json')
+        durations.append(time.time() - start)
+        if rv.status_code != 202:
+            raise RuntimeError('Submit failed with {0}: {1}'.format(
+                rv.status_code, rv.data))
+    return durations
+
+
+def wait_for_finish(tasks, timeout):
+    """
+    Hand due retries to the worker, as beat would, until no email is
+    left SENDING.
+    Returns:
+        (int) Emails still SENDING when we gave up.
+    """
+    from mini_mailgun.api.db import db
+    from mini_mailgun.api.models import Email
+    from mini_mailgun.constants import STATUS_SENDING
+
+    deadline = time.time() + timeout
+    while True:
+        tasks.enqueue_due_emails()
+        with tasks.app.app_context():
+            sending = db.session.query(Email.uuid).filter(
+                Email.status == STATUS_SENDING).count()
+            db.session.remove()
+        if not sending or time.time() > deadline:
+            return sending
+        time.sleep(0.05)
+
+
+def collect(tasks):
+    """
+    Get the status and submit to finish seconds of every email.
+    """
+    from mini_mailgun.api.db import db
+    from mini_mailgun.api.models import Email
+
+    with tasks.app.app_context():
+        rows = db.session.query(Email.status, Email.created_at,
+                                Email.finished_at).all()
+        db.session.remove()
+    return [(status, (finished - created).total_seconds()
+             if finished else None) for status, created, finished in rows]
+
+
+def compare(results, baseline, tolerance):
+    """
+    Check results against a previous run.
+    Returns:
+        (list) Descriptions of every regression.
+    """
+    regressions = []
+    floor = baseline['messages_per_second'] * (1 - tolerance)
+    if results['messages_per_second'] < floor:
+        regressions.append('messages_per_second {0:.1f} < {1:.1f}'.format(
+            results['messages_per_second'], floor))
+    for pct in ('p50', 'p95', 'p99'):
+        before = baseline['latency_ms'].get(pct)
+        after = results['latency_ms'].get(pct)
+        if before and after and after > before * (1 + tolerance):
+            regressions.append('latency_ms {0} {1:.1f} > {2:.1f}'.format(
+                pct, after, before * (1 + tolerance)))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='Emails per POST /v1/emails.')
+    parser.add_argument('--mode', default='chain',
+                        choices=('chain', 'fused'))
+    parser.add_argument('--write-behind', action='store_true')
+    parser.add_argument('--pool', default='solo',
+                        help='Celery pool for the worker, solo or threads.')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--smtp-latency', type=float, default=0,
+                        help='Seconds the sink waits before answering DATA.')
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help='Fraction of messages the sink refuses.')
+    parser.add_argument('--failure-code', type=int, default=451)
+    parser.add_argument('--max-retries', type=int, default=3)
+    parser.add_argument('--database-url',
+                        help='Defaults to a sqlite file in a temp dir.')
+    parser.add_argument('--broker-url', default='memory://')
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--output', help='Also write the results here.')
+    parser.add_argument('--baseline',
+                        help='Results of an earlier run to compare with.')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    from mini_mailgun.smtp.sink import SMTPSink
+    sink = SMTPSink(latency=args.smtp_latency,
+                    failure_rate=args.failure_rate,
+                    failure_code=args.failure_code).start()
+    workdir = tempfile.mkdtemp()
+    configure(workdir, sink.port, args)
+
+    from celery.contrib.testing.worker import start_worker
+    from celery.signals import task_postrun, task_prerun
+    from mini_mailgun.api import tasks
+    from mini_mailgun.api.app import create_app
+    from mini_mailgun.api.db import db
+    from mini_mailgun.constants import STATUS_SENT, STATUS_FAILED
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+    tasks.mx_cache.set(DOMAIN, [(10, sink.host)], 3600)
+    timer = TaskTimer()
+    task_prerun.connect(timer.prerun, weak=False)
+    task_postrun.connect(timer.postrun, weak=False)
+    client = app.test_client()
+    with start_worker(tasks.celery_app, pool=args.pool,
+                      concurrency=args.concurrency,
+                      perform_ping_check=False):
+        start = time.time()
+        requests = submit(client, args.messages, args.batch_size)
+        unfinished = wait_for_finish(tasks, args.timeout)
+        elapsed = time.time() - start
+    if tasks.status_writer is not None:
+        tasks.status_writer.close()
+    # Hang up the pooled sessions first, the sink's session threads die
+    # with a traceback if it's stopped while they're still connected.
+    tasks.smtp_pool.close_all()
+    sink.stop()
+
+    rows = collect(tasks)
+    latencies = [seconds * 1000 for status, seconds in rows
+                 if status == STATUS_SENT]
+    results = {
+        'config': dict(vars(args), python=platform.python_version()),
+        'messages': args.messages,
+        'sent': len(latencies),
+        'failed': len([row for row in rows if row[0] == STATUS_FAILED]),
+        'unfinished': unfinished,
+        'smtp_transactions': len(sink.messages),
+        'elapsed_seconds': elapsed,
+        'messages_per_second': (args.messages - unfinished) / elapsed,
+        'latency_ms': {'p50': percentile(latencies, 50),
+                       'p95': percentile(latencies, 95),
+                       'p99': percentile(latencies, 99)},
+        'submit_requests': summarize(requests),
+        'tasks': timer.summary(),
+        'stages': stage_costs()}
+    output = json.dumps(results, indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            sys.stderr.write('Regression: {0}\n'.format(regression))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Compare send_email validation against the old jsonschema.validate call.
+
+The old code called jsonschema.validate with a new FormatChecker for every
+message, which checks the schema against the meta schema and builds a
+validator each time. Reports microseconds per message for valid and
+invalid payloads, alone and as one batch.
+
+Usage:
+    python benchmarks/validation.py [--messages 1000] [--repeat 5]
+"""
+import argparse
+import json
+import timeit
+
+from jsonschema import FormatChecker, ValidationError, validate
+
+from mini_mailgun.api.schema import send_email, send_email_errors
+
+GOOD = {'from_addr': 'bob@example.com',
+        'to_addr': 'terry@example.com',
+        'subject': 'Hey dude!',
+        'body': 'Where is my money!'}
+BAD = dict(GOOD, to_addr='notanemail')
+
+
+def legacy_errors(data):
+    """
+    What validation cost before the validator was compiled once.
+    """
+    try:
+        validate(data, send_email, format_checker=FormatChecker())
+    except ValidationError as e:
+        return e.message
+    return None
+
+
+def bench(func, payloads, repeat):
+    """
+    Returns:
+        (float) Best microseconds per payload over repeat runs.
+    """
+    timer = timeit.Timer(lambda: [func(data) for data in payloads])
+    return min(timer.repeat(repeat, 1)) / len(payloads) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    cases = {'valid': [GOOD] * args.messages,
+             'invalid': [BAD] * args.messages,
+             'mixed_batch': [GOOD, BAD] * (args.messages // 2)}
+    results = []
+    for name, payloads in sorted(cases.items()):
+        legacy = bench(legacy_errors, payloads, args.repeat)
+        current = bench(send_email_errors, payloads, args.repeat)
+        results.append({'case': name,
+                        'legacy_us_per_message': round(legacy, 2),
+                        'compiled_us_per_message': round(current, 2),
+                        'speedup': round(legacy / current, 1)})
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
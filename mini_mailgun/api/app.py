@@ -2,10 +2,42 @@
 Application odds and ends.
 """
 import logging
+import os
+import threading
 
-from flask import Flask
+from flask import Config, Flask
 
 from mini_mailgun.api.db import db
+from mini_mailgun.logs import configure_logger
+
+_registry = {}
+_registry_lock = threading.RLock()
+
+
+def get_config():
+    """
+    Get the config from MINI_MAILGUN_CONFIG. The file is only read once
+    per process.
+    Returns:
+        (flask.Config) The shared config. Copy it before changing it.
+    """
+    with _registry_lock:
+        if 'config' not in _registry:
+            config = Config(os.path.dirname(os.path.abspath(__file__)))
+            config.from_envvar('MINI_MAILGUN_CONFIG')
+            _registry['config'] = config
+        return _registry['config']
+
+
+def register_blueprints(app):
+    """
+    Add the api routes to an app.
+    Args:
+        app (flask.Flask): The app.
+    """
+    from mini_mailgun.api.blueprint import TextUUIDConverter, v1_api
+    app.url_map.converters['uuid'] = TextUUIDConverter
+    app.register_blueprint(v1_api)
 
 
 def create_app(register_blueprint=True):
@@ -20,47 +52,77 @@ def create_app(register_blueprint=True):
         A flask application.
     """
     app = Flask(__name__)
-    app.config.from_envvar('MINI_MAILGUN_CONFIG')
+    app.config.update(get_config())
     if register_blueprint:
-        from mini_mailgun.api.blueprint import v1_api
-        app.register_blueprint(v1_api)
+        register_blueprints(app)
     db.init_app(app)
     return app
 
 
+def get_app():
+    """
+    Get the app shared by everything in this process. The celery tasks,
+    the API server and the delivery daemon all use it so there is only
+    ever one. It starts without the api routes, the API server adds them.
+    Returns:
+        A flask application.
+    """
+    with _registry_lock:
+        if 'app' not in _registry:
+            _registry['app'] = create_app(register_blueprint=False)
+        return _registry['app']
+
+
+def get_email_cache():
+    """
+    Get the email cache shared by everything in this process.
+    Returns:
+        (mini_mailgun.api.cache.EmailCache)
+    """
+    with _registry_lock:
+        if 'email_cache' not in _registry:
+            from mini_mailgun.api.cache import EmailCache
+            config = get_config()
+            _registry['email_cache'] = EmailCache(
+                max_size=config.get('EMAIL_CACHE_SIZE', 10000),
+                ttl=config.get('EMAIL_CACHE_TTL', 30),
+                negative_ttl=config.get('EMAIL_CACHE_NEGATIVE_TTL', 5),
+                redis_url=config.get('EMAIL_CACHE_REDIS_URL'),
+                tombstone_ttl=config.get('EMAIL_CACHE_TOMBSTONE_TTL', 2))
+        return _registry['email_cache']
+
+
+def get_status_feed():
+    """
+    Get the status feed shared by everything in this process.
+    Returns:
+        (mini_mailgun.api.events.StatusFeed)
+    """
+    with _registry_lock:
+        if 'status_feed' not in _registry:
+            from mini_mailgun.api.events import StatusFeed
+            _registry['status_feed'] = StatusFeed(
+                redis_url=get_config().get('STATUS_EVENTS_REDIS_URL'))
+        return _registry['status_feed']
+
+
 def get_db():
     """
     Get a database session.
     Returns:
         A flask-sqlalchemy database object.
     """
-    app = Flask(__name__)
-    app.config.from_envvar('MINI_MAILGUN_CONFIG')
-    db.init_app(app)
     return db
 
 
 def create_logger(mname):
     """
-    Get a logger object.
+    Get a logger object. Records are written by a background listener,
+    see mini_mailgun.logs. Calling this again for the same name returns
+    the same logger without adding handlers.
     Args:
         mname (str): generally the __name__ of the current module.
     Returns:
         A python logger object.
     """
-    format_string = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    app = Flask(__name__)
-    app.config.from_envvar('MINI_MAILGUN_CONFIG')
-    logger = logging.getLogger(mname)
-    logger.setLevel(logging.DEBUG)
-    handler = logging.StreamHandler()
-    handler.setLevel(logging.DEBUG)
-    formatter = logging.Formatter(format_string)
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    handler = logging.FileHandler(app.config['APP_LOG'])
-    handler.setLevel(logging.DEBUG)
-    formatter = logging.Formatter(format_string)
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    return logger
+    return configure_logger(logging.getLogger(mname), get_config())
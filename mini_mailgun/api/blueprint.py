@@ -3,23 +3,99 @@ Blueprint module contains all the api routes.
 """
 import logging
 import json
+import math
+import time
 
-from celery import chain
-from flask import Blueprint, request, abort
+from flask import Blueprint, Response, current_app, request, abort
+from flask import g, stream_with_context
+from werkzeug.routing import UUIDConverter
 
-from mini_mailgun.api.app import get_db
-from mini_mailgun.api.models import Email
-from mini_mailgun.api.tasks import send_message, update_attempts, update_status
-from mini_mailgun.api.tasks import find_smtp_host
-from mini_mailgun.common import utc_time
+from mini_mailgun.api.app import get_db, get_email_cache, get_status_feed
+from mini_mailgun.api.db import group_by_shard
+from mini_mailgun.api.models import Email, Outbox
+from mini_mailgun.api.query import encode_cursor, filter_emails, gather
+from mini_mailgun.common import normalize_uuid, utc_time
 from mini_mailgun.constants import STATUS_SENDING, STATUS_DELETED,  API_LOGGER
-from mini_mailgun.api.schema import validate_send_email
+from mini_mailgun.constants import FINISHED_STATUSES
+from mini_mailgun.logs import per_message
+from mini_mailgun.metrics import REQUEST_LATENCY, latest
+from mini_mailgun.api.schema import validate_send_email, send_email_errors
 
 v1_api = Blueprint('v1_api', __name__)
 db = get_db()
 LOG = logging.getLogger(API_LOGGER)
 
 
+class TextUUIDConverter(UUIDConverter):
+    """
+    Matches UUIDs in urls like werkzeug's uuid converter, but hands views
+    the canonical text form. Anything else is a 404 without touching the
+    database.
+    """
+
+    def to_python(self, value):
+        return normalize_uuid(value)
+
+
+@v1_api.before_request
+def start_timer():
+    """
+    Note when a request started.
+    """
+    g.request_started = time.time()
+
+
+@v1_api.after_request
+def record_latency(response):
+    """
+    Record how long a request took by route template, so every email
+    uuid shares one series.
+    """
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_LATENCY.labels(request.method, route,
+                               str(response.status_code)).observe(
+                                   time.time() - started)
+    return response
+
+
+def add_to_outbox(emails):
+    """
+    With USE_OUTBOX on, queue new emails for the outbox relay in the
+    current transaction.
+    Args:
+        emails (list): mini_mailgun.api.models.Email objects.
+    Returns:
+        (bool) True if the relay will publish them.
+    """
+    config = current_app.config
+    if not config.get('USE_OUTBOX', False) or \
+            config.get('DELIVERY_MODE', 'chain') == 'daemon':
+        return False
+    rows = Outbox.rows(emails)
+    for shard, shard_rows in group_by_shard(
+            rows, key=lambda row: row['email_uuid']).items():
+        db.session.execute(Outbox.__table__.insert(), shard_rows,
+                           shard_id=shard)
+    return True
+
+
+def schedule_emails(emails):
+    """
+    Hand new emails to celery over one broker connection. Celery isn't
+    imported until it's needed, so it's never loaded in daemon mode.
+    Args:
+        emails (list): mini_mailgun.api.models.Email objects.
+    """
+    if current_app.config.get('DELIVERY_MODE', 'chain') == 'daemon':
+        return
+    from mini_mailgun.api.tasks import celery_app, schedule_email
+    with celery_app.producer_or_acquire() as producer:
+        for email in emails:
+            schedule_email(email, producer=producer)
+
+
 @v1_api.route('/v1/email', methods=['POST'])
 def send_email():
     """
@@ -28,67 +104,290 @@ def send_email():
         {"from_addr": "bob@example.com",
          "to_addr": "terry@example.com",
          "subject": "Hey dude!",
-         "body": "Where is my money!"}
+         "body": "Where is my money!",
+         "priority": 9}
+    priority is optional, 0 to 9 with higher going first. Defaults to 5.
     """
     LOG.info('Attempting to schedule an email.')
     content = request.get_json()
-    # Bug in flask test client. the behavior of get_json changes
-    # between the test client and the actual app.
-    if not isinstance(content, dict):
-        content = json.loads(content)
     validate_send_email(content)
     email = Email(content['from_addr'],
                   content['to_addr'],
                   content['subject'],
-                  content['body'])
+                  content['body'],
+                  priority=content.get('priority'))
     db.session.add(email)
+    outboxed = add_to_outbox([email])
     db.session.commit()
-    chain(update_attempts.s(email.uuid, email.attempts),
-          find_smtp_host.s(email.to_addr),
-          send_message.s(email.from_addr, email.to_addr, email.to_msg()),
-          update_status.s(email.uuid)).apply_async()
-    LOG.info('Email: {0} submitted to celery.'.format(email.uuid))
+    if not outboxed:
+        schedule_emails([email])
+    LOG.info('Email: %s %s.', email.uuid,
+             'queued in outbox' if outboxed else 'submitted to celery',
+             extra=per_message(email.uuid))
     return email.to_json(), 202
 
 
-@v1_api.route('/v1/email/<uuid>', methods=['DELETE'])
+@v1_api.route('/v1/emails', methods=['POST'])
+def send_emails():
+    """
+    Create a batch of emails. Every message is validated on it's own so
+    one bad message does not reject the whole batch. Valid messages are
+    inserted with a single multi row INSERT and published to celery over
+    one broker connection, or left for the outbox relay.
+    Example json body:
+        [{"from_addr": "bob@example.com",
+          "to_addr": "terry@example.com",
+          "subject": "Hey dude!",
+          "body": "Where is my money!"},
+         {"from_addr": "bob@example.com",
+          "to_addr": "notanemail",
+          "subject": "Hey dude!",
+          "body": "Where is my money!"}]
+    Example response body:
+        [{"index": 0, "uuid": "...", "status": "SENDING"},
+         {"index": 1, "error": "u'notanemail' is not a 'email'",
+          "errors": [{"field": "to_addr", "validator": "format",
+                      "message": "u'notanemail' is not a 'email'"}]}]
+    Messages without a priority get BATCH_DEFAULT_PRIORITY, which by
+    default puts them on the bulk queue.
+    Returns 202 if any message was accepted otherwise 400.
+    """
+    content = request.get_json()
+    if not isinstance(content, list) or not content:
+        abort(400)
+    if len(content) > current_app.config.get('MAX_BATCH_SIZE', 10000):
+        abort(413)
+    LOG.info('Attempting to schedule %s emails.', len(content))
+    results = []
+    emails = []
+    default_priority = current_app.config.get('BATCH_DEFAULT_PRIORITY', 2)
+    for index, item in enumerate(content):
+        errors = send_email_errors(item)
+        if errors:
+            results.append({'index': index,
+                            'error': errors[0]['message'],
+                            'errors': errors})
+            continue
+        email = Email(item['from_addr'],
+                      item['to_addr'],
+                      item['subject'],
+                      item['body'],
+                      priority=item.get('priority', default_priority))
+        emails.append(email)
+        results.append({'index': index,
+                        'uuid': email.uuid,
+                        'status': email.status})
+    if not emails:
+        return json.dumps(results), 400
+    for shard, shard_emails in group_by_shard(
+            emails, key=lambda email: email.uuid).items():
+        db.session.execute(Email.__table__.insert(),
+                           [e.to_row() for e in shard_emails],
+                           shard_id=shard)
+    outboxed = add_to_outbox(emails)
+    db.session.commit()
+    if not outboxed:
+        schedule_emails(emails)
+    LOG.info('%s of %s emails %s.', len(emails), len(content),
+             'queued in outbox' if outboxed else 'submitted to celery')
+    return json.dumps(results), 202
+
+
+@v1_api.route('/v1/email/<uuid:uuid>', methods=['DELETE'])
 def delete_email(uuid):
     """
     Delete an email. If it has not already been sent or is not failed.
     """
-    LOG.info('Attempting to delete Email: {0}.'.format(uuid))
+    LOG.info('Attempting to delete Email: %s.', uuid,
+             extra=per_message(uuid))
     email = Email.query.filter_by(uuid=uuid).first_or_404()
     if email.status != STATUS_SENDING:
-        LOG.info(('Email is unable to be '
-                  'deleted, is has already {0}.').format(email.status))
+        LOG.info('Email is unable to be deleted, is has already %s.',
+                 email.status, extra=per_message(uuid))
         abort(409)
-    email.deleted_at = utc_time()
+    email.deleted_at = email.finished_at = utc_time()
     email.status = STATUS_DELETED
     db.session.commit()
-    LOG.info('Email: {0} is deleted.'.format(uuid))
+    get_email_cache().invalidate(uuid)
+    get_status_feed().publish(uuid, STATUS_DELETED,
+                              status_code=email.status_code,
+                              attempts=email.attempts)
+    LOG.info('Email: %s is deleted.', uuid, extra=per_message(uuid))
     return '', 200
 
 
-@v1_api.route('/v1/email/<uuid>', methods=['GET'])
+@v1_api.route('/v1/email/<uuid:uuid>', methods=['GET'])
 def get_email(uuid):
     """
-    Get information about an existing email.
+    Get information about an existing email. Served from the email cache
+    when it can be. With ?wait=<seconds> the response is held until the
+    email's status changes, up to STATUS_MAX_WAIT seconds, unless it has
+    already finished.
+    """
+    if 'wait' in request.args:
+        try:
+            wait = float(request.args['wait'])
+        except ValueError:
+            abort(400)
+        if math.isnan(wait) or math.isinf(wait):
+            abort(400)
+        return wait_for_status(
+            uuid, min(max(wait, 0),
+                      current_app.config.get('STATUS_MAX_WAIT', 60)))
+    LOG.debug('Attempting to find Email: %s.', uuid)
+    cache = get_email_cache()
+    body = cache.get(uuid)
+    if body is None:
+        email = Email.query.filter_by(uuid=uuid).first()
+        body = email.to_json() if email is not None else ''
+        cache.set(uuid, body)
+    if not body:
+        abort(404)
+    LOG.debug('Email: %s found.', uuid)
+    return body, 200
+
+
+def wait_for_status(uuid, wait):
+    """
+    Long poll for a status change. The database session is given back
+    while waiting so a waiting client doesn't hold a connection.
+    Args:
+        uuid (str): UUID of the email.
+        wait (float): Max seconds to wait.
+    Returns:
+        (tuple) The email's JSON and status code.
     """
-    LOG.info('Attempting to find Email: {0}.'.format(uuid))
+    with get_status_feed().subscribe(uuid) as subscription:
+        email = Email.query.filter_by(uuid=uuid).first_or_404()
+        body = email.to_json()
+        finished = email.status in FINISHED_STATUSES
+        db.session.remove()
+        if finished or subscription.get(wait) is None:
+            return body, 200
     email = Email.query.filter_by(uuid=uuid).first_or_404()
-    LOG.info('Email: {0} found.'.format(uuid))
     return email.to_json(), 200
 
 
+def status_event(event):
+    """
+    Format a status change as a server sent event.
+    """
+    return 'event: status\ndata: {0}\n\n'.format(json.dumps(event))
+
+
+@v1_api.route('/v1/email/<uuid:uuid>/events', methods=['GET'])
+def stream_status(uuid):
+    """
+    Stream an email's status changes as server sent events. The first
+    event is the current status and the stream ends once the email has
+    finished, or after STATUS_STREAM_TIMEOUT seconds. A comment goes out
+    every STATUS_STREAM_HEARTBEAT seconds so proxies keep the connection
+    open and a client that has gone away is noticed.
+    """
+    config = current_app.config
+    timeout = config.get('STATUS_STREAM_TIMEOUT', 300)
+    heartbeat = config.get('STATUS_STREAM_HEARTBEAT', 15)
+    subscription = get_status_feed().subscribe(uuid)
+    email = Email.query.filter_by(uuid=uuid).first()
+    if email is None:
+        subscription.close()
+        abort(404)
+    current = {'uuid': uuid, 'status': email.status,
+               'status_code': email.status_code, 'attempts': email.attempts}
+    db.session.remove()
+
+    def generate():
+        try:
+            yield status_event(current)
+            if current['status'] in FINISHED_STATUSES:
+                return
+            deadline = time.time() + timeout
+            while time.time() < deadline:
+                event = subscription.get(
+                    min(heartbeat, deadline - time.time()))
+                if event is None:
+                    yield ': keepalive\n\n'
+                    continue
+                yield status_event(event)
+                if event['status'] in FINISHED_STATUSES:
+                    return
+        finally:
+            subscription.close()
+    response = Response(generate(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache',
+                                 'X-Accel-Buffering': 'no'})
+    # The generator's finally never runs if the body isn't read, e.g. for
+    # HEAD or a client that goes away before the first event.
+    response.call_on_close(subscription.close)
+    return response
+
+
 @v1_api.route('/v1/email', methods=['GET'])
 def get_emails():
     """
-    Return a list of emails. Defaults to 1000 max and supports offsets.
+    Return a list of email uuids ordered by creation time. Defaults to 1000
+    max. When a page is full the X-Next-Cursor header holds a cursor to pass
+    back as the cursor arg to get the next page. Listings can be filtered by
+    status, from_addr, to_addr, created_after and created_before.
+    offset is still supported but cursors are much cheaper on deep pages,
+    with several shards every shard has to read past the offset.
+    """
+    try:
+        limit = int(request.args.get('limit', default=1000))
+        offset = int(request.args.get('offset', default=0))
+    except ValueError:
+        abort(400)
+    if limit < 1 or offset < 0:
+        abort(400)
+    limit = min(limit, current_app.config.get('MAX_PAGE_SIZE', 10000))
+    LOG.info('Generating list of %s emails offset at %s.', limit, offset)
+    try:
+        query = filter_emails(
+            db.session.query(Email.uuid, Email.created_at), request.args)
+    except ValueError:
+        abort(400)
+    if request.args.get('cursor'):
+        offset = 0
+    rows = list(gather(query, limit=limit, offset=offset))
+    headers = {}
+    if rows and len(rows) == limit:
+        headers['X-Next-Cursor'] = encode_cursor(rows[-1].created_at,
+                                                 rows[-1].uuid)
+    return json.dumps([row.uuid for row in rows]), 200, headers
+
+
+@v1_api.route('/v1/emails/export', methods=['GET'])
+def export_emails():
+    """
+    Stream every email matching the same filters as GET /v1/email as
+    newline delimited JSON, one full email per line, ordered by creation
+    time. Rows are read from a server side cursor EXPORT_CHUNK_SIZE at a
+    time so memory use doesn't grow with the number of emails. With
+    several shards each shard has it's own cursor and the rows are merged.
+    """
+    try:
+        limit = request.args.get('limit')
+        limit = int(limit) if limit is not None else None
+        query = filter_emails(Email.query, request.args)
+    except ValueError:
+        abort(400)
+    if limit is not None and limit < 1:
+        abort(400)
+    query = query.yield_per(current_app.config.get('EXPORT_CHUNK_SIZE', 1000))
+    LOG.info('Exporting emails matching %s.', request.args.to_dict())
+
+    def generate():
+        for email in gather(query, limit=limit):
+            yield json.dumps(email.to_dict()) + '\n'
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
+
+
+@v1_api.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Prometheus metrics for this process, or every process on the host in
+    multiprocess mode.
     """
-    limit = request.args.get('limit', default=1000)
-    offset = request.args.get('offset', default=0)
-    LOG.info('Generating list of {0} emails offset at {1}.'.format(limit,
-                                                                   offset))
-    uuids = [uuid[0] for uuid in db.session.query(
-        Email.uuid).limit(limit).offset(offset).all()]
-    return json.dumps(uuids), 200
+    body, content_type = latest()
+    return Response(body, content_type=content_type)
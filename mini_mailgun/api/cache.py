@@ -0,0 +1,185 @@
+"""
+Read through cache for the emails served by GET /v1/email/<uuid>.
+"""
+import threading
+import time
+
+from mini_mailgun import metrics
+from mini_mailgun.common import LRUCache
+
+REDIS_KEY = 'mini_mailgun:email:{0}'
+# Held in place of an invalidated entry. It has no ':' so it can't be
+# mistaken for a cached email in redis.
+TOMBSTONE = '-'
+
+
+class EmailCache(object):
+    """
+    Caches the JSON the API serves for each email, keyed by uuid. Emails
+    that don't exist are cached too, for a shorter time, as an empty
+    string.
+
+    With a redis url every API process shares one cache and the celery
+    workers and delivery daemon invalidate entries as they change the
+    rows. Without one each process keeps it's own bounded LRU, only
+    changes made through that process invalidate it and everything else
+    shows up once the entry expires. Either way an entry is never served
+    more than ttl seconds after it was read from the database. If redis
+    can't be reached every lookup is a miss.
+
+    A request that read an email just before it changed could cache the
+    old row after the change invalidated it. Invalidating leaves a
+    tombstone for tombstone_ttl seconds that set won't overwrite, so that
+    only happens to a request that takes longer than that between reading
+    the row and caching it, and even then only until ttl runs out.
+    """
+
+    def __init__(self, max_size=10000, ttl=30, negative_ttl=5,
+                 redis_url=None, tombstone_ttl=2):
+        """
+        Constructor for the email cache.
+        Kwargs:
+            max_size (int): Max emails held in process.
+            ttl (float): Seconds to keep an email. 0 turns the cache off.
+            negative_ttl (float): Seconds to remember an email doesn't
+                                  exist.
+            redis_url (str): Redis to share the cache across processes.
+                             Disabled when None.
+            tombstone_ttl (float): Seconds after an invalidation that the
+                                   email can't be cached again.
+        """
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.tombstone_ttl = tombstone_ttl
+        self._cache = LRUCache(max_size)
+        self._redis = None
+        if ttl and redis_url:
+            import redis
+            self._redis = redis.StrictRedis.from_url(redis_url)
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'negative_hits': 0, 'misses': 0,
+                       'invalidations': 0}
+
+    def _count(self, stat, amount=1):
+        with self._lock:
+            self._stats[stat] += amount
+
+    def stats(self):
+        """
+        Hit and miss counters for this process.
+        Returns:
+            (dict) hits, negative_hits, misses, invalidations, lookups and
+                size. size only counts the in process tier.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats['lookups'] = stats['hits'] + stats['negative_hits'] + \
+            stats['misses']
+        stats['size'] = len(self._cache)
+        return stats
+
+    def _load(self, uuid):
+        """
+        Get an entry from whichever tier is in use.
+        Returns:
+            (tuple) The time it was cached and the JSON, or None on a miss
+                or a tombstone.
+        """
+        if self._redis is None:
+            entry = self._cache.get(uuid)
+            return None if entry == TOMBSTONE else entry
+        import redis
+        try:
+            value = self._redis.get(REDIS_KEY.format(uuid))
+        except redis.RedisError:
+            return None
+        if value is None:
+            return None
+        value = value.decode('utf-8')
+        if value == TOMBSTONE:
+            return None
+        cached_at, body = value.split(':', 1)
+        return float(cached_at), body
+
+    def get(self, uuid):
+        """
+        Look up an email.
+        Args:
+            uuid (str): UUID of the email.
+        Returns:
+            (str) The email's JSON, an empty string if the email is known
+                not to exist, or None on a miss.
+        """
+        if not self.ttl:
+            return None
+        entry = self._load(uuid)
+        if entry is None:
+            self._count('misses')
+            metrics.EMAIL_CACHE.labels('miss').inc()
+            return None
+        cached_at, body = entry
+        result = 'hit' if body else 'negative_hit'
+        self._count(result + 's')
+        metrics.EMAIL_CACHE.labels(result).inc()
+        metrics.EMAIL_CACHE_AGE.observe(max(0, time.time() - cached_at))
+        return body
+
+    def set(self, uuid, body):
+        """
+        Cache what was read from the database, unless the email was
+        invalidated in the last tombstone_ttl seconds.
+        Args:
+            uuid (str): UUID of the email.
+            body (str): The email's JSON, or an empty string if there is
+                        no such email.
+        """
+        if not self.ttl:
+            return
+        ttl = self.ttl if body else self.negative_ttl
+        if not ttl:
+            return
+        now = time.time()
+        if self._redis is None:
+            with self._lock:
+                if self._cache.get(uuid) != TOMBSTONE:
+                    self._cache.set(uuid, (now, body), ttl)
+            return
+        import redis
+        # set only runs after a miss, so anything already there is a
+        # tombstone or a concurrent reader's copy and is kept.
+        try:
+            self._redis.set(REDIS_KEY.format(uuid),
+                            '{0:.3f}:{1}'.format(now, body),
+                            px=int(ttl * 1000), nx=True)
+        except redis.RedisError:
+            pass
+
+    def invalidate(self, *uuids):
+        """
+        Drop emails that have changed or been deleted.
+        Args:
+            *uuids (str): UUIDs of the emails.
+        """
+        if not self.ttl or not uuids:
+            return
+        self._count('invalidations', len(uuids))
+        if self._redis is None:
+            with self._lock:
+                for uuid in uuids:
+                    if self.tombstone_ttl:
+                        self._cache.set(uuid, TOMBSTONE, self.tombstone_ttl)
+                    else:
+                        self._cache.delete(uuid)
+            return
+        import redis
+        keys = [REDIS_KEY.format(uuid) for uuid in uuids]
+        try:
+            if not self.tombstone_ttl:
+                self._redis.delete(*keys)
+                return
+            pipe = self._redis.pipeline(transaction=False)
+            for key in keys:
+                pipe.set(key, TOMBSTONE, px=int(self.tombstone_ttl * 1000))
+            pipe.execute()
+        except redis.RedisError:
+            pass
@@ -2,10 +2,16 @@
 mini_mailgun client
 """
 import json
+import time
+import warnings
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from mini_mailgun.constants import FINISHED_STATUSES
 from mini_mailgun.exceptions import ClientExceptionError, ServerExceptionError
+from mini_mailgun.exceptions import MiniMailgunError
 from mini_mailgun.exceptions import MessageAlreadySentOrFailedError
 
 
@@ -32,22 +38,69 @@ class Message:
         self.attempts = message_json['attempts']
         self.status = message_json['status']
         self.status_code = message_json['status_code']
+        self.priority = message_json.get('priority')
 
 
 class Client:
     """
-    mini_mailgun http client.
+    mini_mailgun http client. Requests go over a pool of keep alive
+    connections, so reuse one client rather than making one per call.
     """
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, pool_size=10, max_retries=3,
+                 backoff_factor=0.1, timeout=10):
         """
         Args:
             host (str): The host of the mini_mailgun service.
             port (str): The port you with to connect over.
+        Kwargs:
+            pool_size (int): Max connections kept open to the service.
+            max_retries (int): Times to retry a request that couldn't
+                connect, or a GET or DELETE that got a 502, 503 or 504.
+                Other POSTs aren't retried so an email is never sent twice.
+            backoff_factor (float): Retries wait backoff_factor seconds,
+                doubling each time.
+            timeout (float): Seconds to wait to connect and for each read.
         """
         self.uri = 'http://{0}:{1}/v1/'.format(host, port)
         self.host = host
         self.port = port
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size,
+            max_retries=Retry(total=max_retries,
+                              backoff_factor=backoff_factor,
+                              status_forcelist=(502, 503, 504),
+                              raise_on_status=False))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        """
+        Close every pooled connection.
+        """
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _request(self, method, uri, **kwargs):
+        """
+        Make a request over the pooled session.
+        Args:
+            method (str): The HTTP method.
+            uri (str): The request url.
+        Kwargs:
+            **kwargs: Passed through to requests.
+        Returns:
+            (requests.Response)
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, uri, **kwargs)
 
     def _make_uri(self, *args):
         """
@@ -79,7 +132,7 @@ class Client:
         elif response.status_code >= 400 and response.status_code < 500:
             raise ClientExceptionError(response.status_code)
 
-    def send_email(self, from_addr, to_addr, subject, body):
+    def send_email(self, from_addr, to_addr, subject, body, priority=None):
         """
         Send an email.
         Args:
@@ -87,6 +140,9 @@ class Client:
             to_addr (str): The recipiant's address.
             subject (str): The subject of the email.
             body (str): The body of the email.
+        Kwargs:
+            priority (int): 0 to 9, higher goes first. Defaults to 5 on
+                the server.
         Raises:
             ClientExceptionError on a 4** series error.
             ServerExceptionError on a 5** series error.
@@ -98,11 +154,33 @@ class Client:
                 'to_addr': to_addr,
                 'subject': subject,
                 'body': body}
-        response = requests.post(uri, json=json.dumps(data),
-                                 headers={'content-type': 'application/json'})
+        if priority is not None:
+            data['priority'] = priority
+        response = self._request('POST', uri, json=data)
         self._check_for_errors(response)
         return Message(response.json())
 
+    def send_emails(self, messages):
+        """
+        Send a batch of emails in a single request.
+        Args:
+            messages (list): A list of dicts each with a from_addr,
+                to_addr, subject, body and optionally a priority. Messages
+                without one are sent as bulk mail.
+        Raises:
+            ClientExceptionError on a 4** series error. Including when
+                every message in the batch is invalid.
+            ServerExceptionError on a 5** series error.
+        Returns:
+            (list) One dict per message in the order they were given.
+                Accepted messages have a uuid and status, rejected
+                messages have an error.
+        """
+        uri = self._make_uri('emails')
+        response = self._request('POST', uri, json=messages)
+        self._check_for_errors(response)
+        return response.json()
+
     def delete_email(self, uuid):
         """
         Delete a message if it has not already been sent.
@@ -115,7 +193,7 @@ class Client:
             ServerExceptionError on all 5** series errors.
         """
         uri = self._make_uri('email', uuid)
-        response = requests.delete(uri)
+        response = self._request('DELETE', uri)
         self._check_for_errors(response)
 
     def get_email(self, uuid):
@@ -130,26 +208,183 @@ class Client:
             (mini_mailgun.api.client.Message)
         """
         uri = self._make_uri('email', uuid)
-        response = requests.get(uri)
+        response = self._request('GET', uri)
         self._check_for_errors(response)
         return Message(response.json())
 
-    def get_emails(self, limit=1000, offset=0):
+    def wait_for_status(self, uuid, statuses=FINISHED_STATUSES, timeout=None,
+                        wait=30):
+        """
+        Wait for an email to reach a status. Long polls the service, which
+        answers as soon as the status changes, instead of polling on a
+        timer.
+        Args:
+            uuid (str): The UUID of the message.
+        Kwargs:
+            statuses (tuple): Statuses to wait for. Defaults to SENT,
+                FAILED or DELETED.
+            timeout (float): Max seconds to wait. None to wait for as long
+                as it takes.
+            wait (float): Max seconds the service holds each request for.
+        Raises:
+            ClientExceptionError on all 4** series errors.
+            ServerExceptionError on all 5** series errors.
+        Returns:
+            (mini_mailgun.api.client.Message) The email once it reaches one
+                of statuses, or as it is when timeout runs out.
+        """
+        uri = self._make_uri('email', uuid)
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            poll = wait if deadline is None else \
+                max(0, min(wait, deadline - time.time()))
+            response = self._request('GET', uri, params={'wait': poll},
+                                     timeout=poll + self.timeout)
+            self._check_for_errors(response)
+            message = Message(response.json())
+            if message.status in statuses or \
+                    (deadline is not None and time.time() >= deadline):
+                return message
+
+    def get_emails(self, limit=1000, offset=0, page_size=1000, **filters):
         """
         Get a list of all emails in the system. Sent or otherwise.
+        Pages are fetched with the cursor returned by the server until
+        limit uuids have been collected or there are no more emails.
         Kwargs:
             limit (int): Integer to limit the number of UUID's returned
-                defaults to 1000.
-            offset (int): Offset to start the next request at.
+                defaults to 1000. None to return every email.
+            offset (int): Offset to start the first request at.
                 defaults to 0
+            page_size (int): Number of UUID's to fetch per request.
+                defaults to 1000
+            **filters: Any of status, from_addr, to_addr, created_after
+                and created_before.
         Raises:
             ClientExceptionError on all 4** series errors.
             ServerExceptionError on all 5** series errors.
         Returns:
-            (list) A list of email uuids.
+            (list) A list of email uuids ordered by creation time.
         """
-        params = {'limit': limit, 'offset': offset}
+        params = dict((k, v) for k, v in filters.items() if v is not None)
+        if offset:
+            params['offset'] = offset
         uri = self._make_uri('email')
-        response = requests.get(uri, params=params)
-        self._check_for_errors(response)
-        return response.json()
+        uuids = []
+        while limit is None or len(uuids) < limit:
+            params['limit'] = page_size if limit is None else min(
+                page_size, limit - len(uuids))
+            response = self._request('GET', uri, params=params)
+            self._check_for_errors(response)
+            page = response.json()
+            uuids.extend(page)
+            cursor = response.headers.get('X-Next-Cursor')
+            if not cursor or len(page) < params['limit']:
+                break
+            params.pop('offset', None)
+            params['cursor'] = cursor
+        return uuids
+
+    def iter_emails(self, limit=None, chunk_size=8192, **filters):
+        """
+        Stream full info for every email in the system. Sent or otherwise.
+        The export is parsed a line at a time so memory use stays flat no
+        matter how many emails there are.
+        Kwargs:
+            limit (int): Max emails to return. None for all of them.
+            chunk_size (int): Bytes to read from the socket at a time.
+            **filters: Any of status, from_addr, to_addr, created_after,
+                created_before and cursor.
+        Raises:
+            ClientExceptionError on all 4** series errors.
+            ServerExceptionError on all 5** series errors.
+        Returns:
+            (generator) mini_mailgun.api.client.Message objects ordered by
+                creation time.
+        """
+        params = dict((k, v) for k, v in filters.items() if v is not None)
+        if limit is not None:
+            params['limit'] = limit
+        uri = self._make_uri('emails', 'export')
+        response = self._request('GET', uri, params=params, stream=True)
+        try:
+            self._check_for_errors(response)
+            for line in response.iter_lines(chunk_size=chunk_size):
+                if line:
+                    yield Message(json.loads(line))
+        finally:
+            response.close()
+
+
+class ConcurrentClient(Client):
+    """
+    mini_mailgun http client for running thousands of requests at once.
+    Each request runs in it's own greenlet, so the process needs gevent's
+    monkey patching for them to overlap.
+    """
+
+    def __init__(self, host, port, concurrency=1000, **kwargs):
+        """
+        Args:
+            host (str): The host of the mini_mailgun service.
+            port (str): The port you with to connect over.
+        Kwargs:
+            concurrency (int): Max requests in flight.
+            **kwargs: Passed through to Client. pool_size defaults to
+                concurrency.
+        """
+        from gevent import monkey
+        from gevent.pool import Pool
+        if not monkey.is_module_patched('socket'):
+            warnings.warn('gevent has not patched socket, requests made by '
+                          'ConcurrentClient will run one at a time.')
+        kwargs.setdefault('pool_size', concurrency)
+        Client.__init__(self, host, port, **kwargs)
+        self.pool = Pool(concurrency)
+
+    def spawn(self, method, *args, **kwargs):
+        """
+        Call a client method in a greenlet.
+        Args:
+            method (str): Name of the method. ie send_email.
+            *args: Passed through to the method.
+        Kwargs:
+            **kwargs: Passed through to the method.
+        Returns:
+            (gevent.Greenlet) get() returns the result or raises.
+        """
+        return self.pool.spawn(getattr(self, method), *args, **kwargs)
+
+    def map(self, method, calls):
+        """
+        Make many calls at once and wait for all of them.
+        Args:
+            method (str): Name of the method. ie send_email.
+            calls (list): kwargs dicts, one per call.
+        Returns:
+            (list) The result of each call in order, or the
+                MiniMailgunError or requests.RequestException it raised.
+        """
+        import gevent
+
+        def call_or_error(kwargs):
+            try:
+                return getattr(self, method)(**kwargs)
+            except (MiniMailgunError, requests.RequestException) as e:
+                return e
+        greenlets = [self.pool.spawn(call_or_error, call) for call in calls]
+        gevent.joinall(greenlets, raise_error=True)
+        return [greenlet.value for greenlet in greenlets]
+
+    def send_email_many(self, messages):
+        """
+        Send each email in it's own request, all at once. The batch
+        endpoint is cheaper when you have all the messages up front.
+        Args:
+            messages (list): Dicts each with a from_addr, to_addr,
+                subject and body.
+        Returns:
+            (list) A mini_mailgun.api.client.Message for each accepted
+                email and the exception for each rejected one, in order.
+        """
+        return self.map('send_email', messages)
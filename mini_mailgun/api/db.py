@@ -1,7 +1,261 @@
 """
 Save me from circlular imports module.
+
+Also where emails are spread across databases. Shard 0 is
+SQLALCHEMY_DATABASE_URI and every url in SHARD_DATABASE_URIS adds a
+shard, registered as a flask-sqlalchemy bind. An email's shard comes from
+the shard key byte of it's uuid, see mini_mailgun.common.shard_key, and
+the outbox rows for an email live on the same shard as the email.
+
+db.session routes by the shard key. New rows go to their uuid's shard,
+loaded rows go back to the shard they came from and queries filtering on
+the shard key, like filter_by(uuid=uuid) or uuid.in_(...), only run on
+the shards those uuids live on. Anything else runs on every shard and the
+results are concatenated, use query.set_shard(shard) to pick one or
+mini_mailgun.api.query.gather to merge ordered listings. Statements run
+through db.session.execute go to shard 0 unless given shard_id.
 """
-from flask_sqlalchemy import SQLAlchemy
+from collections import OrderedDict
+
+from flask_sqlalchemy import BaseQuery, SignallingSession, SQLAlchemy
+from sqlalchemy import orm
+from sqlalchemy.ext.horizontal_shard import ShardedQuery, ShardedSession
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter
+from sqlalchemy.sql.elements import BooleanClauseList, Grouping
+
+from mini_mailgun.common import shard_key
+from mini_mailgun.metrics import instrument_sessions
+
+SHARD_BIND = 'shard{0}'
+
+
+def shard_count(app=None):
+    """
+    Get the number of shards.
+    Kwargs:
+        app (flask.Flask): Defaults to the current app.
+    Returns:
+        (int)
+    """
+    app = db.get_app(app)
+    return 1 + len(app.config.get('SHARD_DATABASE_URIS') or ())
+
+
+def shard_ids(app=None):
+    """
+    Get every shard.
+    Kwargs:
+        app (flask.Flask): Defaults to the current app.
+    Returns:
+        (list) Shard numbers.
+    """
+    return list(range(shard_count(app)))
+
+
+def shard_of(uuid, app=None):
+    """
+    Get the shard an email lives on.
+    Args:
+        uuid (str): UUID of the email.
+    Kwargs:
+        app (flask.Flask): Defaults to the current app.
+    Returns:
+        (int) The shard.
+    """
+    count = shard_count(app)
+    if count == 1:
+        return 0
+    return shard_key(uuid) % count
+
+
+def shard_engine(shard, app=None):
+    """
+    Get the engine for a shard.
+    Args:
+        shard (int): The shard.
+    Kwargs:
+        app (flask.Flask): Defaults to the current app.
+    Returns:
+        (sqlalchemy.engine.Engine)
+    """
+    return db.get_engine(app, bind=SHARD_BIND.format(shard) if shard else None)
+
+
+def shard_limit(limit, app=None):
+    """
+    Split a batch size across shards for a query that runs on every shard.
+    Args:
+        limit (int): Max rows wanted in total.
+    Kwargs:
+        app (flask.Flask): Defaults to the current app.
+    Returns:
+        (int) Max rows to take from each shard.
+    """
+    return -(-limit // shard_count(app))
+
+
+def group_by_shard(items, key=None, app=None):
+    """
+    Split items by the shard of their email.
+    Args:
+        items (iterable): uuids, or anything key gets a uuid from.
+    Kwargs:
+        key (callable): Gets the uuid from an item. Defaults to the item.
+        app (flask.Flask): Defaults to the current app.
+    Returns:
+        (OrderedDict) Shard mapped to a list of it's items, in order.
+    """
+    groups = OrderedDict()
+    for item in items:
+        uuid = item if key is None else key(item)
+        groups.setdefault(shard_of(uuid, app), []).append(item)
+    return groups
+
+
+def _shard_column(clause):
+    return getattr(clause, 'table', None) is not None and \
+        clause.table.info.get('shard_key') == clause.key
+
+
+def _pinned_uuids(criterion):
+    """
+    Get the uuids a where clause limits the shard key to.
+    Args:
+        criterion: The where clause of a query.
+    Returns:
+        (list) The uuids, or None if the clause doesn't limit the shard
+            key with = or IN in one of it's top level ANDs.
+    """
+    if isinstance(criterion, BooleanClauseList) and \
+            criterion.operator is operators.and_:
+        clauses = criterion.clauses
+    else:
+        clauses = [criterion]
+    for clause in clauses:
+        if not isinstance(clause, BinaryExpression) or \
+                not _shard_column(clause.left):
+            continue
+        right = clause.right
+        if clause.operator is operators.eq and \
+                isinstance(right, BindParameter):
+            return [right.effective_value]
+        if clause.operator is operators.in_op:
+            if isinstance(right, BindParameter):
+                return list(right.effective_value)
+            if isinstance(right, Grouping) and \
+                    all(isinstance(value, BindParameter)
+                        for value in right.element.clauses):
+                return [value.effective_value
+                        for value in right.element.clauses]
+    return None
+
+
+class ShardedBaseQuery(ShardedQuery, BaseQuery):
+    """
+    Query class for db.session and Model.query.
+    """
+
+    def _execute_and_instances(self, context):
+        # Results from one shard are streamed rather than collected first,
+        # so yield_per keeps working.
+        if self._shard_id is None and context.identity_token is None:
+            shards = self.query_chooser(self)
+            if len(shards) == 1:
+                context.identity_token = shards[0]
+        return super(ShardedBaseQuery, self)._execute_and_instances(context)
+
+
+class ShardedSignallingSession(ShardedSession, SignallingSession):
+    """
+    flask-sqlalchemy's session with every email routed to it's shard.
+    """
+
+    def __init__(self, db, **options):
+        ShardedSession.__init__(self, self.choose_shard, self.choose_ids,
+                                self.choose_query, db=db, **options)
+
+    def get_bind(self, mapper=None, shard_id=None, instance=None,
+                 clause=None, **kwargs):
+        if shard_id is None:
+            shard_id = self._choose_shard_and_assign(mapper, instance,
+                                                     clause=clause)
+        return shard_engine(shard_id, self.app)
+
+    def choose_shard(self, mapper, instance, clause=None):
+        """
+        Get the shard to write a new row to.
+        """
+        if mapper is None or instance is None:
+            return 0
+        key = mapper.persist_selectable.info.get('shard_key')
+        if key is None:
+            return 0
+        return shard_of(getattr(instance, key), self.app)
+
+    def choose_ids(self, query, ident):
+        """
+        Get the shards to look up a primary key on.
+        """
+        if shard_count(self.app) == 1:
+            return [0]
+        mapper = query._bind_mapper()
+        key = mapper.persist_selectable.info.get('shard_key')
+        if key is not None and mapper.primary_key[0].key == key:
+            return [shard_of(ident[0], self.app)]
+        return shard_ids(self.app)
+
+    def choose_query(self, query):
+        """
+        Get the shards a query has to run on.
+        """
+        if shard_count(self.app) == 1:
+            return [0]
+        uuids = None
+        if query._criterion is not None:
+            uuids = _pinned_uuids(query._criterion)
+        if not uuids:
+            return shard_ids(self.app)
+        try:
+            return sorted(set(shard_of(uuid, self.app) for uuid in uuids))
+        except (TypeError, ValueError):
+            return shard_ids(self.app)
+
+
+class ShardedSQLAlchemy(SQLAlchemy):
+    """
+    SQLAlchemy with the shards registered as binds.
+    """
+
+    def init_app(self, app):
+        uris = app.config.get('SHARD_DATABASE_URIS') or ()
+        if uris:
+            binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+            for shard, uri in enumerate(uris, 1):
+                binds[SHARD_BIND.format(shard)] = uri
+            app.config['SQLALCHEMY_BINDS'] = binds
+        super(ShardedSQLAlchemy, self).init_app(app)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=ShardedSignallingSession, db=self,
+                                **options)
+
+    def create_all(self, bind='__all__', app=None):
+        super(ShardedSQLAlchemy, self).create_all(bind, app)
+        if bind == '__all__':
+            for shard in shard_ids(app)[1:]:
+                self.Model.metadata.create_all(
+                    bind=shard_engine(shard, app),
+                    tables=self.get_tables_for_bind())
+
+    def drop_all(self, bind='__all__', app=None):
+        super(ShardedSQLAlchemy, self).drop_all(bind, app)
+        if bind == '__all__':
+            for shard in shard_ids(app)[1:]:
+                self.Model.metadata.drop_all(
+                    bind=shard_engine(shard, app),
+                    tables=self.get_tables_for_bind())
 
 
-db = SQLAlchemy()
+db = ShardedSQLAlchemy(query_class=ShardedBaseQuery)
+instrument_sessions(db.session)
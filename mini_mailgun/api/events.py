@@ -0,0 +1,275 @@
+"""
+Status change events for clients waiting on an email.
+
+Whatever commits a status change publishes it to the email's own redis
+channel. Each API process runs a single listener, subscribed to the
+channels of the emails someone in that process is waiting on, and hands
+every event to the requests waiting on that email. A process only
+receives the events it has waiters for, a waiting client holds no
+database connection and costs one greenlet under the gevent server.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from mini_mailgun.constants import API_LOGGER
+
+STATUS_CHANNEL = 'mini_mailgun:status:{0}'
+LOG = logging.getLogger(API_LOGGER)
+
+
+class Subscription(object):
+    """
+    Status events for one email, for one waiting request. Use as a context
+    manager, or call close, so the feed stops delivering to it.
+    """
+
+    def __init__(self, feed, uuid):
+        """
+        Args:
+            feed (StatusFeed): The feed it belongs to.
+            uuid (str): UUID of the email.
+        """
+        self.feed = feed
+        self.uuid = uuid
+        self._events = deque()
+        self._ready = threading.Event()
+
+    def put(self, event):
+        self._events.append(event)
+        self._ready.set()
+
+    def get(self, timeout):
+        """
+        Wait for the next event.
+        Args:
+            timeout (float): Max seconds to wait.
+        Returns:
+            (dict) The event, or None if nothing happened in time.
+        """
+        if not self._events:
+            self._ready.wait(timeout)
+        self._ready.clear()
+        try:
+            return self._events.popleft()
+        except IndexError:
+            return None
+        finally:
+            if self._events:
+                self._ready.set()
+
+    def close(self):
+        self.feed.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class StatusFeed(object):
+    """
+    Publishes status changes and delivers them to subscriptions. With a
+    redis url events reach every process with a subscription to the
+    email, otherwise only subscriptions in the publishing process see them.
+    Events published while redis is unreachable are dropped, waiting
+    requests then time out and read the email from the database.
+    """
+
+    def __init__(self, redis_url=None, reconnect_delay=1):
+        """
+        Constructor for the status feed.
+        Kwargs:
+            redis_url (str): Redis to publish through. Disabled when None.
+            reconnect_delay (float): Seconds to wait before the listener
+                                     reconnects after losing redis.
+        """
+        self.reconnect_delay = reconnect_delay
+        self._redis = None
+        if redis_url:
+            import redis
+            self._redis = redis.StrictRedis.from_url(redis_url)
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        self._pubsub = None
+        self._wanted = threading.Event()
+
+    def publish(self, uuid, status, status_code=None, attempts=None):
+        """
+        Tell waiting clients an email's status changed. Only call once the
+        change is committed.
+        Args:
+            uuid (str): UUID of the email.
+            status (str): The new status.
+        Kwargs:
+            status_code (int): The last SMTP status code.
+            attempts (int): Attempts made so far.
+        """
+        event = {'uuid': uuid, 'status': status, 'status_code': status_code,
+                 'attempts': attempts}
+        if self._redis is None:
+            self._dispatch(event)
+            return
+        import redis
+        try:
+            self._redis.publish(STATUS_CHANNEL.format(uuid),
+                                json.dumps(event))
+        except redis.RedisError:
+            LOG.warning('Unable to publish the status of %s.', uuid)
+
+    def publish_many(self, events):
+        """
+        Publish what a status writer flushed.
+        Args:
+            events (dict): uuid mapped to a mini_mailgun.api.status
+                           event. Events without a status are skipped.
+        """
+        for uuid, event in events.items():
+            if 'status' in event:
+                self.publish(uuid, event['status'],
+                             status_code=event.get('status_code'),
+                             attempts=event['attempts'])
+
+    def subscribe(self, uuid):
+        """
+        Start collecting status events for an email. Subscribe before
+        reading the email so no change slips in between.
+        Args:
+            uuid (str): UUID of the email.
+        Returns:
+            (Subscription)
+        """
+        if self._redis is not None and self._pid != os.getpid():
+            self._start()
+        subscription = Subscription(self, uuid)
+        with self._lock:
+            subscriptions = self._subscriptions.setdefault(uuid, set())
+            subscriptions.add(subscription)
+            if self._redis is not None and len(subscriptions) == 1:
+                self._follow(uuid)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Stop delivering to a subscription.
+        Args:
+            subscription (Subscription): What subscribe returned.
+        """
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.uuid)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.uuid]
+                    self._unfollow(subscription.uuid)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(subscriptions)
+                       for subscriptions in self._subscriptions.values())
+
+    def _dispatch(self, event):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(event['uuid'], ()))
+        for subscription in subscriptions:
+            subscription.put(event)
+
+    def _follow(self, uuid):
+        """
+        Subscribe to an email's channel. Call with the lock held.
+        Args:
+            uuid (str): UUID of the email.
+        """
+        import redis
+        self._wanted.set()
+        try:
+            if self._pubsub is None:
+                self._connect()
+            else:
+                self._pubsub.subscribe(STATUS_CHANNEL.format(uuid))
+        except redis.RedisError:
+            LOG.warning('Unable to follow the status of %s.', uuid)
+
+    def _unfollow(self, uuid):
+        """
+        Unsubscribe from an email's channel. Call with the lock held.
+        Args:
+            uuid (str): UUID of the email.
+        """
+        if self._pubsub is None:
+            return
+        import redis
+        try:
+            self._pubsub.unsubscribe(STATUS_CHANNEL.format(uuid))
+        except redis.RedisError:
+            LOG.warning('Unable to stop following the status of %s.', uuid)
+
+    def _connect(self):
+        """
+        Open a pubsub subscribed to the channel of every email with a
+        subscription. Call with the lock held.
+        Raises:
+            redis.RedisError if redis is unreachable.
+        Returns:
+            (redis.client.PubSub) The pubsub, or None if nothing is
+                subscribed.
+        """
+        channels = [STATUS_CHANNEL.format(uuid)
+                    for uuid in self._subscriptions]
+        if not channels:
+            self._wanted.clear()
+            return None
+        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(*channels)
+        self._pubsub = pubsub
+        return pubsub
+
+    def _start(self):
+        """
+        Start the listener for this process. Under gevent it's a greenlet.
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            # A pubsub inherited over fork shares it's socket with the
+            # parent, leave it to the parent.
+            self._pubsub = None
+            thread = threading.Thread(target=self._listen,
+                                      name='status-feed')
+            thread.daemon = True
+            thread.start()
+
+    def _listen(self):
+        """
+        Read events while anything is subscribed. listen returns once the
+        last channel is unsubscribed and the next subscription opens a new
+        pubsub, which also picks up any email followed in between.
+        """
+        import redis
+        while True:
+            self._wanted.wait()
+            pubsub = None
+            failed = False
+            try:
+                with self._lock:
+                    pubsub = self._pubsub or self._connect()
+                if pubsub is not None:
+                    for message in pubsub.listen():
+                        if message['type'] == 'message':
+                            self._dispatch(json.loads(message['data']))
+            except redis.RedisError:
+                LOG.exception('Lost the status feed, reconnecting.')
+                failed = True
+            with self._lock:
+                if self._pubsub is pubsub:
+                    self._pubsub = None
+            if pubsub is not None:
+                pubsub.close()
+            if failed:
+                time.sleep(self.reconnect_delay)
@@ -1,20 +1,55 @@
 """
 Database models.
 """
+import hashlib
 import json
+from datetime import timedelta
+from uuid import UUID
 
-from flanker.mime import create
+from sqlalchemy.types import BINARY, TypeDecorator
 
 from mini_mailgun.api.db import db
 from mini_mailgun.common import utc_time, uuid
-from mini_mailgun.constants import STATUS_SENDING
+from mini_mailgun.constants import STATUS_SENDING, STATUS_SENT, STATUS_FAILED
+from mini_mailgun.constants import STATUS_DELETED
+from mini_mailgun.constants import DEFAULT_PRIORITY
+
+
+class BinaryUUID(TypeDecorator):
+    """
+    A UUID stored as 16 bytes. Everything outside the database sees the
+    usual text form.
+    """
+    impl = BINARY(16)
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return UUID(value).bytes
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return str(UUID(bytes=bytes(value)))
 
 
 class Email(db.Model):
     """
-    Email DB model.
+    Email DB model. Sharded on uuid, see mini_mailgun.api.db.
     """
-    uuid = db.Column(db.String(37), primary_key=True, unique=True)
+    __table_args__ = (
+        db.Index('ix_email_created_at_uuid', 'created_at', 'uuid'),
+        db.Index('ix_email_status_created_at', 'status', 'created_at', 'uuid'),
+        db.Index('ix_email_status_next_attempt_at',
+                 'status', 'next_attempt_at'),
+        db.Index('ix_email_status_finished_at', 'status', 'finished_at'),
+        db.Index('ix_email_from_addr_created_at',
+                 'from_addr', 'created_at', 'uuid'),
+        db.Index('ix_email_to_addr_created_at',
+                 'to_addr', 'created_at', 'uuid'),
+        {'info': {'shard_key': 'uuid'}})
+    uuid = db.Column(BinaryUUID, primary_key=True)
     from_addr = db.Column(db.String(256), nullable=False)
     to_addr = db.Column(db.String(256), nullable=False)
     subject = db.Column(db.String(78), nullable=False)
@@ -22,11 +57,15 @@ class Email(db.Model):
     created_at = db.Column(db.DateTime, nullable=False)
     deleted_at = db.Column(db.DateTime, nullable=True)
     last_attempt = db.Column(db.DateTime, nullable=True)
+    next_attempt_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
     attempts = db.Column(db.Integer, nullable=False, default=0)
     status = db.Column(db.String(10), nullable=False, default=STATUS_SENDING)
     status_code = db.Column(db.Integer, nullable=True)
+    priority = db.Column(db.SmallInteger, nullable=False,
+                         default=DEFAULT_PRIORITY)
 
-    def __init__(self, from_addr, to_addr, subject, body):
+    def __init__(self, from_addr, to_addr, subject, body, priority=None):
         """
         Construct an email model.
         Args:
@@ -34,15 +73,104 @@ class Email(db.Model):
             to_addr (str): The recipient's email address.
             subject (str): The subject of the email.
             body (str): The body of the message.
+        Kwargs:
+            priority (int): 0 to 9, higher goes first. Defaults to
+                            DEFAULT_PRIORITY.
         """
         if not self.uuid:
             self.uuid = uuid()
         if not self.created_at:
             self.created_at = utc_time()
+        if self.attempts is None:
+            self.attempts = 0
+        if not self.status:
+            self.status = STATUS_SENDING
         self.from_addr = from_addr
         self.to_addr = to_addr
         self.subject = subject
         self.body = body
+        self.priority = DEFAULT_PRIORITY if priority is None else priority
+
+    @staticmethod
+    def response_status(code, attempts, max_retries, status=STATUS_SENDING):
+        """
+        Work out the status after a delivery attempt.
+        Args:
+            code (int): The SMTP status code. -1 if we couldn't connect.
+            attempts (int): Attempts made including this one.
+            max_retries (int): Attempts allowed before the email fails.
+        Kwargs:
+            status (str): The status before the attempt.
+        Returns:
+            (str) The new status. An email deleted while the attempt was in
+                flight stays DELETED.
+        """
+        if status == STATUS_DELETED:
+            return status
+        if code in range(250, 253):
+            return STATUS_SENT
+        if attempts >= max_retries and status == STATUS_SENDING:
+            return STATUS_FAILED
+        return status
+
+    def record_response(self, code, max_retries):
+        """
+        Update the status from the SMTP response of a delivery attempt.
+        Args:
+            code (int): The SMTP status code. -1 if we couldn't connect.
+            max_retries (int): Attempts allowed before the email fails.
+        Returns:
+            (bool) True if the email should be retried.
+        """
+        self.status_code = code
+        if self.status == STATUS_DELETED:
+            return False
+        self.status = self.response_status(code, self.attempts, max_retries,
+                                           self.status)
+        if self.status != STATUS_SENDING:
+            self.next_attempt_at = None
+            self.finished_at = utc_time()
+        return self.status == STATUS_SENDING
+
+    def schedule_retry(self, wait):
+        """
+        Mark the email as due for another attempt after a wait. The retry
+        poller picks it up once next_attempt_at has passed.
+        Args:
+            wait (float): Seconds to wait.
+        """
+        self.next_attempt_at = utc_time() + timedelta(seconds=wait)
+
+    def to_row(self):
+        """
+        Get a dict of column values for this model. Used for multi row
+        inserts where going through the ORM unit of work is too slow.
+        Returns:
+            (dict) Column names mapped to their values.
+        """
+        return dict((column.name, getattr(self, column.name))
+                    for column in self.__table__.columns)
+
+    def to_dict(self):
+        """
+        Get the dict the rest api serializes for this model.
+        Returns:
+            (dict) The email's fields with times as strings.
+        """
+        return {'uuid': self.uuid,
+                'from_addr': self.from_addr,
+                'to_addr': self.to_addr,
+                'subject': self.subject,
+                'body': self.body,
+                'created_at': str(self.created_at),
+                'deleted_at': str(self.deleted_at),
+                'last_attempt': str(self.last_attempt),
+                'next_attempt_at': str(self.next_attempt_at),
+                'finished_at': str(self.finished_at),
+                'attempts': self.attempts,
+                'status': self.status,
+                'status_code': self.status_code,
+                'priority': self.priority}
 
     def to_json(self):
         """
@@ -51,27 +179,67 @@ class Email(db.Model):
         Returns:
             (str) Json representation of this DB model.
         """
-        return json.dumps({'uuid': self.uuid,
-                           'from_addr': self.from_addr,
-                           'to_addr': self.to_addr,
-                           'subject': self.subject,
-                           'body': self.body,
-                           'created_at': str(self.created_at),
-                           'deleted_at': str(self.deleted_at),
-                           'last_attempt': str(self.last_attempt),
-                           'attempts': self.attempts,
-                           'status': self.status,
-                           'status_code': self.status_code})
+        return json.dumps(self.to_dict())
+
+    def content_hash(self):
+        """
+        Get a hash of everything that goes into the rendered message.
+        Tasks carry this along with the uuid instead of the message itself
+        so workers can tell if a cached rendering is still good.
+        Returns:
+            (str) A hex sha1 digest.
+        """
+        digest = hashlib.sha1()
+        for value in (self.from_addr, self.to_addr, self.subject, self.body):
+            if not isinstance(value, bytes):
+                value = value.encode('utf-8')
+            digest.update(value)
+            digest.update(b'\0')
+        return digest.hexdigest()
 
-    def to_msg(self):
+    def to_msg(self, to_header=None):
         """
         Get a well formed email message based off of the info in this
         DB record. Used when sending the email in the tasks module.
+        Kwargs:
+            to_header (str): Replaces to_addr in the To header. Used when
+                             one message goes out to several recipients.
         Returns:
             (u'str') Well formed email message.
         """
+        # flanker is slow to import and only workers render messages.
+        from flanker.mime import create
         message = create.text("plain", self.body)
         message.headers['From'] = self.from_addr
-        message.headers['To'] = self.to_addr
+        message.headers['To'] = to_header or self.to_addr
         message.headers['Subject'] = self.subject
         return message.to_string()
+
+
+class Outbox(db.Model):
+    """
+    Emails waiting to be published to celery. Rows are written in the same
+    transaction as the email so an email is never committed without the
+    relay knowing to publish it, so they live on the email's shard.
+    """
+    __table_args__ = (
+        db.Index('ix_outbox_dispatched_at_id', 'dispatched_at', 'id'),
+        {'info': {'shard_key': 'email_uuid'}})
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'),
+                   primary_key=True, autoincrement=True)
+    email_uuid = db.Column(BinaryUUID, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    dispatched_at = db.Column(db.DateTime, nullable=True)
+
+    @staticmethod
+    def rows(emails):
+        """
+        Get outbox rows for new emails, for a multi row insert.
+        Args:
+            emails (list): mini_mailgun.api.models.Email objects.
+        Returns:
+            (list) Dicts of column values.
+        """
+        now = utc_time()
+        return [{'email_uuid': email.uuid, 'created_at': now}
+                for email in emails]
@@ -0,0 +1,114 @@
+"""
+Helpers for filtering and paginating email listings.
+"""
+import base64
+import heapq
+from itertools import islice
+
+from mini_mailgun.api.db import shard_ids
+from mini_mailgun.api.models import Email
+from mini_mailgun.common import normalize_uuid, parse_time
+
+
+def encode_cursor(created_at, uuid):
+    """
+    Build an opaque cursor pointing just after a row.
+    Args:
+        created_at (datetime.datetime): created_at of the last row returned.
+        uuid (str): uuid of the last row returned.
+    Returns:
+        (str) The cursor.
+    """
+    key = '{0}|{1}'.format(created_at.strftime('%Y-%m-%dT%H:%M:%S.%f'), uuid)
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Reverse encode_cursor.
+    Args:
+        cursor (str): The cursor.
+    Raises:
+        ValueError if the cursor is malformed.
+    Returns:
+        (tuple) created_at and uuid.
+    """
+    try:
+        key = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        created_at, uuid = key.split('|', 1)
+    except (TypeError, UnicodeError):
+        raise ValueError('Malformed cursor {0}'.format(cursor))
+    return parse_time(created_at), normalize_uuid(uuid)
+
+
+def filter_emails(query, args):
+    """
+    Apply listing filters from the request args to a query.
+    Supported args:
+        status (str): A status or comma separated list of statuses.
+        from_addr (str): Exact sender address.
+        to_addr (str): Exact recipient address.
+        created_after (str): Only emails created at or after this time.
+        created_before (str): Only emails created before this time.
+        cursor (str): Only emails after this cursor.
+    Args:
+        query (sqlalchemy.orm.Query): The query to filter.
+        args (dict): The request args.
+    Raises:
+        ValueError on malformed timestamps or cursors.
+    Returns:
+        (sqlalchemy.orm.Query) The filtered query ordered by
+            (created_at, uuid).
+    """
+    if args.get('status'):
+        query = query.filter(Email.status.in_(args['status'].split(',')))
+    if args.get('from_addr'):
+        query = query.filter(Email.from_addr == args['from_addr'])
+    if args.get('to_addr'):
+        query = query.filter(Email.to_addr == args['to_addr'])
+    if args.get('created_after'):
+        query = query.filter(
+            Email.created_at >= parse_time(args['created_after']))
+    if args.get('created_before'):
+        query = query.filter(
+            Email.created_at < parse_time(args['created_before']))
+    if args.get('cursor'):
+        created_at, uuid = decode_cursor(args['cursor'])
+        query = query.filter((Email.created_at > created_at) |
+                             ((Email.created_at == created_at) &
+                              (Email.uuid > uuid)))
+    return query.order_by(Email.created_at, Email.uuid)
+
+
+def _keyed(rows, shard):
+    for row in rows:
+        yield (row.created_at, row.uuid), shard, row
+
+
+def gather(query, limit=None, offset=0):
+    """
+    Run a listing from filter_emails on every shard and merge the results
+    by (created_at, uuid). Each shard is asked for up to offset + limit
+    rows and they are read lazily, so a yield_per query still streams.
+    Args:
+        query (sqlalchemy.orm.Query): A query from filter_emails.
+    Kwargs:
+        limit (int): Max rows. None for all of them.
+        offset (int): Rows to skip.
+    Returns:
+        (iterator) The rows in order.
+    """
+    shards = shard_ids()
+    if len(shards) == 1:
+        if offset:
+            query = query.offset(offset)
+        if limit is not None:
+            query = query.limit(limit)
+        return iter(query)
+    per_shard = query
+    if limit is not None:
+        per_shard = query.limit(offset + limit)
+    merged = heapq.merge(*[_keyed(per_shard.set_shard(shard), shard)
+                           for shard in shards])
+    stop = offset + limit if limit is not None else None
+    return (row for _, _, row in islice(merged, offset, stop))
@@ -0,0 +1,168 @@
+"""
+Purging finished emails from the database.
+"""
+import re
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, text
+
+from mini_mailgun.api.db import shard_engine, shard_ids
+from mini_mailgun.api.models import Email
+from mini_mailgun.common import utc_time
+from mini_mailgun.constants import FINISHED_STATUSES
+
+PARTITION_NAME = re.compile(r'^p(\d{4})(\d{2})$')
+FUTURE_PARTITION = 'p_future'
+
+
+def purge_finished(app, older_than, chunk_size=1000, max_chunks=100,
+                   pause=0.1, on_delete=None):
+    """
+    Delete emails that were sent, failed or deleted more than older_than
+    seconds ago. Rows go in chunks, each in it's own short transaction,
+    with a pause between chunks so replicas can keep up. Shards are purged
+    one after the other.
+    Args:
+        app (flask.Flask): App holding the database config.
+        older_than (int): Seconds an email is kept once it is finished.
+    Kwargs:
+        chunk_size (int): Max rows deleted per transaction.
+        max_chunks (int): Max chunks per shard per call. Whatever is left
+                          goes in the next run.
+        pause (float): Seconds to sleep between chunks.
+        on_delete (callable): Called with the uuids of each chunk once it
+                              is deleted.
+    Returns:
+        (int) The number of rows purged.
+    """
+    table = Email.__table__
+    cutoff = utc_time() - timedelta(seconds=older_than)
+    query = select([table.c.uuid]).where(
+        table.c.status.in_(FINISHED_STATUSES)).where(
+            table.c.finished_at < cutoff).limit(chunk_size)
+    purged = 0
+    for shard in shard_ids(app):
+        engine = shard_engine(shard, app)
+        for chunk in range(max_chunks):
+            if chunk:
+                time.sleep(pause)
+            # MySQL won't take a LIMIT inside IN (SELECT ...) so the uuids
+            # are selected first and deleted by primary key.
+            with engine.begin() as conn:
+                uuids = [row[0] for row in conn.execute(query)]
+                if uuids:
+                    conn.execute(
+                        table.delete().where(table.c.uuid.in_(uuids)))
+            if uuids and on_delete is not None:
+                on_delete(*uuids)
+            purged += len(uuids)
+            if len(uuids) < chunk_size:
+                break
+    return purged
+
+
+def next_month(value):
+    """
+    Get the first day of the month after value.
+    Args:
+        value (datetime.datetime): Any time.
+    Returns:
+        (datetime.datetime)
+    """
+    if value.month == 12:
+        return datetime(value.year + 1, 1, 1)
+    return datetime(value.year, value.month + 1, 1)
+
+
+def partition_end(name):
+    """
+    Get the exclusive upper bound of a monthly partition.
+    Args:
+        name (str): A partition name like p201703.
+    Returns:
+        (datetime.datetime) Or None if name isn't a monthly partition.
+    """
+    match = PARTITION_NAME.match(name)
+    if match is None:
+        return None
+    return next_month(datetime(int(match.group(1)), int(match.group(2)), 1))
+
+
+def partition_sql(months):
+    """
+    Get the VALUES LESS THAN clauses for monthly partitions.
+    Args:
+        months (list): The first day of each month to partition.
+    Returns:
+        (str) Partition definitions ending with the catch all partition.
+    """
+    partitions = ["PARTITION p{0:%Y%m} VALUES LESS THAN "
+                  "(TO_DAYS('{1:%Y-%m-%d}'))".format(month, next_month(month))
+                  for month in months]
+    partitions.append('PARTITION {0} VALUES LESS THAN MAXVALUE'.format(
+        FUTURE_PARTITION))
+    return ', '.join(partitions)
+
+
+def list_partitions(conn):
+    """
+    Get the names of the email table's partitions. MySQL only.
+    """
+    return [row[0] for row in conn.execute(text(
+        'SELECT partition_name FROM information_schema.partitions '
+        'WHERE table_schema = DATABASE() AND table_name = :table '
+        'AND partition_name IS NOT NULL'), table=Email.__tablename__)]
+
+
+def rotate_partitions(app, before, months_ahead=3):
+    """
+    Drop monthly partitions whose rows are all older than before and split
+    new months off the catch all partition, on every shard. Does nothing
+    to a shard unless it's table was partitioned by the
+    partition_email_by_month migration.
+    Args:
+        app (flask.Flask): App holding the database config.
+        before (datetime.datetime): Partitions ending on or before this are
+                                    dropped.
+    Kwargs:
+        months_ahead (int): Months past the current one to keep
+                            partitions for.
+    Returns:
+        (list) Names of the partitions dropped from any shard.
+    """
+    dropped = set()
+    for shard in shard_ids(app):
+        dropped.update(_rotate_partitions(shard_engine(shard, app), before,
+                                          months_ahead))
+    return sorted(dropped)
+
+
+def _rotate_partitions(engine, before, months_ahead):
+    if engine.dialect.name != 'mysql':
+        return []
+    with engine.connect() as conn:
+        names = list_partitions(conn)
+        if FUTURE_PARTITION not in names:
+            return []
+        ends = dict((name, partition_end(name)) for name in names)
+        dropped = [name for name, end in sorted(ends.items())
+                   if end is not None and end <= before]
+        if dropped:
+            conn.execute(text('ALTER TABLE email DROP PARTITION {0}'.format(
+                ', '.join(dropped))))
+        now = utc_time()
+        horizon = datetime(now.year, now.month, 1)
+        for _ in range(months_ahead):
+            horizon = next_month(horizon)
+        month = max([end for end in ends.values() if end] or
+                    [datetime(now.year, now.month, 1)])
+        months = []
+        while month <= horizon:
+            months.append(month)
+            month = next_month(month)
+        if months:
+            conn.execute(text(
+                'ALTER TABLE email REORGANIZE PARTITION {0} INTO ({1})'.format(
+                    FUTURE_PARTITION, partition_sql(months))))
+    return dropped
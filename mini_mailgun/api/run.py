@@ -1,10 +1,11 @@
 """
 Run the API server!
 """
-from gevent.wsgi import WSGIServer
+from gevent.pywsgi import WSGIServer
 from gevent import monkey
 
-from mini_mailgun.api.app import create_app, create_logger
+from mini_mailgun.api.app import get_app, create_logger
+from mini_mailgun.api.app import register_blueprints
 from mini_mailgun.constants import API_LOGGER
 
 
@@ -13,7 +14,11 @@ def run_server():
     Entry point to start the API Server.
     """
     monkey.patch_all()
-    app = create_app()
+    app = get_app()
+    register_blueprints(app)
+    if app.config.get('DELIVERY_MODE', 'chain') != 'daemon':
+        # Load celery now rather than on the first request.
+        from mini_mailgun.api import tasks  # noqa
     logger = create_logger(API_LOGGER)
     logger.info("Starting API SERVER")
     ws = WSGIServer((app.config['APPLICATION_INTERFACE'],
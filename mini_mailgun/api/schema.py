@@ -1,14 +1,18 @@
 """
 JSON Schema module
 """
-from flask import abort
-from jsonschema import validate, FormatChecker
+import json
+
+from flask import Response, abort
+from jsonschema import Draft4Validator, FormatChecker
+from jsonschema.compat import int_types, str_types
+
+from mini_mailgun.constants import MIN_PRIORITY, MAX_PRIORITY
 
 send_email = {'$schema': 'http://json-schema.org/draft-04/schema#',
               'title': 'send_email',
               'type': 'object',
-              'minProperties': 4,
-              'maxProperties': 4,
+              'additionalProperties': False,
               'properties':
                   {'from_addr': {'type': 'string',
                                  'format': 'email',
@@ -18,9 +22,69 @@ send_email = {'$schema': 'http://json-schema.org/draft-04/schema#',
                                'maxLength': 256},
                    'subject': {'type': 'string',
                                'maxLength': 78},
-                   'body': {'type': 'string'}},
+                   'body': {'type': 'string'},
+                   'priority': {'type': 'integer',
+                                'minimum': MIN_PRIORITY,
+                                'maximum': MAX_PRIORITY}},
               'required': ['to_addr', 'from_addr', 'subject', 'body']}
 
+# Checking the schema and building the validator is most of the cost of
+# jsonschema.validate so it's done once at import.
+Draft4Validator.check_schema(send_email)
+send_email_validator = Draft4Validator(send_email,
+                                       format_checker=FormatChecker())
+EMAIL_FIELDS = ('from_addr', 'to_addr')
+MAX_LENGTHS = dict((name, prop['maxLength'])
+                   for name, prop in send_email['properties'].items()
+                   if 'maxLength' in prop)
+
+
+def is_simple_valid(data):
+    """
+    Fast path for the common case of a well formed payload. Does the same
+    checks as the schema without going through jsonschema. False doesn't
+    mean the payload is invalid, only that it needs the full validator.
+    Args:
+        data: JSON payload for a single message.
+    Returns:
+        (bool) True if the payload is definitely valid.
+    """
+    if not isinstance(data, dict) or len(data) not in (4, 5):
+        return False
+    if len(data) == 5:
+        priority = data.get('priority')
+        if not isinstance(priority, int_types) or \
+                isinstance(priority, bool) or \
+                not MIN_PRIORITY <= priority <= MAX_PRIORITY:
+            return False
+    for name in send_email['required']:
+        value = data.get(name)
+        if not isinstance(value, str_types):
+            return False
+        if len(value) > MAX_LENGTHS.get(name, len(value)):
+            return False
+    # jsonschema's email format only checks for an @.
+    return all('@' in data[name] for name in EMAIL_FIELDS)
+
+
+def send_email_errors(data):
+    """
+    Validate a send_email payload without aborting the request.
+    Used by the batch endpoint to report failures per message.
+    Args:
+        data (dict) JSON payload for a single message.
+    Returns:
+        (list) Dicts with the field, the failed schema keyword and a
+            message for every problem. Empty if the payload is valid.
+    """
+    if is_simple_valid(data):
+        return []
+    errors = sorted(send_email_validator.iter_errors(data),
+                    key=lambda e: (list(e.path), e.validator))
+    return [{'field': e.path[0] if e.path else None,
+             'validator': e.validator,
+             'message': e.message} for e in errors]
+
 
 def validate_send_email(data):
     """
@@ -28,9 +92,10 @@ def validate_send_email(data):
     Args:
         data (dict) JSON payload for request.
     Raises:
-        (jsonschema.ValidationError) When payload is not valid.
+        (werkzeug.exceptions.BadRequest) When payload is not valid. The
+            response body lists the errors.
     """
-    try:
-        validate(data, send_email, format_checker=FormatChecker())
-    except:
-        abort(400)
+    errors = send_email_errors(data)
+    if errors:
+        abort(Response(json.dumps({'errors': errors}), 400,
+                       mimetype='application/json'))
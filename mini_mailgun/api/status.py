@@ -0,0 +1,211 @@
+"""
+Write behind status updates for emails.
+"""
+import atexit
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import and_, case
+
+from mini_mailgun.api.db import group_by_shard, shard_engine
+from mini_mailgun.api.models import Email
+from mini_mailgun.constants import CELERY_LOGGER, STATUS_DELETED
+from mini_mailgun.metrics import DB_COMMIT_LATENCY, timed
+
+LOG = logging.getLogger(CELERY_LOGGER)
+FIELDS = ('last_attempt', 'next_attempt_at', 'finished_at', 'status',
+          'status_code')
+# Left alone on emails deleted while an attempt was in flight, so a late
+# response can't bring them back for a retry.
+DELETE_GUARDED = ('next_attempt_at', 'finished_at', 'status')
+
+
+class StatusWriter(object):
+    """
+    Buffers status changes for emails and writes them back in bulk.
+
+    Updates for the same email are merged in the order they are pushed, so
+    only the newest value of each column is written. Every update carries
+    the attempt it belongs to and rows that have moved on to a later
+    attempt are left alone, which keeps updates ordered per email even when
+    they come from different processes. Emails deleted in the meantime
+    keep their status. Each flush is a handful of
+    UPDATE ... SET col = CASE uuid ... statements in one transaction.
+    """
+
+    def __init__(self, app, flush_interval=0.05, max_events=500,
+                 on_flush=None):
+        """
+        Constructor for the status writer.
+        Args:
+            app (flask.Flask): App holding the database config.
+        Kwargs:
+            flush_interval (float): Seconds between background flushes.
+                                    None to only flush when flush is called.
+            max_events (int): Flush early once this many emails are waiting.
+            on_flush (callable): Called with the events written, uuid
+                                 mapped to the merged event, once they
+                                 are committed.
+        """
+        self.app = app
+        self.flush_interval = flush_interval
+        self.max_events = max_events
+        self.on_flush = on_flush
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._running = False
+        self._atexit = False
+
+    def push(self, uuid, attempts, **fields):
+        """
+        Queue a status change.
+        Args:
+            uuid (str): UUID of the email.
+            attempts (int): The attempt the change belongs to.
+        Kwargs:
+            **fields: New values for last_attempt, next_attempt_at,
+                      finished_at, status or status_code.
+        """
+        for field in fields:
+            if field not in FIELDS:
+                raise ValueError('Unknown status field {0}'.format(field))
+        with self._lock:
+            event = self._pending.get(uuid)
+            if event is None or event['attempts'] < attempts:
+                event = self._pending[uuid] = {'attempts': attempts}
+            elif event['attempts'] > attempts:
+                return
+            event.update(fields)
+            pending = len(self._pending)
+        if self.flush_interval is not None:
+            self._ensure_thread()
+            if pending >= self.max_events:
+                self._wakeup.set()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def _ensure_thread(self):
+        """
+        Start the background flusher, again if we've been forked.
+        """
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._running = True
+            self._thread = threading.Thread(target=self._run,
+                                            name='status-writer')
+            self._thread.daemon = True
+            self._thread.start()
+            if not self._atexit:
+                atexit.register(self.close)
+                self._atexit = True
+
+    def _run(self):
+        while self._running:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                LOG.exception('Unable to flush email statuses.')
+
+    def _requeue(self, events):
+        """
+        Put events from a failed flush back without clobbering anything
+        pushed since.
+        """
+        with self._lock:
+            for uuid, event in events.items():
+                newer = self._pending.get(uuid)
+                if newer is None or newer['attempts'] < event['attempts']:
+                    self._pending[uuid] = event
+                elif newer['attempts'] == event['attempts']:
+                    merged = dict(event)
+                    merged.update(newer)
+                    self._pending[uuid] = merged
+
+    def statements(self, events):
+        """
+        Build the bulk updates for a set of events. Events that change the
+        same columns share a statement.
+        Args:
+            events (dict): uuid mapped to the merged event.
+        Returns:
+            (list) sqlalchemy update statements.
+        """
+        table = Email.__table__
+        groups = OrderedDict()
+        for uuid, event in events.items():
+            groups.setdefault(tuple(sorted(event)), []).append(uuid)
+        stmts = []
+        for columns, uuids in groups.items():
+            values = {}
+            for column in columns:
+                if column in DELETE_GUARDED:
+                    whens = [(and_(table.c.uuid == uuid,
+                                   table.c.status != STATUS_DELETED),
+                              events[uuid][column]) for uuid in uuids]
+                else:
+                    whens = [(table.c.uuid == uuid, events[uuid][column])
+                             for uuid in uuids]
+                values[column] = case(whens, else_=table.c[column])
+            stmts.append(table.update().where(
+                table.c.uuid.in_(uuids)).where(
+                    table.c.attempts <= values['attempts']).values(**values))
+        return stmts
+
+    def flush(self):
+        """
+        Write every queued change to the database, one transaction per
+        shard. If a shard fails what was written to the others is kept and
+        the rest is queued again.
+        Returns:
+            (int) The number of emails written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                events, self._pending = self._pending, OrderedDict()
+            if not events:
+                return 0
+            written = OrderedDict()
+            try:
+                for shard, uuids in group_by_shard(
+                        events, app=self.app).items():
+                    batch = OrderedDict(
+                        (uuid, events[uuid]) for uuid in uuids)
+                    with timed(DB_COMMIT_LATENCY), \
+                            shard_engine(shard, self.app).begin() as conn:
+                        for stmt in self.statements(batch):
+                            conn.execute(stmt)
+                    written.update(batch)
+            except Exception:
+                self._requeue(OrderedDict(
+                    (uuid, event) for uuid, event in events.items()
+                    if uuid not in written))
+                raise
+            finally:
+                if written and self.on_flush is not None:
+                    self.on_flush(written)
+            return len(written)
+
+    def close(self):
+        """
+        Stop the background flusher and write anything still queued.
+        """
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(self.flush_interval or 1)
+        self._thread = None
+        self.flush()
@@ -1,16 +1,31 @@
 """
 Celery tasks.
 """
+from datetime import timedelta
+
 from celery import Celery, chain
-import dns.resolver
+from kombu import Queue
+from celery.signals import after_task_publish, before_task_publish
+from celery.signals import worker_init, worker_process_shutdown
 
-from mini_mailgun.api.app import get_db, create_app, create_logger
+from mini_mailgun.api.app import get_app, get_db, get_email_cache
+from mini_mailgun.api.app import create_logger, get_status_feed
+from mini_mailgun.api.db import shard_limit
 from mini_mailgun.api.models import Email
-from mini_mailgun.common import utc_time
-from mini_mailgun.constants import STATUS_SENT, STATUS_FAILED, STATUS_DELETED
+from mini_mailgun.api.retention import purge_finished, rotate_partitions
+from mini_mailgun.api.status import StatusWriter
+from mini_mailgun import metrics
+from mini_mailgun.common import LRUCache, backoff, utc_time
+from mini_mailgun.constants import STATUS_SENDING, STATUS_SENT, STATUS_FAILED
+from mini_mailgun.constants import STATUS_DELETED
+from mini_mailgun.constants import MAX_PRIORITY, QUEUES
+from mini_mailgun.constants import QUEUE_BULK, QUEUE_FIRST, QUEUE_RETRY
 from mini_mailgun.constants import CELERY_LOGGER
-from mini_mailgun.exceptions import EmailDeletedError
-from mini_mailgun.smtp.client import Client
+from mini_mailgun.exceptions import EmailDeletedError, ThrottledError
+from mini_mailgun.logs import per_message
+from mini_mailgun.smtp.mx import MXCache, select_mx_host
+from mini_mailgun.smtp.pool import ConnectionPool
+from mini_mailgun.smtp.throttle import Throttle
 
 
 db = get_db()
@@ -29,7 +44,23 @@ def make_celery(app):
     celery = Celery(app.import_name,
                     backend=app.config['CELERY_RESULT_BACKEND'],
                     broker=app.config['CELERY_BROKER_URL'])
+    # First attempts, retries and bulk mail each get their own queue so a
+    # backlog in one can't hold up the others. A worker consuming several
+    # queues takes from them round robin. Every queue supports per message
+    # priorities, on redis by splitting it into a list per priority level.
+    celery.conf.update(
+        CELERY_QUEUES=[Queue(name, routing_key=name, queue_arguments={
+            'x-max-priority': MAX_PRIORITY + 1}) for name in QUEUES],
+        CELERY_DEFAULT_QUEUE=QUEUE_FIRST,
+        CELERY_ROUTES={
+            'mini_mailgun.api.tasks.enqueue_due_emails': {
+                'queue': QUEUE_RETRY},
+            'mini_mailgun.api.tasks.purge_finished_emails': {
+                'queue': QUEUE_RETRY}})
     celery.conf.update(app.config)
+    transport_options = dict(priority_steps=list(range(MAX_PRIORITY + 1)))
+    transport_options.update(app.config.get('BROKER_TRANSPORT_OPTIONS', {}))
+    celery.conf.BROKER_TRANSPORT_OPTIONS = transport_options
     TaskBase = celery.Task
 
     class ContextTask(TaskBase):
@@ -42,19 +73,221 @@ def make_celery(app):
     return celery
 
 
-app = create_app(register_blueprint=False)
+app = get_app()
 celery_app = make_celery(app)
+smtp_pool = ConnectionPool(
+    max_size=app.config.get('SMTP_POOL_SIZE', 4),
+    max_idle=app.config.get('SMTP_POOL_MAX_IDLE', 30),
+    max_messages=app.config.get('SMTP_POOL_MAX_MESSAGES', 100))
+mx_cache = MXCache(
+    max_size=app.config.get('MX_CACHE_SIZE', 1024),
+    negative_ttl=app.config.get('MX_CACHE_NEGATIVE_TTL', 300),
+    max_ttl=app.config.get('MX_CACHE_MAX_TTL', 3600),
+    redis_url=app.config.get('MX_CACHE_REDIS_URL'))
+message_cache = LRUCache(app.config.get('MESSAGE_CACHE_SIZE', 256))
+throttle = Throttle(
+    rate=app.config.get('THROTTLE_RATE'),
+    burst=app.config.get('THROTTLE_BURST'),
+    max_connections=app.config.get('THROTTLE_MAX_CONNECTIONS'),
+    overrides=app.config.get('THROTTLE_DOMAINS'),
+    lease_ttl=app.config.get('THROTTLE_LEASE_TTL', 300),
+    retry_delay=app.config.get('THROTTLE_RETRY_DELAY', 1),
+    redis_url=app.config.get('THROTTLE_REDIS_URL'))
+email_cache = get_email_cache()
+status_feed = get_status_feed()
+
+
+def statuses_flushed(events):
+    """
+    Let the API know about status changes the status writer committed.
+    Args:
+        events (dict): uuid mapped to the merged event.
+    """
+    email_cache.invalidate(*events)
+    status_feed.publish_many(events)
+
+
+status_writer = StatusWriter(
+    app,
+    flush_interval=app.config.get('STATUS_FLUSH_INTERVAL', 0.05),
+    max_events=app.config.get('STATUS_FLUSH_SIZE', 500),
+    on_flush=statuses_flushed) \
+    if app.config.get('STATUS_WRITE_BEHIND', False) else None
+
+
+before_task_publish.connect(metrics.publish_started)
+after_task_publish.connect(metrics.publish_finished)
+
+
+@worker_init.connect
+def start_metrics_server(**kwargs):
+    """
+    Serve metrics from the main worker process when METRICS_PORT is set.
+    """
+    port = app.config.get('METRICS_PORT')
+    if not port:
+        return
+    if not metrics.multiprocess_dir():
+        LOG.warning('PROMETHEUS_MULTIPROC_DIR is not set, metrics from '
+                    'pool processes will be missing.')
+    metrics.start_server(port, app.config.get('METRICS_INTERFACE', ''))
+
+
+@worker_process_shutdown.connect
+def clean_up_metrics(pid=None, **kwargs):
+    """
+    Fold a pool process's metrics into the totals when it exits.
+    """
+    metrics.process_exited(pid)
+
+
+@worker_process_shutdown.connect
+def close_smtp_pool(**kwargs):
+    """
+    Send QUIT on any pooled SMTP connections when a worker process exits.
+    """
+    smtp_pool.close_all()
+
+
+@worker_process_shutdown.connect
+def close_status_writer(**kwargs):
+    """
+    Write any buffered status updates when a worker process exits.
+    """
+    if status_writer is not None:
+        status_writer.close()
+
+
+def route(email):
+    """
+    Pick the queue and broker priority for an email's next attempt.
+    Retries go on the retry queue, first attempts with a priority of
+    BULK_MAX_PRIORITY or less on the bulk queue and everything else on
+    the first attempt queue.
+    Args:
+        email (mini_mailgun.api.models.Email): The email to deliver.
+    Returns:
+        (dict) queue and priority options for apply_async.
+    """
+    if email.attempts:
+        queue = QUEUE_RETRY
+    elif email.priority <= app.config.get('BULK_MAX_PRIORITY', 2):
+        queue = QUEUE_BULK
+    else:
+        queue = QUEUE_FIRST
+    priority = email.priority
+    scheme = app.config['CELERY_BROKER_URL'].split(':')[0]
+    if scheme in ('redis', 'rediss', 'sentinel'):
+        # The redis transport serves lower numbers first.
+        priority = MAX_PRIORITY - priority
+    return {'queue': queue, 'priority': priority}
+
+
+def schedule_email(email, **options):
+    """
+    Schedule a delivery attempt for an email. With DELIVERY_MODE set to
+    fused the attempt runs as a single deliver_email task, otherwise as a
+    chain of update_attempts, find_smtp_host, send_message and update_status.
+    Every task for the attempt goes on the queue picked by route.
+    With DELIVERY_MODE set to daemon nothing is published, the delivery
+    daemon picks the email up from the database.
+    Args:
+        email (mini_mailgun.api.models.Email): The email to deliver.
+    Kwargs:
+        **options: Passed through to apply_async. ie countdown or producer.
+    """
+    mode = app.config.get('DELIVERY_MODE', 'chain')
+    if mode == 'daemon':
+        return None
+    content_hash = email.content_hash()
+    routing = route(email)
+    if mode == 'fused':
+        return deliver_email.s(email.uuid, email.attempts,
+                               content_hash).set(**routing).apply_async(
+                                   **options)
+    return chain(update_attempts.s(email.uuid, email.attempts).set(**routing),
+                 find_smtp_host.s(email.to_addr).set(**routing),
+                 send_message.s(email.uuid, content_hash).set(**routing),
+                 update_status.s(email.uuid, email.attempts + 1).set(
+                     **routing)).apply_async(**options)
+
+
+def queue_depths():
+    """
+    Get the number of tasks waiting in each queue.
+    Returns:
+        (dict) Queue name mapped to it's depth.
+    """
+    depths = {}
+    with celery_app.connection_or_acquire() as conn:
+        for queue in QUEUES:
+            try:
+                depths[queue] = conn.default_channel.queue_declare(
+                    queue, passive=True).message_count
+            except conn.channel_errors:
+                # Nothing has been published to it yet.
+                depths[queue] = 0
+    return depths
+
+
+metrics.add_collector(metrics.QueueDepthCollector(queue_depths))
+
+
+def retry_wait(attempts):
+    """
+    Get the wait before retrying an email from the RETRY_* config.
+    Args:
+        attempts (int): Attempts made so far.
+    Returns:
+        (float) Seconds to wait.
+    """
+    config = app.config
+    return backoff(attempts, config['RETRY_WAIT'],
+                   multiplier=config.get('RETRY_BACKOFF', 2),
+                   max_wait=config.get('RETRY_MAX_WAIT'),
+                   jitter=config.get('RETRY_JITTER', 0))
+
+
+def render_message(uuid, content_hash):
+    """
+    Get a rendered message for delivery. Renderings are cached per worker
+    process keyed by uuid and content hash so retries and large bodies
+    don't have to travel through the broker.
+    Args:
+        uuid (str): UUID of the email message.
+        content_hash (str): Email.content_hash() when it was scheduled.
+    Returns:
+        (tuple) from_addr, to_addr and the well formed email message.
+    """
+    rendered = message_cache.get((uuid, content_hash))
+    if rendered is None:
+        email = Email.query.filter_by(uuid=uuid).first()
+        if email.content_hash() != content_hash:
+            LOG.info('Email: %s changed since it was scheduled.', uuid,
+                     extra=per_message(uuid))
+        rendered = email.from_addr, email.to_addr, email.to_msg()
+        message_cache.set((uuid, email.content_hash()), rendered)
+    return rendered
 
 
 @celery_app.task(acks_late=True)
 def update_attempts(uuid, attempts):
     """
-    Async task to update attempts in the db.
+    Async task to update attempts in the db. With STATUS_WRITE_BEHIND on
+    the update goes through the status writer.
     Args:
         uuid (str): UUID of the email message.
         attempts (int): number of attempts tried.
+    Returns:
+        (int) The number of this attempt.
     """
-    LOG.info('Attempting to send Email: {0}'.format(uuid))
+    LOG.info('Attempting to send Email: %s', uuid, extra=per_message(uuid))
+    if status_writer is not None:
+        status = db.session.query(Email.status).filter_by(uuid=uuid).scalar()
+        if status == STATUS_DELETED:
+            raise EmailDeletedError('Email {0} deleted'.format(uuid))
+        status_writer.push(uuid, attempts + 1, last_attempt=utc_time())
+        return attempts + 1
     email = Email.query.filter_by(uuid=uuid).first()
     if email.status == STATUS_DELETED:
         raise EmailDeletedError('Email {0} deleted'.format(uuid))
@@ -63,94 +296,280 @@ def update_attempts(uuid, attempts):
         email.last_attempt = utc_time()
     db.session.add(email)
     db.session.commit()
+    email_cache.invalidate(uuid)
     return email.attempts
 
 
 @celery_app.task(acks_late=True)
 def find_smtp_host(attempts, to_addr):
-    LOG.info('Grabbing SMTP host for {0}'.format(to_addr))
+    """
+    Async task to pick the SMTP host for an attempt.
+    Args:
+        attempts (int): number of attempts tried.
+        to_addr (str): The recipient's address.
+    Returns:
+        (str) The MX host, or the domain itself if it has no MX records.
+    """
+    LOG.debug('Grabbing SMTP host for %s', to_addr)
+    domain = to_addr.split('@')[1]
     try:
-        res = dns.resolver.query(to_addr.split('@')[1], 'MX')
-    except:
-        LOG.info(('No MX Records found for {0} trying hostname.').format(
-            to_addr))
-        return to_addr.split('@')[1]
-    mx_records = {}
-    for mx in res:
-        mx_records[mx.preference.real] = mx.exchange.to_text()
-    while(len(mx_records) < attempts):
-        attempts -= len(mx_records)
-    smtp_host = mx_records[sorted(mx_records.keys())[attempts - 1]]
-    LOG.info('Out of {0} MX records selected {1}'.format(
-        len(mx_records), smtp_host))
+        records = mx_cache.lookup(domain)
+    except Exception:
+        records = []
+    stats = mx_cache.stats()
+    if stats['lookups'] and stats['lookups'] % 1000 == 0:
+        LOG.info('MX cache stats: %s', stats)
+    if not records:
+        LOG.info('No MX Records found for %s trying hostname.', to_addr)
+        return domain
+    smtp_host = select_mx_host(records, attempts)
+    LOG.debug('Out of %s MX records selected %s', len(records), smtp_host)
     return smtp_host
 
 
-@celery_app.task(acks_late=True)
-def send_message(smtp_host, from_addr, to_addr, message):
+def throttle_key(smtp_host, to_addr):
     """
-    Async task to send an email message.
+    Get what a send is throttled on, the recipient's domain or with
+    THROTTLE_BY set to mx the MX host.
+    """
+    if app.config.get('THROTTLE_BY', 'domain') == 'mx':
+        return smtp_host
+    return to_addr.split('@')[1]
+
+
+def deferral(task, e):
+    """
+    Requeue a throttled task to run again once the destination has room.
+    The attempt is already counted, running the task again doesn't count
+    it twice. After THROTTLE_MAX_DEFERRALS the send goes ahead as a
+    failed attempt so a domain that never frees up can't hold an email
+    forever. Tasks called directly rather than by a worker can't be
+    requeued and go ahead straight away.
     Args:
-        mx_record (str) The mx record for the to_addr
-        from_addr (str): The sender's address.
-        to_addr (str): The recipient's address.
-        message (str): A well formed email message.
+        task (celery.Task): The bound task that was throttled.
+        e (mini_mailgun.exceptions.ThrottledError): Why.
+    Returns:
+        (celery.exceptions.Retry) To raise. Or None once the email has
+            been deferred too many times.
+    """
+    metrics.THROTTLED.labels(e.reason).inc()
+    if task.request.called_directly or \
+            task.request.retries >= app.config.get('THROTTLE_MAX_DEFERRALS',
+                                                   100):
+        return None
+    return task.retry(countdown=e.wait, throw=False)
+
+
+def deliver(smtp_host, uuid, content_hash):
+    """
+    Send an email message over a pooled connection, within the throttle's
+    limits for it's destination.
+    Args:
+        smtp_host (str) The mx record for the to_addr
+        uuid (str): UUID of the email message.
+        content_hash (str): Email.content_hash() when it was scheduled.
+    Raises:
+        mini_mailgun.exceptions.ThrottledError if the send has to wait.
+    Returns:
+        (tuple) The SMTP status code and message. -1 if we couldn't
+            connect.
+    """
+    from_addr, to_addr, message = render_message(uuid, content_hash)
+    key = throttle_key(smtp_host, to_addr)
+    lease = throttle.acquire(key)
+    try:
+        try:
+            client = smtp_pool.acquire(smtp_host,
+                                       app.config['SMTP_PORT'],
+                                       use_tls=app.config['USE_TLS'])
+            try:
+                resp = client.send_message(from_addr, to_addr, message)
+            except Exception:
+                smtp_pool.release(client, reusable=False)
+                raise
+        except Exception:
+            return -1, 'Unable to connect to host {0}'.format(smtp_host)
+    finally:
+        throttle.release(key, lease)
+    # A 421 means the server is closing the session.
+    smtp_pool.release(client, reusable=resp[0] != 421)
+    return resp
+
+
+@celery_app.task(bind=True, acks_late=True, max_retries=None)
+def send_message(self, smtp_host, uuid, content_hash):
+    """
+    Async task to send an email message. Throttled sends are requeued
+    with a short delay rather than counted as a failed attempt.
+    Args:
+        smtp_host (str) The mx record for the to_addr
+        uuid (str): UUID of the email message.
+        content_hash (str): Email.content_hash() when it was scheduled.
+    """
+    try:
+        return deliver(smtp_host, uuid, content_hash)
+    except ThrottledError as e:
+        retry = deferral(self, e)
+        if retry is not None:
+            raise retry
+        return -2, str(e)
+
+
+@celery_app.task(bind=True, acks_late=True, max_retries=None)
+def deliver_email(self, uuid, attempts, content_hash):
     """
+    Async task to run a whole delivery attempt in process. Does the same
+    work as the update_attempts, find_smtp_host, send_message and
+    update_status chain without the broker round trips between them.
+    Args:
+        uuid (str): UUID of the email message.
+        attempts (int): number of attempts tried.
+        content_hash (str): Email.content_hash() when it was scheduled.
+    """
+    this_attempt = update_attempts.run(uuid, attempts)
+    to_addr = render_message(uuid, content_hash)[1]
+    smtp_host = find_smtp_host.run(this_attempt, to_addr)
     try:
-        smtp_client = Client(smtp_host,
-                             app.config['SMTP_PORT'],
-                             use_tls=app.config['USE_TLS'])
-        return smtp_client.send_message(from_addr, to_addr, message)
-    except:
-        return -1, 'Unable to connect to host {0}'.format(smtp_host)
+        resp = deliver(smtp_host, uuid, content_hash)
+    except ThrottledError as e:
+        retry = deferral(self, e)
+        if retry is not None:
+            raise retry
+        resp = -2, str(e)
+    update_status.run(resp, uuid, this_attempt)
 
 
 @celery_app.task(acks_late=True)
 def clean_db_record(uuid):
     """
-    Delete a db record.
+    Delete a db record. No longer scheduled, purge_finished_emails cleans up
+    in bulk, but kept for tasks still sitting in the broker.
     Args:
         uuid (str): uuid of the db record.
     """
-    LOG.info('Attempting to delete record {0}'.format(uuid))
+    LOG.info('Attempting to delete record %s', uuid)
     db.session.query(Email).filter(
         Email.uuid == uuid).delete(synchronize_session=False)
     db.session.commit()
-    LOG.info('DB record {0} deleted.'.format(uuid))
+    email_cache.invalidate(uuid)
+    LOG.info('DB record %s deleted.', uuid)
 
 
 @celery_app.task(acks_late=True)
-def update_status(resp, uuid):
+def update_status(resp, uuid, attempts=None):
     """
-    Async task to update message status.
+    Async task to update message status. With STATUS_WRITE_BEHIND on and
+    the attempt known the update goes through the status writer instead
+    of loading the email.
     Args:
         resp (tuple): A tuple containing resp code and message.
         uuid (string): The uuid of the email message.
+    Kwargs:
+        attempts (int): The number of this attempt.
     """
-    email = Email.query.filter_by(uuid=uuid).first()
-    email.status_code = resp[0]
-    LOG.info(('Email: {0} Status: {1} '
-              'Response Message: {2}.').format(email.uuid,
-                                               resp[0],
-                                               resp[1]))
-    if resp[0] not in range(250, 253):
-        if email.attempts >= app.config['MAX_RETRIES']:
-            LOG.info('Email: {0} has failed to send.'.format(uuid))
-            email.status = STATUS_FAILED
+    LOG.info('Email: %s Status: %s Response Message: %s.',
+             uuid, resp[0], resp[1], extra=per_message(uuid))
+    metrics.count_response(resp[0])
+    if status_writer is None or attempts is None:
+        email = Email.query.filter_by(uuid=uuid).first()
+        if email.record_response(resp[0], app.config['MAX_RETRIES']):
+            email.schedule_retry(retry_wait(email.attempts))
+        db.session.add(email)
+        db.session.commit()
+        email_cache.invalidate(uuid)
+        status_feed.publish(uuid, email.status, status_code=email.status_code,
+                            attempts=email.attempts)
+        status, next_attempt_at = email.status, email.next_attempt_at
     else:
-        LOG.info('Email: {0} has been sent.'.format(uuid))
-        email.status = STATUS_SENT
-    db.session.add(email)
+        status = Email.response_status(resp[0], attempts,
+                                       app.config['MAX_RETRIES'])
+        next_attempt_at = None
+        finished_at = None
+        if status == STATUS_SENDING:
+            next_attempt_at = utc_time() + timedelta(
+                seconds=retry_wait(attempts))
+        else:
+            finished_at = utc_time()
+        status_writer.push(uuid, attempts, status=status,
+                           status_code=resp[0],
+                           next_attempt_at=next_attempt_at,
+                           finished_at=finished_at)
+    if status == STATUS_FAILED:
+        LOG.info('Email: %s has failed to send.', uuid,
+                 extra=per_message(uuid))
+    elif status == STATUS_SENT:
+        LOG.info('Email: %s has been sent.', uuid, extra=per_message(uuid))
+    if status == STATUS_SENDING:
+        LOG.info('Rescheduling Email: %s for %s', uuid,
+                 str(next_attempt_at), extra=per_message(uuid))
+
+
+@celery_app.task
+def enqueue_due_emails(limit=None):
+    """
+    Periodic task that hands emails whose next_attempt_at has passed back
+    to the workers. Rows are claimed with SELECT ... FOR UPDATE SKIP LOCKED
+    so several pollers can run at once without picking the same emails.
+    Emails are published before the claim commits, so delivery is at
+    least once. If the commit fails, or the worker dies before it, the
+    emails are published again on the next poll. Committing first would
+    lose them instead, the claim clears next_attempt_at and nothing would
+    pick them up again.
+    Kwargs:
+        limit (int): Max emails to enqueue, split evenly across shards.
+                     Defaults to RETRY_POLL_BATCH_SIZE.
+    Returns:
+        (int) The number of emails enqueued.
+    """
+    if app.config.get('DELIVERY_MODE', 'chain') == 'daemon':
+        return 0
+    limit = limit or app.config.get('RETRY_POLL_BATCH_SIZE', 500)
+    emails = Email.query.filter(
+        Email.status == STATUS_SENDING,
+        Email.next_attempt_at <= utc_time()).order_by(
+            Email.next_attempt_at).limit(
+                shard_limit(limit, app)).with_for_update(
+                    skip_locked=True).all()
+    if emails:
+        with celery_app.producer_or_acquire() as producer:
+            for email in emails:
+                email.next_attempt_at = None
+                schedule_email(email, producer=producer)
+        LOG.info('Enqueued %s emails due for a retry.', len(emails))
+    uuids = [email.uuid for email in emails]
     db.session.commit()
-    if (email.attempts < app.config['MAX_RETRIES']
-            and email.status != STATUS_SENT):
-        LOG.info('Rescheduling Email: {0}'.format(uuid))
-        chain(update_attempts.s(email.uuid, email.attempts),
-              find_smtp_host.s(email.to_addr),
-              send_message.s(email.from_addr, email.to_addr,
-                             email.to_msg()),
-              update_status.s(email.uuid)).apply_async(
-                  countdown=app.config['RETRY_WAIT'])
-    else:
-        clean_db_record.s(uuid).apply_async(
-            countdown=app.config['DELETE_WAIT'])
+    email_cache.invalidate(*uuids)
+    return len(uuids)
+
+
+@celery_app.task
+def purge_finished_emails():
+    """
+    Periodic task that deletes emails DELETE_WAIT seconds after they were
+    sent, failed or deleted. Monthly partitions older than
+    PURGE_DROP_PARTITIONS_AFTER days are dropped whole when the table is
+    partitioned.
+    Returns:
+        (int) The number of rows purged.
+    """
+    config = app.config
+    purged = purge_finished(app, config['DELETE_WAIT'],
+                            chunk_size=config.get('PURGE_CHUNK_SIZE', 1000),
+                            max_chunks=config.get('PURGE_MAX_CHUNKS', 100),
+                            pause=config.get('PURGE_CHUNK_PAUSE', 0.1),
+                            on_delete=email_cache.invalidate)
+    LOG.info('Purged %s finished emails.', purged)
+    if config.get('PURGE_DROP_PARTITIONS_AFTER'):
+        dropped = rotate_partitions(app, utc_time() - timedelta(
+            days=config['PURGE_DROP_PARTITIONS_AFTER']))
+        if dropped:
+            LOG.info('Dropped partitions %s.', ', '.join(dropped))
+    return purged
+
+
+celery_app.add_periodic_task(app.config.get('RETRY_POLL_INTERVAL', 10),
+                             enqueue_due_emails.s(),
+                             name='enqueue-due-emails')
+celery_app.add_periodic_task(app.config.get('PURGE_INTERVAL', 60),
+                             purge_finished_emails.s(),
+                             name='purge-finished-emails')
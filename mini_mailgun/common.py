@@ -2,17 +2,59 @@
 Common module has common utils
 used in the application
 """
+import os
+import random
+import struct
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
-from uuid import uuid4
+from uuid import UUID
 
 
 def uuid():
     """
-    Generate a UUID4 string
+    Generate a time ordered UUID string, laid out like a UUIDv7. The first
+    48 bits are the unix time in milliseconds and the rest is random, so
+    new ids sort after older ones and inserts land at the end of the
+    primary key instead of all over it. The 8th byte is the shard key, see
+    shard_key.
     Returns:
-        (str) A UUID4 string
+        (str) A UUID string
     """
-    return str(uuid4())
+    rand = bytearray(os.urandom(10))
+    rand[0] = 0x70 | rand[0] & 0x0f
+    rand[2] = 0x80 | rand[2] & 0x3f
+    millis = struct.pack('>Q', int(time.time() * 1000))[2:]
+    return str(UUID(bytes=millis + bytes(rand)))
+
+
+def normalize_uuid(value):
+    """
+    Get the canonical text form of a UUID.
+    Args:
+        value (str): A UUID in any form uuid.UUID accepts.
+    Raises:
+        ValueError if value isn't a UUID.
+    Returns:
+        (str) The lower case, hyphenated UUID.
+    """
+    return str(UUID(value))
+
+
+def shard_key(value):
+    """
+    Get the shard key of a UUID, it's 8th byte. It's random so emails
+    spread evenly over however many shards there are, and because it comes
+    after the timestamp ids still sort by time.
+    Args:
+        value (str): A UUID.
+    Raises:
+        ValueError if value isn't a UUID.
+    Returns:
+        (int) 0 to 255.
+    """
+    return int(UUID(value).hex[14:16], 16)
 
 
 def utc_time():
@@ -22,3 +64,115 @@ def utc_time():
         (datetime.datetime) A UTC datetime object.
     """
     return datetime.utcnow()
+
+
+def parse_time(value):
+    """
+    Parse a timestamp as returned by the api. Accepts ISO 8601 or the
+    str() of a datetime, with or without microseconds.
+    Args:
+        value (str): The timestamp.
+    Raises:
+        ValueError if the timestamp can't be parsed.
+    Returns:
+        (datetime.datetime)
+    """
+    value = value.replace(' ', 'T')
+    if '.' in value:
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+
+
+def backoff(attempts, base, multiplier=2, max_wait=None, jitter=0):
+    """
+    Get the wait before the next attempt using exponential backoff.
+    Args:
+        attempts (int): Attempts made so far, starting at 1.
+        base (float): Seconds to wait after the first attempt.
+    Kwargs:
+        multiplier (float): Growth of the wait per attempt.
+        max_wait (float): Cap on the wait before jitter. None for no cap.
+        jitter (float): Fraction of the wait to randomly add or remove so
+                        emails that failed together don't retry together.
+    Returns:
+        (float) Seconds to wait.
+    """
+    wait = base * multiplier ** max(attempts - 1, 0)
+    if max_wait is not None:
+        wait = min(wait, max_wait)
+    if jitter:
+        wait += wait * random.uniform(-jitter, jitter)
+    return max(wait, 0)
+
+
+class LRUCache(object):
+    """
+    A small thread safe LRU cache with optional per entry expiry.
+    """
+
+    def __init__(self, max_size):
+        """
+        Args:
+            max_size (int): Max number of entries before the least recently
+                            used entry is evicted.
+        """
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Get an entry and mark it as recently used.
+        Args:
+            key: The cache key.
+        Kwargs:
+            default: Returned when the key is missing or expired.
+        Returns:
+            The cached value or default.
+        """
+        now = time.time()
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires <= now:
+                return default
+            self._data[key] = (value, expires)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Add or replace an entry.
+        Args:
+            key: The cache key.
+            value: The value to cache.
+        Kwargs:
+            ttl (float): Seconds until the entry expires. None to never expire.
+        """
+        expires = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """
+        Remove an entry if it exists.
+        Args:
+            key: The cache key.
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """
+        Remove every entry.
+        """
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
@@ -2,5 +2,15 @@ STATUS_SENT = 'SENT'
 STATUS_SENDING = 'SENDING'
 STATUS_FAILED = 'FAILED'
 STATUS_DELETED = 'DELETED'
+FINISHED_STATUSES = (STATUS_SENT, STATUS_FAILED, STATUS_DELETED)
+MIN_PRIORITY = 0
+MAX_PRIORITY = 9
+DEFAULT_PRIORITY = 5
+QUEUE_FIRST = 'mini_mailgun.first'
+QUEUE_RETRY = 'mini_mailgun.retry'
+QUEUE_BULK = 'mini_mailgun.bulk'
+QUEUES = (QUEUE_FIRST, QUEUE_RETRY, QUEUE_BULK)
 CELERY_LOGGER = 'celery.logger'
 API_LOGGER = 'api.logger'
+DELIVERY_LOGGER = 'delivery.logger'
+RELAY_LOGGER = 'relay.logger'
@@ -0,0 +1,384 @@
+"""
+High concurrency delivery engine built on gevent.
+
+The engine claims due emails from the database in batches and runs every
+SMTP transaction in it's own greenlet, so one process can keep thousands
+of deliveries in flight. Database work stays on the polling greenlet and
+status updates are written back in batches.
+"""
+import logging
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+import gevent
+from gevent.lock import BoundedSemaphore
+from gevent.pool import Pool
+from sqlalchemy import and_, or_
+
+from mini_mailgun.api.cache import EmailCache
+from mini_mailgun.api.db import db, shard_limit
+from mini_mailgun.api.events import StatusFeed
+from mini_mailgun.api.models import Email
+from mini_mailgun.api.retention import purge_finished
+from mini_mailgun.api.status import StatusWriter
+from mini_mailgun.common import backoff, utc_time
+from mini_mailgun.constants import STATUS_SENDING, STATUS_FAILED
+from mini_mailgun.constants import DELIVERY_LOGGER
+from mini_mailgun.logs import per_message
+from mini_mailgun.metrics import count_response
+from mini_mailgun.smtp.mx import MXCache, select_mx_host
+from mini_mailgun.smtp.pool import ConnectionPool
+
+LOG = logging.getLogger(DELIVERY_LOGGER)
+UNDISCLOSED = 'undisclosed-recipients:;'
+
+
+class DeliveryJob(object):
+    """
+    Everything a greenlet needs to deliver one SMTP transaction without
+    touching the database. A job covers one email, or several identical
+    emails to the same domain when recipient grouping is on.
+    """
+
+    def __init__(self, emails):
+        """
+        Args:
+            emails (list): Claimed mini_mailgun.api.models.Email objects
+                           with the same sender, subject, body and domain.
+        """
+        first = emails[0]
+        self.uuids = dict((email.to_addr, email.uuid) for email in emails)
+        self.from_addr = first.from_addr
+        self.to_addrs = [email.to_addr for email in emails]
+        self.attempts = first.attempts
+        self.message = first.to_msg(
+            to_header=UNDISCLOSED if len(emails) > 1 else None)
+        self.resps = {}
+
+    def set_resp(self, resp):
+        """
+        Use the same response for every recipient.
+        """
+        self.resps = dict((to_addr, resp) for to_addr in self.to_addrs)
+
+
+class DeliveryEngine(object):
+    """
+    Pulls due emails from the database and delivers them concurrently.
+    """
+
+    def __init__(self, app, concurrency=1000, host_concurrency=20,
+                 batch_size=500, poll_interval=1, mx_cache=None,
+                 smtp_pool=None, group_recipients=False, max_recipients=50,
+                 purge_interval=None, email_cache=None, status_feed=None):
+        """
+        Constructor for the delivery engine.
+        Args:
+            app (flask.Flask): App holding the database config.
+        Kwargs:
+            concurrency (int): Max SMTP transactions in flight.
+            host_concurrency (int): Max SMTP transactions in flight
+                                    per MX host.
+            batch_size (int): Max emails claimed per database round trip.
+            poll_interval (float): Seconds to wait when nothing is due.
+            mx_cache (mini_mailgun.smtp.mx.MXCache): Cache for MX lookups.
+            smtp_pool (mini_mailgun.smtp.pool.ConnectionPool): SMTP sessions.
+            group_recipients (bool): Send emails with the same sender,
+                                     subject and body to the same domain
+                                     in one transaction.
+            max_recipients (int): Max recipients per grouped transaction.
+            purge_interval (float): Seconds between purges of finished
+                                    emails. None to leave them alone.
+            email_cache (mini_mailgun.api.cache.EmailCache): The API's cache
+                                                            to invalidate.
+            status_feed (mini_mailgun.api.events.StatusFeed): Where status
+                                                             changes go.
+        """
+        self.app = app
+        self.concurrency = concurrency
+        self.host_concurrency = host_concurrency
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.group_recipients = group_recipients
+        self.max_recipients = max_recipients
+        self.purge_interval = purge_interval
+        self.mx_cache = mx_cache or MXCache()
+        self.smtp_pool = smtp_pool or ConnectionPool()
+        self.email_cache = email_cache or EmailCache(ttl=0)
+        self.status_feed = status_feed or StatusFeed()
+        self.pool = Pool(concurrency)
+        self.status_writer = StatusWriter(
+            app, flush_interval=None, on_flush=self.statuses_flushed)
+        # smtp_host -> [semaphore, greenlets holding or waiting on it]
+        self._host_locks = {}
+        self._finished = []
+        self._running = False
+
+    def claim(self, limit):
+        """
+        Claim emails that are due for an attempt, either new emails or
+        ones whose next_attempt_at has passed. Claiming counts the attempt
+        and pushes next_attempt_at out by RETRY_WAIT, so emails claimed by
+        a daemon that dies are picked up again. Emails whose lease ran out
+        on their last attempt are marked FAILED instead. Rows are locked
+        with SKIP LOCKED so several daemons can share a database.
+        Args:
+            limit (int): Max emails to claim, split evenly across shards.
+        Returns:
+            (list) DeliveryJob objects.
+        """
+        config = self.app.config
+        now = utc_time()
+        lease = now + timedelta(seconds=config['RETRY_WAIT'])
+        with self.app.app_context():
+            expired = Email.query.filter(
+                Email.status == STATUS_SENDING,
+                Email.attempts >= config['MAX_RETRIES'],
+                Email.next_attempt_at <= now).limit(
+                    shard_limit(limit, self.app)).with_for_update(
+                        skip_locked=True).all()
+            for email in expired:
+                email.status = STATUS_FAILED
+                email.next_attempt_at = None
+                email.finished_at = now
+            failed = [(email.uuid, email.status_code, email.attempts)
+                      for email in expired]
+            emails = Email.query.filter(
+                Email.status == STATUS_SENDING,
+                Email.attempts < config['MAX_RETRIES'],
+                or_(and_(Email.last_attempt.is_(None),
+                         Email.next_attempt_at.is_(None)),
+                    Email.next_attempt_at <= now)).order_by(
+                        Email.created_at).limit(
+                            shard_limit(limit, self.app)).with_for_update(
+                                skip_locked=True).all()
+            for email in emails:
+                email.attempts += 1
+                email.last_attempt = now
+                email.next_attempt_at = lease
+            jobs = [DeliveryJob(group) for group in self.group(emails)]
+            uuids = [email.uuid for email in emails]
+            db.session.commit()
+        self.email_cache.invalidate(*(uuids + [f[0] for f in failed]))
+        for uuid, status_code, attempts in failed:
+            LOG.info('Email: %s lease expired on it\'s last attempt.', uuid,
+                     extra=per_message(uuid))
+            self.status_feed.publish(uuid, STATUS_FAILED,
+                                     status_code=status_code,
+                                     attempts=attempts)
+        return jobs
+
+    def group(self, emails):
+        """
+        Split claimed emails into transactions.
+        Args:
+            emails (list): Claimed emails.
+        Returns:
+            (list) Lists of emails to send in one transaction each.
+        """
+        if not self.group_recipients:
+            return [[email] for email in emails]
+        groups = []
+        open_groups = {}
+        for email in emails:
+            key = (email.from_addr, email.subject, email.body, email.attempts,
+                   email.to_addr.split('@')[1].lower())
+            group = open_groups.get(key)
+            if (group is None or len(group) >= self.max_recipients or
+                    email.to_addr in [e.to_addr for e in group]):
+                group = open_groups[key] = []
+                groups.append(group)
+            group.append(email)
+        return groups
+
+    def find_smtp_host(self, job):
+        """
+        Pick the MX host for a job, falling back on the domain itself.
+        """
+        domain = job.to_addrs[0].split('@')[1]
+        try:
+            records = self.mx_cache.lookup(domain)
+        except Exception:
+            records = []
+        if not records:
+            return domain
+        return select_mx_host(records, job.attempts)
+
+    @contextmanager
+    def host_lock(self, smtp_host):
+        """
+        Context manager limiting concurrent transactions to one host to
+        host_concurrency. A host's semaphore is dropped once nothing holds
+        or waits on it, so hosts seen once don't stay around forever.
+        Args:
+            smtp_host (str): The MX host.
+        """
+        entry = self._host_locks.get(smtp_host)
+        if entry is None:
+            entry = self._host_locks[smtp_host] = [
+                BoundedSemaphore(self.host_concurrency), 0]
+        entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._host_locks[smtp_host]
+
+    def deliver(self, job):
+        """
+        Run one SMTP transaction. Runs in it's own greenlet.
+        Args:
+            job (DeliveryJob): The emails to deliver.
+        """
+        try:
+            smtp_host = self.find_smtp_host(job)
+            with self.host_lock(smtp_host):
+                self.send(smtp_host, job)
+        except Exception:
+            LOG.exception('Delivery of %s crashed.', job.to_addrs)
+            job.set_resp((-1, 'Delivery crashed'))
+        self._finished.append(job)
+
+    def send(self, smtp_host, job):
+        """
+        Send a job over a pooled connection, filling in job.resps.
+        Args:
+            smtp_host (str): The MX host.
+            job (DeliveryJob): The emails to deliver.
+        """
+        try:
+            client = self.smtp_pool.acquire(
+                smtp_host, self.app.config['SMTP_PORT'],
+                use_tls=self.app.config['USE_TLS'])
+        except Exception:
+            job.set_resp((-1, 'Unable to connect to host {0}'.format(
+                smtp_host)))
+            return
+        try:
+            job.resps = client.send_message_multi(
+                job.from_addr, job.to_addrs, job.message)
+        except Exception:
+            self.smtp_pool.release(client, reusable=False)
+            job.set_resp((-1, 'Unable to connect to host {0}'.format(
+                smtp_host)))
+            return
+        closing = any(resp[0] == 421 for resp in job.resps.values())
+        self.smtp_pool.release(client, reusable=not closing)
+
+    def flush(self):
+        """
+        Write the results of finished deliveries back to the database in
+        bulk.
+        Returns:
+            (int) The number of results written.
+        """
+        finished, self._finished = self._finished, []
+        config = self.app.config
+        for job in finished:
+            for to_addr, uuid in job.uuids.items():
+                resp = job.resps[to_addr]
+                LOG.info('Email: %s Status: %s Response Message: %s.',
+                         uuid, resp[0], resp[1], extra=per_message(uuid))
+                count_response(resp[0])
+                status = Email.response_status(resp[0], job.attempts,
+                                               config['MAX_RETRIES'])
+                next_attempt_at = finished_at = None
+                if status == STATUS_SENDING:
+                    next_attempt_at = utc_time() + timedelta(seconds=backoff(
+                        job.attempts, config['RETRY_WAIT'],
+                        multiplier=config.get('RETRY_BACKOFF', 2),
+                        max_wait=config.get('RETRY_MAX_WAIT'),
+                        jitter=config.get('RETRY_JITTER', 0)))
+                else:
+                    finished_at = utc_time()
+                self.status_writer.push(uuid, job.attempts, status=status,
+                                        status_code=resp[0],
+                                        next_attempt_at=next_attempt_at,
+                                        finished_at=finished_at)
+        return self.status_writer.flush()
+
+    def statuses_flushed(self, events):
+        """
+        Let the API know about status changes the status writer committed.
+        Args:
+            events (dict): uuid mapped to the merged event.
+        """
+        self.email_cache.invalidate(*events)
+        self.status_feed.publish_many(events)
+
+    def purge(self):
+        """
+        Delete emails that finished more than DELETE_WAIT seconds ago.
+        Returns:
+            (int) The number of rows purged.
+        """
+        config = self.app.config
+        purged = purge_finished(
+            self.app, config['DELETE_WAIT'],
+            chunk_size=config.get('PURGE_CHUNK_SIZE', 1000),
+            max_chunks=config.get('PURGE_MAX_CHUNKS', 100),
+            pause=config.get('PURGE_CHUNK_PAUSE', 0.1),
+            on_delete=self.email_cache.invalidate)
+        LOG.info('Purged %s finished emails.', purged)
+        return purged
+
+    def run_once(self):
+        """
+        Claim one batch, deliver all of it and record the results.
+        Returns:
+            (int) The number of emails delivered or attempted.
+        """
+        jobs = self.claim(self.batch_size)
+        for job in jobs:
+            self.pool.spawn(self.deliver, job)
+        self.pool.join()
+        return self.flush()
+
+    def run_forever(self):
+        """
+        Keep the pool full until stop is called.
+        """
+        self._running = True
+        LOG.info('Delivery engine started with %s greenlets.',
+                 self.concurrency)
+        next_purge = time.time()
+        while self._running:
+            if self.purge_interval and time.time() >= next_purge:
+                next_purge = time.time() + self.purge_interval
+                try:
+                    self.purge()
+                except Exception:
+                    LOG.exception('Unable to purge finished emails.')
+            free = min(self.pool.free_count(), self.batch_size)
+            jobs = []
+            if free:
+                try:
+                    jobs = self.claim(free)
+                except Exception:
+                    LOG.exception('Unable to claim due emails.')
+            for job in jobs:
+                self.pool.spawn(self.deliver, job)
+            try:
+                self.flush()
+            except Exception:
+                # The status writer keeps what it couldn't write for the
+                # next flush.
+                LOG.exception('Unable to record delivery results.')
+            if jobs:
+                gevent.sleep(0)
+            else:
+                gevent.sleep(self.poll_interval if free else 0.05)
+        self.pool.join()
+        self.flush()
+        self.smtp_pool.close_all()
+        LOG.info('Delivery engine stopped.')
+
+    def stop(self):
+        """
+        Stop claiming new emails. In flight deliveries are finished and
+        recorded before run_forever returns.
+        """
+        self._running = False
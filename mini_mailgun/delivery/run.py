@@ -0,0 +1,53 @@
+"""
+Run the delivery daemon!
+"""
+import signal
+
+import gevent
+from gevent import monkey
+
+from mini_mailgun.api.app import get_app, get_email_cache, get_status_feed
+from mini_mailgun.api.app import create_logger
+from mini_mailgun.constants import DELIVERY_LOGGER
+
+
+def run_daemon():
+    """
+    Entry point to start the delivery daemon. Set DELIVERY_MODE = 'daemon'
+    so the API stops publishing emails to celery.
+    """
+    monkey.patch_all()
+    from mini_mailgun.delivery.engine import DeliveryEngine
+    from mini_mailgun.smtp.mx import MXCache
+    from mini_mailgun.smtp.pool import ConnectionPool
+    app = get_app()
+    config = app.config
+    logger = create_logger(DELIVERY_LOGGER)
+    logger.info("Starting DELIVERY DAEMON")
+    if config.get('METRICS_PORT'):
+        from mini_mailgun.metrics import start_server
+        start_server(config['METRICS_PORT'],
+                     config.get('METRICS_INTERFACE', ''))
+    engine = DeliveryEngine(
+        app,
+        concurrency=config.get('DELIVERY_CONCURRENCY', 1000),
+        host_concurrency=config.get('DELIVERY_HOST_CONCURRENCY', 20),
+        batch_size=config.get('DELIVERY_BATCH_SIZE', 500),
+        poll_interval=config.get('DELIVERY_POLL_INTERVAL', 1),
+        group_recipients=config.get('DELIVERY_GROUP_RECIPIENTS', False),
+        max_recipients=config.get('DELIVERY_MAX_RECIPIENTS', 50),
+        purge_interval=config.get('PURGE_INTERVAL', 60),
+        email_cache=get_email_cache(),
+        status_feed=get_status_feed(),
+        mx_cache=MXCache(
+            max_size=config.get('MX_CACHE_SIZE', 1024),
+            negative_ttl=config.get('MX_CACHE_NEGATIVE_TTL', 300),
+            max_ttl=config.get('MX_CACHE_MAX_TTL', 3600),
+            redis_url=config.get('MX_CACHE_REDIS_URL')),
+        smtp_pool=ConnectionPool(
+            max_size=config.get('SMTP_POOL_SIZE', 4),
+            max_idle=config.get('SMTP_POOL_MAX_IDLE', 30),
+            max_messages=config.get('SMTP_POOL_MAX_MESSAGES', 100)))
+    gevent.signal_handler(signal.SIGTERM, engine.stop)
+    gevent.signal_handler(signal.SIGINT, engine.stop)
+    engine.run_forever()
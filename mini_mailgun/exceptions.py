@@ -44,3 +44,24 @@ class SMTPClientError(MiniMailgunError):
     Raises when we the SMTP client a connection or similar error.
     """
     pass
+
+
+class ThrottledError(MiniMailgunError):
+    """
+    Raised when a send has to wait for it's destination's rate or
+    connection limit.
+    """
+
+    def __init__(self, key, reason, wait):
+        """
+        Args:
+            key (str): The throttled destination.
+            reason (str): rate or connections.
+            wait (float): Seconds to wait before trying again.
+        """
+        MiniMailgunError.__init__(
+            self, '{0} throttled on {1}, retry in {2:.2f}s'.format(
+                key, reason, wait))
+        self.key = key
+        self.reason = reason
+        self.wait = wait
@@ -0,0 +1,297 @@
+"""
+Non blocking logging.
+
+Loggers made by create_logger only put records on an in memory queue. A
+listener running on a real OS thread, even under gevent, formats them and
+does the file and console writes, so a slow disk never stalls a request,
+a task or the delivery daemon's event loop.
+"""
+import atexit
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import zlib
+from collections import deque
+from datetime import datetime
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+SAFE_ARG_TYPES = (bool, int, float, type(None), type(b''), type(u''))
+if sys.version_info[0] < 3:
+    SAFE_ARG_TYPES += (long,)  # noqa
+
+
+def _original(module, name):
+    """
+    Get a function as it was before gevent monkey patched it.
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        return getattr(__import__(module), name)
+    return monkey.get_original(module, name)
+
+
+def per_message(uuid):
+    """
+    Get the extra dict for a log line about a single email. Lets the JSON
+    formatter include the uuid and the sampling filter keep or drop every
+    line for an email together.
+    Args:
+        uuid (str): UUID of the email.
+    Returns:
+        (dict) Pass as extra to a logging call.
+    """
+    return {'email_uuid': uuid}
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats a record as one JSON object per line.
+    """
+
+    def format(self, record):
+        data = {'time': datetime.utcfromtimestamp(
+                    record.created).isoformat() + 'Z',
+                'logger': record.name,
+                'level': record.levelname,
+                'message': record.getMessage(),
+                'process': record.process}
+        if getattr(record, 'email_uuid', None):
+            data['uuid'] = record.email_uuid
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps a fraction of the INFO and DEBUG lines about individual emails.
+    Whether an email is kept depends only on it's uuid so you either get
+    every line for an email or none of them. Warnings, errors and lines
+    that aren't about one email always go through.
+    """
+
+    def __init__(self, rate):
+        """
+        Args:
+            rate (float): Fraction of emails to keep lines for. 0 to 1.
+        """
+        logging.Filter.__init__(self)
+        self.threshold = int(rate * 10000)
+
+    def filter(self, record):
+        uuid = getattr(record, 'email_uuid', None)
+        if uuid is None or record.levelno > logging.INFO:
+            return True
+        return zlib.crc32(uuid.encode('utf-8')) % 10000 < self.threshold
+
+
+class QueueHandler(logging.Handler):
+    """
+    Puts records on a QueueListener instead of writing them. Never blocks,
+    when the queue is full new records are dropped and counted.
+    """
+
+    def __init__(self, listener):
+        """
+        Args:
+            listener (QueueListener): Where records are sent.
+        """
+        logging.Handler.__init__(self)
+        self.listener = listener
+
+    def prepare(self, record):
+        """
+        Make a record safe to format on another thread. Messages with
+        simple arguments are left for the listener to format, anything
+        else is formatted now while the arguments still hold the values
+        they were logged with.
+        """
+        args = record.args
+        if not isinstance(args, tuple):
+            # A single dict argument is kept as the dict itself.
+            args = (args,)
+        if record.args and not all(isinstance(arg, SAFE_ARG_TYPES)
+                                   for arg in args):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.listener.put(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """
+    Drains queued records on a real OS thread and hands them to the
+    handlers that do the writing. Started on first use, again after a
+    fork, and drained at interpreter exit.
+    """
+
+    def __init__(self, handlers, max_size=10000, interval=0.05):
+        """
+        Args:
+            handlers (list): logging.Handler objects that do the writing.
+                             Only the listener thread ever calls them.
+        Kwargs:
+            max_size (int): Max records waiting before new ones are dropped.
+            interval (float): Seconds to sleep when the queue is empty.
+        """
+        self.handlers = handlers
+        for handler in handlers:
+            # Locks made after gevent patching are greenlet locks which
+            # can't be used from a real thread. Nothing else calls these.
+            handler.lock = None
+        self.max_size = max_size
+        self.interval = interval
+        self.dropped = 0
+        self._queue = deque()
+        self._pid = None
+        self._running = False
+        self._stopped = True
+        self._atexit = False
+        self._start_lock = threading.Lock()
+
+    def put(self, record):
+        """
+        Queue a record for writing.
+        Args:
+            record (logging.LogRecord): A prepared record.
+        """
+        if self._pid != os.getpid():
+            self.start()
+        if len(self._queue) >= self.max_size:
+            self.dropped += 1
+            return
+        self._queue.append(record)
+
+    def __len__(self):
+        return len(self._queue)
+
+    def start(self):
+        """
+        Start the listener thread for this process.
+        """
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                # Forked, the parent's thread and queue stayed behind.
+                self._queue.clear()
+            self._pid = os.getpid()
+            self._running = True
+            self._stopped = False
+            thread_module = 'thread' if sys.version_info[0] < 3 \
+                else '_thread'
+            _original(thread_module, 'start_new_thread')(self._run, ())
+            if not self._atexit:
+                atexit.register(self.stop)
+                self._atexit = True
+
+    def drain(self):
+        """
+        Write everything queued so far. Only call from the listener thread
+        or once it has stopped.
+        Returns:
+            (int) The number of records written.
+        """
+        count = 0
+        while True:
+            try:
+                record = self._queue.popleft()
+            except IndexError:
+                break
+            count += 1
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+        if count:
+            for handler in self.handlers:
+                handler.flush()
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            sys.stderr.write('Dropped {0} log records.\n'.format(dropped))
+        return count
+
+    def _run(self):
+        sleep = _original('time', 'sleep')
+        try:
+            while self._running:
+                if not self.drain():
+                    sleep(self.interval)
+            self.drain()
+        finally:
+            self._stopped = True
+
+    def stop(self, timeout=5):
+        """
+        Stop the listener thread once everything queued has been written.
+        Kwargs:
+            timeout (float): Max seconds to wait for the thread.
+        """
+        if self._pid != os.getpid():
+            return
+        self._running = False
+        sleep = _original('time', 'sleep')
+        deadline = time.time() + timeout
+        while not self._stopped and time.time() < deadline:
+            sleep(0.01)
+        self._pid = None
+
+
+_listener = {}
+
+
+def get_listener(config):
+    """
+    Get the process wide listener, setting up the real handlers the first
+    time.
+    Args:
+        config (flask.Config): Holds APP_LOG, LOG_FORMAT and LOG_QUEUE_SIZE.
+    Returns:
+        (QueueListener)
+    """
+    if 'listener' not in _listener:
+        if config.get('LOG_FORMAT', 'text') == 'json':
+            formatter = JSONFormatter()
+        else:
+            formatter = logging.Formatter(TEXT_FORMAT)
+        handlers = [logging.StreamHandler(),
+                    logging.FileHandler(config['APP_LOG'])]
+        for handler in handlers:
+            handler.setFormatter(formatter)
+        _listener['listener'] = QueueListener(
+            handlers, max_size=config.get('LOG_QUEUE_SIZE', 10000))
+    return _listener['listener']
+
+
+def configure_logger(logger, config):
+    """
+    Route a logger through the shared listener. Safe to call more than once.
+    Args:
+        logger (logging.Logger): The logger.
+        config (flask.Config): The app config.
+    Returns:
+        (logging.Logger)
+    """
+    if any(isinstance(h, QueueHandler) for h in logger.handlers):
+        return logger
+    logger.setLevel(config.get('LOG_LEVEL', 'DEBUG'))
+    handler = QueueHandler(get_listener(config))
+    rate = config.get('LOG_SAMPLE_RATE', 1)
+    if rate < 1:
+        handler.addFilter(SamplingFilter(rate))
+    logger.addHandler(handler)
+    return logger
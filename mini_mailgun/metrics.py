@@ -0,0 +1,253 @@
+"""
+Prometheus metrics.
+
+Everything is recorded in prometheus_client's default registry. When
+celery runs a prefork pool, or several API processes share a host, set
+the PROMETHEUS_MULTIPROC_DIR environment variable to an empty directory
+before starting them. Each process then records into it's own memory
+mapped file and a scrape of any process sums them all.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY
+from prometheus_client import CollectorRegistry, Counter, Histogram
+from prometheus_client import generate_latest, multiprocess
+from prometheus_client import start_http_server
+from prometheus_client.core import GaugeMetricFamily
+
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10,
+           30, 60)
+MAX_DOMAINS = 200
+OTHER_DOMAIN = 'other'
+
+REQUEST_LATENCY = Histogram(
+    'mini_mailgun_http_request_seconds', 'API request latency.',
+    ['method', 'route', 'status'], buckets=BUCKETS)
+DB_COMMIT_LATENCY = Histogram(
+    'mini_mailgun_db_commit_seconds',
+    'Time to flush and commit a session or write a batch of statuses.',
+    buckets=BUCKETS)
+PUBLISH_LATENCY = Histogram(
+    'mini_mailgun_broker_publish_seconds',
+    'Time to publish a task to the broker.', ['task'], buckets=BUCKETS)
+MX_LOOKUP_LATENCY = Histogram(
+    'mini_mailgun_mx_lookup_seconds',
+    'Time to resolve MX records. Cache hits are not counted.',
+    buckets=BUCKETS)
+SMTP_LATENCY = Histogram(
+    'mini_mailgun_smtp_seconds',
+    'Time spent in each stage of an SMTP session.', ['stage', 'domain'],
+    buckets=BUCKETS)
+THROTTLED = Counter(
+    'mini_mailgun_throttled_total',
+    'Sends deferred by the per destination throttle.', ['reason'])
+RESPONSES = Counter(
+    'mini_mailgun_responses_total',
+    'Delivery attempts by the status code they ended with.', ['code'])
+EMAIL_CACHE = Counter(
+    'mini_mailgun_email_cache_total',
+    'Email lookups by the API cache, by hit, negative_hit or miss.',
+    ['result'])
+EMAIL_CACHE_AGE = Histogram(
+    'mini_mailgun_email_cache_age_seconds',
+    'How long ago a cached email was read from the database when served.',
+    buckets=BUCKETS)
+
+_collectors = []
+_domains = set()
+_domains_lock = threading.Lock()
+_local = threading.local()
+
+
+def multiprocess_dir():
+    """
+    Get the directory shared by every process on the host.
+    Returns:
+        (str) Or None when each process keeps it's own metrics.
+    """
+    return (os.environ.get('PROMETHEUS_MULTIPROC_DIR') or
+            os.environ.get('prometheus_multiproc_dir'))
+
+
+def domain_label(host):
+    """
+    Get a bounded label for an SMTP host. Hosts are collapsed to their last
+    two labels, so mx1.example.com and mx2.example.com are both
+    example.com. IP addresses are kept whole. Once MAX_DOMAINS domains
+    have been seen anything new is counted as other.
+    Args:
+        host (str): The SMTP host.
+    Returns:
+        (str) The label.
+    """
+    labels = host.lower().rstrip('.').split('.')
+    domain = '.'.join(labels if labels[-1].isdigit() else labels[-2:])
+    if domain in _domains:
+        return domain
+    with _domains_lock:
+        if len(_domains) >= MAX_DOMAINS:
+            return OTHER_DOMAIN
+        _domains.add(domain)
+    return domain
+
+
+@contextmanager
+def timed(histogram, *labels):
+    """
+    Observe how long the body of a with block takes, even if it raises.
+    Args:
+        histogram (prometheus_client.Histogram): Where to record it.
+        *labels: Label values, if the histogram has labels.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        if labels:
+            histogram = histogram.labels(*labels)
+        histogram.observe(time.time() - start)
+
+
+def count_response(code):
+    """
+    Count the status code a delivery attempt ended with.
+    Args:
+        code (int): SMTP status code, or -1 if the attempt never got one.
+    """
+    RESPONSES.labels(str(code)).inc()
+
+
+def publish_started(**kwargs):
+    """
+    celery before_task_publish handler.
+    """
+    _local.publish_started = time.time()
+
+
+def publish_finished(sender=None, **kwargs):
+    """
+    celery after_task_publish handler.
+    """
+    start = getattr(_local, 'publish_started', None)
+    if start is not None:
+        _local.publish_started = None
+        PUBLISH_LATENCY.labels(sender or 'unknown').observe(
+            time.time() - start)
+
+
+def _commit_started(session):
+    session.info['commit_started'] = time.time()
+
+
+def _commit_finished(session):
+    start = session.info.pop('commit_started', None)
+    if start is not None:
+        DB_COMMIT_LATENCY.observe(time.time() - start)
+
+
+def _commit_abandoned(session):
+    session.info.pop('commit_started', None)
+
+
+def instrument_sessions(target):
+    """
+    Time every commit made through a session.
+    Args:
+        target: A sqlalchemy Session class, sessionmaker or scoped_session.
+    """
+    from sqlalchemy import event
+    event.listen(target, 'before_commit', _commit_started)
+    event.listen(target, 'after_commit', _commit_finished)
+    event.listen(target, 'after_rollback', _commit_abandoned)
+
+
+class QueueDepthCollector(object):
+    """
+    Reports how many tasks are waiting in each broker queue. The broker is
+    asked on every scrape, only by the process being scraped.
+    """
+
+    def __init__(self, depths):
+        """
+        Args:
+            depths (callable): Returns a dict of queue name to depth.
+        """
+        self.depths = depths
+
+    def _family(self):
+        return GaugeMetricFamily('mini_mailgun_queue_depth',
+                                 'Tasks waiting in each broker queue.',
+                                 labels=['queue'])
+
+    def describe(self):
+        return [self._family()]
+
+    def collect(self):
+        family = self._family()
+        try:
+            depths = self.depths()
+        except Exception:
+            depths = {}
+        for queue, depth in sorted(depths.items()):
+            family.add_metric([queue], depth)
+        return [family]
+
+
+def add_collector(collector):
+    """
+    Register a collector that is asked for it's metrics on every scrape,
+    in multiprocess mode too.
+    Args:
+        collector: Any prometheus_client collector.
+    """
+    _collectors.append(collector)
+    REGISTRY.register(collector)
+
+
+def registry():
+    """
+    Get the registry to expose. In multiprocess mode this collects from
+    every process's files.
+    Returns:
+        (prometheus_client.CollectorRegistry)
+    """
+    if not multiprocess_dir():
+        return REGISTRY
+    collected = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collected)
+    for collector in _collectors:
+        collected.register(collector)
+    return collected
+
+
+def latest():
+    """
+    Render the current metrics.
+    Returns:
+        (tuple) The body and it's content type.
+    """
+    return generate_latest(registry()), CONTENT_TYPE_LATEST
+
+
+def start_server(port, addr=''):
+    """
+    Serve the metrics on their own port, for processes without the API.
+    Args:
+        port (int): Port to listen on.
+    Kwargs:
+        addr (str): Interface to listen on. Defaults to all of them.
+    """
+    start_http_server(port, addr, registry=registry())
+
+
+def process_exited(pid):
+    """
+    Clean up after a process that has exited in multiprocess mode.
+    Args:
+        pid (int): The exited process.
+    """
+    if multiprocess_dir():
+        multiprocess.mark_process_dead(pid)
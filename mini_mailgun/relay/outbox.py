@@ -0,0 +1,126 @@
+"""
+Publishes emails from the outbox table to celery.
+
+The API writes an outbox row in the same transaction as each email and
+leaves publishing to the relay, so a slow or unreachable broker never
+holds up a request or loses an email. Rows are claimed with SKIP LOCKED
+so any number of relays can share the table. Every shard has it's own
+outbox and each batch takes an even share from all of them. Delivery is
+at least once, if the relay dies between publishing and committing the
+batch is published again.
+"""
+import logging
+import time
+from datetime import timedelta
+
+from mini_mailgun.api.db import db, shard_engine, shard_ids, shard_limit
+from mini_mailgun.api.models import Email, Outbox
+from mini_mailgun.common import utc_time
+from mini_mailgun.constants import STATUS_SENDING, RELAY_LOGGER
+
+LOG = logging.getLogger(RELAY_LOGGER)
+
+
+class OutboxRelay(object):
+    """
+    Drains the outbox in batches.
+    """
+
+    def __init__(self, app, batch_size=500, poll_interval=0.1, keep=3600,
+                 purge_interval=60):
+        """
+        Constructor for the outbox relay.
+        Args:
+            app (flask.Flask): App holding the database and celery config.
+        Kwargs:
+            batch_size (int): Max rows published per transaction.
+            poll_interval (float): Seconds to wait when the outbox is empty.
+            keep (float): Seconds dispatched rows are kept for.
+            purge_interval (float): Seconds between purges of dispatched
+                                    rows. None to leave them alone.
+        """
+        self.app = app
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.keep = keep
+        self.purge_interval = purge_interval
+        self._running = False
+
+    def relay(self, limit):
+        """
+        Publish one batch over a single broker connection and mark it
+        dispatched. Rows whose email is gone or no longer SENDING are
+        marked without publishing.
+        Args:
+            limit (int): Max rows to publish, split evenly across shards.
+        Returns:
+            (int) The number of rows dispatched.
+        """
+        from mini_mailgun.api.tasks import celery_app, schedule_email
+        with self.app.app_context():
+            entries = Outbox.query.filter(
+                Outbox.dispatched_at.is_(None)).order_by(Outbox.id).limit(
+                    shard_limit(limit, self.app)).with_for_update(
+                        skip_locked=True).all()
+            if not entries:
+                db.session.commit()
+                return 0
+            emails = Email.query.filter(
+                Email.uuid.in_([entry.email_uuid for entry in entries]),
+                Email.status == STATUS_SENDING).all()
+            # kombu publishes one message at a time, the batch shares a
+            # producer and it's connection instead.
+            with celery_app.producer_or_acquire() as producer:
+                for email in emails:
+                    schedule_email(email, producer=producer)
+            now = utc_time()
+            for entry in entries:
+                entry.dispatched_at = now
+            db.session.commit()
+        LOG.debug('Dispatched %s emails.', len(entries))
+        return len(entries)
+
+    def purge(self):
+        """
+        Delete rows dispatched more than keep seconds ago.
+        Returns:
+            (int) The number of rows purged.
+        """
+        table = Outbox.__table__
+        cutoff = utc_time() - timedelta(seconds=self.keep)
+        purged = 0
+        for shard in shard_ids(self.app):
+            with shard_engine(shard, self.app).begin() as conn:
+                purged += conn.execute(table.delete().where(
+                    table.c.dispatched_at < cutoff)).rowcount
+        return purged
+
+    def run_forever(self):
+        """
+        Keep relaying until stop is called.
+        """
+        self._running = True
+        LOG.info('Outbox relay started.')
+        next_purge = time.time()
+        while self._running:
+            if self.purge_interval and time.time() >= next_purge:
+                next_purge = time.time() + self.purge_interval
+                try:
+                    LOG.info('Purged %s dispatched outbox rows.',
+                             self.purge())
+                except Exception:
+                    LOG.exception('Unable to purge the outbox.')
+            try:
+                relayed = self.relay(self.batch_size)
+            except Exception:
+                LOG.exception('Unable to relay the outbox.')
+                relayed = 0
+            if relayed < self.batch_size:
+                time.sleep(self.poll_interval)
+        LOG.info('Outbox relay stopped.')
+
+    def stop(self):
+        """
+        Stop once the current batch is done.
+        """
+        self._running = False
@@ -0,0 +1,28 @@
+"""
+Run the outbox relay!
+"""
+import signal
+
+from mini_mailgun.api.app import get_app, create_logger
+from mini_mailgun.constants import RELAY_LOGGER
+
+
+def run_relay():
+    """
+    Entry point to start the outbox relay. Set USE_OUTBOX = True so the
+    API leaves publishing to it.
+    """
+    from mini_mailgun.relay.outbox import OutboxRelay
+    app = get_app()
+    config = app.config
+    logger = create_logger(RELAY_LOGGER)
+    logger.info("Starting OUTBOX RELAY")
+    relay = OutboxRelay(
+        app,
+        batch_size=config.get('OUTBOX_BATCH_SIZE', 500),
+        poll_interval=config.get('OUTBOX_POLL_INTERVAL', 0.1),
+        keep=config.get('OUTBOX_KEEP', 3600),
+        purge_interval=config.get('PURGE_INTERVAL', 60))
+    signal.signal(signal.SIGTERM, lambda *args: relay.stop())
+    signal.signal(signal.SIGINT, lambda *args: relay.stop())
+    relay.run_forever()
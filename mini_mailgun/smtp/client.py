@@ -1,8 +1,11 @@
 """
 SMTP client used to send email messages
 """
-from smtplib import SMTP, SMTPException
+import socket
+import time
+from smtplib import CRLF, SMTP, SMTPDataError, SMTPException, quoteaddr
 
+from mini_mailgun import metrics
 from mini_mailgun.exceptions import SMTPClientError
 
 
@@ -21,12 +24,22 @@ class MiniMailgunSMTP(SMTP):
             port (int): The port on the SMTP host
                         you would like to connect over.
         """
-        SMTP.__init__(self, host, port)
+        self.domain = metrics.domain_label(host)
+        with metrics.timed(metrics.SMTP_LATENCY, 'connect', self.domain):
+            SMTP.__init__(self, host, port)
+
+    def ehlo_or_helo_if_needed(self):
+        """
+        Say EHLO, or HELO if that's refused, unless we already have.
+        """
+        if self.helo_resp is None and self.ehlo_resp is None:
+            with metrics.timed(metrics.SMTP_LATENCY, 'ehlo', self.domain):
+                SMTP.ehlo_or_helo_if_needed(self)
 
     def sendmail_get_status(self, from_addr, to_addr, msg):
         """
         Modified version of the SMTP sendmail method.
-        It no longer supports multiple to_addrs.
+        It no longer supports multiple to_addrs, see sendmail_multi.
         Args:
             from_addr (str): The sender's email address.
             to_addr (str): The recipiant's email address.
@@ -35,18 +48,54 @@ class MiniMailgunSMTP(SMTP):
             (dict): A dictionary of the last SMTP status code
                 and the servers last status message.
         """
+        code, resp, _ = self.sendmail_multi(from_addr, [to_addr], msg)
+        return code, resp
+
+    def sendmail_multi(self, from_addr, to_addrs, msg):
+        """
+        Send one message to many recipients in a single transaction.
+        If the server supports PIPELINING (RFC 2920) MAIL and every RCPT
+        are sent in one write and their replies read back together.
+        The session is only RSET if the transaction was abandoned part way.
+        Args:
+            from_addr (str): The sender's email address.
+            to_addrs (list): The recipiants' email addresses.
+            msg (str): The email message.
+        Returns:
+            (tuple): The last SMTP status code, the servers last status
+                message and a dict of recipient to (code, message) with
+                the final status for every recipient.
+        """
         self.ehlo_or_helo_if_needed()
-        try:
+        if self.does_esmtp and self.has_extn('pipelining'):
+            commands = ['MAIL FROM:{0}'.format(quoteaddr(from_addr))]
+            commands.extend('RCPT TO:{0}'.format(quoteaddr(to_addr))
+                            for to_addr in to_addrs)
+            self.send(''.join(command + CRLF for command in commands))
+            (code, resp) = self.getreply()
+            rcpt_replies = [self.getreply() for _ in to_addrs]
+        else:
             (code, resp) = self.mail(from_addr)
-            if code != 250:
-                return code, resp
-            (code, resp) = self.rcpt(to_addr)
-            if (code != 250) and (code != 251):
-                return code, resp
-            (code, resp) = self.data(msg)
-            return code, resp
-        finally:
+            rcpt_replies = [] if code != 250 else \
+                [self.rcpt(to_addr) for to_addr in to_addrs]
+        if code != 250:
+            return code, resp, dict((to_addr, (code, resp))
+                                    for to_addr in to_addrs)
+        statuses = dict(zip(to_addrs, rcpt_replies))
+        accepted = [to_addr for to_addr in to_addrs
+                    if statuses[to_addr][0] in (250, 251)]
+        if not accepted:
+            self.rset()
+            return rcpt_replies[-1][0], rcpt_replies[-1][1], statuses
+        try:
+            with metrics.timed(metrics.SMTP_LATENCY, 'data', self.domain):
+                (code, resp) = self.data(msg)
+        except SMTPDataError as e:
+            (code, resp) = e.smtp_code, e.smtp_error
             self.rset()
+        for to_addr in accepted:
+            statuses[to_addr] = (code, resp)
+        return code, resp, statuses
 
 
 class Client():
@@ -66,8 +115,19 @@ class Client():
         self.host = host
         self.port = port
         self.use_tls = use_tls
+        self.messages_sent = 0
+        self.last_used = time.time()
         self.connect()
 
+    @property
+    def key(self):
+        """
+        The destination this client is connected to.
+        Returns:
+            (tuple) host, port and use_tls.
+        """
+        return self.host, self.port, self.use_tls
+
     def connect(self):
         """
         Connect or reconnect to the SMTP host.
@@ -78,13 +138,20 @@ class Client():
         Raises:
             mini_mailgun.exceptions.SMTPClientError
         """
+        smtp_connection = None
         try:
-            self._smtp_connection = MiniMailgunSMTP(self.host, self.port)
+            smtp_connection = MiniMailgunSMTP(self.host, self.port)
             if self.use_tls:
-                self._smtp_connection.starttls()
+                with metrics.timed(metrics.SMTP_LATENCY, 'starttls',
+                                   smtp_connection.domain):
+                    smtp_connection.starttls()
         except SMTPException as e:
-            self.smtp_connection.quit()
+            if smtp_connection is not None:
+                smtp_connection.close()
             raise SMTPClientError(str(e))
+        self._smtp_connection = smtp_connection
+        self.messages_sent = 0
+        self.last_used = time.time()
 
     def quit(self):
         """
@@ -92,6 +159,28 @@ class Client():
         """
         self._smtp_connection.quit()
 
+    def close(self):
+        """
+        Politely close the SMTP connection, dropping the socket if the
+        server has already gone away.
+        """
+        try:
+            self._smtp_connection.quit()
+        except (SMTPException, socket.error):
+            self._smtp_connection.close()
+
+    def is_alive(self):
+        """
+        Health check a connection before reusing it.
+        Returns:
+            (bool) True if the server answered a NOOP with a 250.
+        """
+        try:
+            code = self._smtp_connection.noop()[0]
+        except (SMTPException, socket.error):
+            return False
+        return code == 250
+
     def send_message(self, from_addr, to_addr, message):
         """
         Send an email message.
@@ -103,6 +192,25 @@ class Client():
             (dict): A dict containing status code
                     and last message from the server.
         """
+        self.messages_sent += 1
+        self.last_used = time.time()
         return self._smtp_connection.sendmail_get_status(from_addr,
                                                          to_addr,
                                                          message)
+
+    def send_message_multi(self, from_addr, to_addrs, message):
+        """
+        Send one email message to many recipients in a single transaction.
+        Args:
+            from_addr (str): The sender's address.
+            to_addrs (list): The recipiants' addresses.
+            message (str): A well formed email message.
+        Returns:
+            (dict): Recipient to a tuple of status code and
+                    last message from the server.
+        """
+        self.messages_sent += 1
+        self.last_used = time.time()
+        return self._smtp_connection.sendmail_multi(from_addr,
+                                                    to_addrs,
+                                                    message)[2]
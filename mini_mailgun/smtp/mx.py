@@ -0,0 +1,166 @@
+"""
+MX record lookups with a TTL aware cache.
+"""
+import json
+import threading
+
+from mini_mailgun import metrics
+from mini_mailgun.common import LRUCache
+
+REDIS_KEY = 'mini_mailgun:mx:{0}'
+
+
+def select_mx_host(records, attempts):
+    """
+    Pick the MX host to use for an attempt. The first attempt uses the most
+    preferred record, later attempts walk down the list and wrap around.
+    Args:
+        records (list): (preference, exchange) tuples.
+        attempts (int): The attempt number starting at 1.
+    Returns:
+        (str) The selected exchange.
+    """
+    mx_records = {}
+    for preference, exchange in records:
+        mx_records[preference] = exchange
+    while(len(mx_records) < attempts):
+        attempts -= len(mx_records)
+    return mx_records[sorted(mx_records.keys())[attempts - 1]]
+
+
+class MXCache(object):
+    """
+    Caches MX lookups in process for as long as the record TTL allows.
+    Domains with no MX records (NXDOMAIN or an empty answer) are cached
+    negatively. An optional redis tier lets every worker process share
+    lookups.
+    """
+
+    def __init__(self, max_size=1024, negative_ttl=300, max_ttl=3600,
+                 redis_url=None):
+        """
+        Constructor for the MX cache.
+        Kwargs:
+            max_size (int): Max domains held in process.
+            negative_ttl (int): Seconds to remember a domain has no MX records.
+            max_ttl (int): Cap on how long a record is cached regardless
+                           of it's TTL.
+            redis_url (str): Redis to share lookups across processes.
+                             Disabled when None.
+        """
+        self.negative_ttl = negative_ttl
+        self.max_ttl = max_ttl
+        self._cache = LRUCache(max_size)
+        self._redis = None
+        if redis_url:
+            import redis
+            self._redis = redis.StrictRedis.from_url(redis_url)
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'negative_hits': 0,
+                       'redis_hits': 0, 'misses': 0}
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def stats(self):
+        """
+        Hit and miss counters for this process.
+        Returns:
+            (dict) hits, negative_hits, redis_hits, misses, lookups and size.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats['lookups'] = sum(stats.values())
+        stats['size'] = len(self._cache)
+        return stats
+
+    def _resolve(self, domain):
+        """
+        Query DNS for a domain's MX records.
+        Raises:
+            dns.exception.DNSException on lookup errors other than
+            NXDOMAIN or no answer.
+        Returns:
+            (tuple) A list of (preference, exchange) tuples and the TTL.
+        """
+        import dns.resolver
+        try:
+            answer = dns.resolver.query(domain, 'MX')
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            return [], self.negative_ttl
+        records = sorted((mx.preference.real, mx.exchange.to_text())
+                         for mx in answer)
+        return records, min(answer.rrset.ttl, self.max_ttl)
+
+    def _redis_get(self, domain):
+        """
+        Look up a domain in the shared tier.
+        Returns:
+            (tuple) The records and remaining TTL, or None on a miss.
+        """
+        import redis
+        try:
+            pipe = self._redis.pipeline()
+            pipe.get(REDIS_KEY.format(domain))
+            pipe.pttl(REDIS_KEY.format(domain))
+            value, pttl = pipe.execute()
+        except redis.RedisError:
+            return None
+        if value is None or pttl <= 0:
+            return None
+        records = [tuple(record) for record in json.loads(value)]
+        return records, pttl / 1000.0
+
+    def _redis_set(self, domain, records, ttl):
+        """
+        Share a lookup with other processes.
+        """
+        import redis
+        try:
+            self._redis.psetex(REDIS_KEY.format(domain), int(ttl * 1000),
+                               json.dumps(records))
+        except redis.RedisError:
+            pass
+
+    def set(self, domain, records, ttl):
+        """
+        Seed the cache. Mostly useful for tests and benchmarks.
+        Args:
+            domain (str): The domain.
+            records (list): (preference, exchange) tuples.
+            ttl (int): Seconds to keep the records for.
+        """
+        self._cache.set(domain.lower(), records, ttl)
+
+    def lookup(self, domain):
+        """
+        Get the MX records for a domain.
+        Args:
+            domain (str): The domain to look up.
+        Raises:
+            dns.exception.DNSException on lookup errors other than
+            NXDOMAIN or no answer. These are not cached.
+        Returns:
+            (list) (preference, exchange) tuples sorted by preference.
+                Empty if the domain has no MX records.
+        """
+        domain = domain.lower()
+        records = self._cache.get(domain)
+        if records is not None:
+            self._count('hits' if records else 'negative_hits')
+            return records
+        shared = self._redis_get(domain) if self._redis else None
+        if shared is not None:
+            self._count('redis_hits')
+            records, ttl = shared
+            self._cache.set(domain, records, ttl)
+            return records
+        self._count('misses')
+        with metrics.timed(metrics.MX_LOOKUP_LATENCY):
+            records, ttl = self._resolve(domain)
+        if ttl > 0:
+            self._cache.set(domain, records, ttl)
+            if self._redis:
+                self._redis_set(domain, records, ttl)
+        return records
@@ -0,0 +1,169 @@
+"""
+Process local pool of live SMTP sessions.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from mini_mailgun.smtp.client import Client
+
+
+class ConnectionPool(object):
+    """
+    Keeps idle SMTP connections around so consecutive messages to the same
+    MX can be delivered over one session.
+    Connections are keyed by (host, port, use_tls). A connection is
+    health checked with a NOOP before it is handed out again and is closed
+    once it has been idle for too long or has sent too many messages.
+    """
+
+    def __init__(self, max_size=4, max_idle=30, max_messages=100,
+                 client_class=Client):
+        """
+        Constructor for the connection pool.
+        Kwargs:
+            max_size (int): Max idle connections kept per destination.
+            max_idle (int): Seconds a connection may sit idle before
+                            it is closed.
+            max_messages (int): Messages sent over a connection before
+                                it is closed.
+            client_class (class): The SMTP client to create connections with.
+        """
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.max_messages = max_messages
+        self.client_class = client_class
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._pid = os.getpid()
+
+    def _check_pid(self):
+        """
+        Forget connections inherited from a parent process. The sockets
+        belong to the parent so they are dropped without a QUIT.
+        """
+        if self._pid != os.getpid():
+            with self._lock:
+                self._idle = {}
+                self._pid = os.getpid()
+
+    def _expired(self, client, now):
+        """
+        Check if a connection has been idle for too long.
+        """
+        return now - client.last_used > self.max_idle
+
+    def _close(self, clients):
+        """
+        Close a list of connections. Errors are ignored, the connection
+        is going away either way.
+        """
+        for client in clients:
+            try:
+                client.close()
+            except Exception:
+                pass
+
+    def _pop(self, key):
+        """
+        Grab the most recently used idle connection for a destination,
+        sweeping expired connections while we hold the lock.
+        Returns:
+            (tuple) The connection or None and a list of connections to close.
+        """
+        now = time.time()
+        expired = []
+        client = None
+        with self._lock:
+            for idle_key in list(self._idle):
+                idle = self._idle[idle_key]
+                expired.extend(c for c in idle if self._expired(c, now))
+                idle[:] = [c for c in idle if not self._expired(c, now)]
+                if not idle:
+                    del self._idle[idle_key]
+            idle = self._idle.get(key)
+            if idle:
+                client = idle.pop()
+        return client, expired
+
+    def acquire(self, host, port, use_tls=False):
+        """
+        Get a live connection to a destination. Reuses an idle connection
+        if a healthy one exists, otherwise opens a new one.
+        Args:
+            host (str): The SMTP host.
+            port (int): The port on the SMTP host.
+        Kwargs:
+            use_tls (bool): Use STARTTLS on new connections.
+        Raises:
+            mini_mailgun.exceptions.SMTPClientError
+        Returns:
+            (mini_mailgun.smtp.client.Client)
+        """
+        self._check_pid()
+        while True:
+            client, expired = self._pop((host, port, use_tls))
+            self._close(expired)
+            if client is None:
+                return self.client_class(host, port, use_tls=use_tls)
+            if client.is_alive():
+                return client
+            self._close([client])
+
+    def release(self, client, reusable=True):
+        """
+        Hand a connection back to the pool.
+        Args:
+            client (mini_mailgun.smtp.client.Client): The connection.
+        Kwargs:
+            reusable (bool): False if the connection is in an unknown
+                             state and should be closed.
+        """
+        self._check_pid()
+        if not reusable or client.messages_sent >= self.max_messages:
+            self._close([client])
+            return
+        with self._lock:
+            idle = self._idle.setdefault(client.key, [])
+            if len(idle) < self.max_size:
+                idle.append(client)
+                return
+        self._close([client])
+
+    @contextmanager
+    def connection(self, host, port, use_tls=False):
+        """
+        Context manager to borrow a connection. The connection is closed
+        instead of returned to the pool if the block raises.
+        Args:
+            host (str): The SMTP host.
+            port (int): The port on the SMTP host.
+        Kwargs:
+            use_tls (bool): Use STARTTLS on new connections.
+        """
+        client = self.acquire(host, port, use_tls=use_tls)
+        try:
+            yield client
+        except Exception:
+            self.release(client, reusable=False)
+            raise
+        self.release(client)
+
+    def close_all(self):
+        """
+        Close every idle connection. Used on worker shutdown.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for clients in idle.values():
+            self._close(clients)
+
+    def size(self):
+        """
+        Number of idle connections currently held.
+        Returns:
+            (int)
+        """
+        with self._lock:
+            return sum(len(clients) for clients in self._idle.values())
@@ -0,0 +1,191 @@
+"""
+A local SMTP sink used by tests and benchmarks. Accepts everything it is
+sent (unless told to fail some of it) and keeps the messages in memory.
+"""
+import argparse
+import random
+import threading
+import time
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """
+    Speaks just enough SMTP for smtplib.
+    """
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('ascii'))
+        self.wfile.flush()
+
+    def read_data(self):
+        lines = []
+        while True:
+            line = self.rfile.readline()
+            if not line or line.rstrip(b'\r\n') == b'.':
+                return b''.join(lines)
+            if line.startswith(b'..'):
+                line = line[1:]
+            lines.append(line)
+
+    def handle(self):
+        sink = self.server.sink
+        mail_from = None
+        rcpts = []
+        self.reply('220 mini-mailgun sink ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.strip().decode('ascii', 'replace')
+            verb = command.split(' ', 1)[0].upper()
+            sink.commands.append(verb)
+            if sink.command_latency:
+                time.sleep(sink.command_latency)
+            if verb == 'EHLO':
+                self.reply('250-mini-mailgun sink')
+                for extension in sink.extensions[:-1]:
+                    self.reply('250-' + extension)
+                self.reply('250 ' + sink.extensions[-1])
+            elif verb == 'HELO':
+                self.reply('250 mini-mailgun sink')
+            elif verb == 'MAIL':
+                mail_from = command[10:].strip('<> ')
+                rcpts = []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                rcpt = command[8:].strip('<> ')
+                if rcpt in sink.reject:
+                    self.reply('550 No such user')
+                else:
+                    rcpts.append(rcpt)
+                    self.reply('250 OK')
+            elif verb == 'DATA':
+                if not rcpts:
+                    self.reply('554 No valid recipients')
+                    continue
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = self.read_data()
+                if sink.latency:
+                    time.sleep(sink.latency)
+                if random.random() < sink.failure_rate:
+                    sink.record(mail_from, rcpts, data, sink.failure_code)
+                    self.reply('{0} Try again later'.format(sink.failure_code))
+                else:
+                    sink.record(mail_from, rcpts, data, 250)
+                    self.reply('250 OK queued')
+                mail_from = None
+                rcpts = []
+            elif verb == 'RSET':
+                mail_from = None
+                rcpts = []
+                self.reply('250 OK')
+            elif verb == 'NOOP':
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('500 Command not recognized')
+
+
+class SMTPSinkServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class SMTPSink(object):
+    """
+    A threaded SMTP server that accepts and records messages.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0,
+                 command_latency=0, failure_rate=0, failure_code=451,
+                 extensions=('PIPELINING', '8BITMIME'), reject=()):
+        """
+        Constructor for the sink.
+        Kwargs:
+            host (str): Interface to listen on.
+            port (int): Port to listen on. 0 picks a free port.
+            latency (float): Seconds to wait before answering DATA.
+            command_latency (float): Seconds to wait before every reply.
+            failure_rate (float): Fraction of messages answered with
+                                  failure_code instead of 250.
+            failure_code (int): The SMTP code for failed messages.
+            extensions (tuple): ESMTP extensions to advertise.
+            reject (tuple): Recipients to answer RCPT with a 550.
+        """
+        self.latency = latency
+        self.command_latency = command_latency
+        self.failure_rate = failure_rate
+        self.failure_code = failure_code
+        self.extensions = list(extensions) or ['HELP']
+        self.reject = set(reject)
+        self.messages = []
+        self.commands = []
+        self._lock = threading.Lock()
+        self._server = SMTPSinkServer((host, port), SMTPSinkHandler)
+        self._server.sink = self
+        self.host, self.port = self._server.server_address
+        self._thread = None
+
+    def record(self, mail_from, rcpts, data, code):
+        with self._lock:
+            self.messages.append({'mail_from': mail_from,
+                                  'rcpts': list(rcpts),
+                                  'data': data,
+                                  'code': code,
+                                  'received_at': time.time()})
+
+    def start(self):
+        """
+        Start serving in a background thread.
+        Returns:
+            (SMTPSink) self, so it can be started inline.
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """
+        Serve in the calling thread.
+        """
+        self._server.serve_forever()
+
+    def stop(self):
+        """
+        Stop serving and close the listening socket.
+        """
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local SMTP sink.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2525)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--failure-rate', type=float, default=0)
+    parser.add_argument('--failure-code', type=int, default=451)
+    args = parser.parse_args()
+    sink = SMTPSink(args.host, args.port, latency=args.latency,
+                    failure_rate=args.failure_rate,
+                    failure_code=args.failure_code)
+    print('SMTP sink listening on {0}:{1}'.format(sink.host, sink.port))
+    sink.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
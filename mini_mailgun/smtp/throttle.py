@@ -0,0 +1,191 @@
+"""
+Per destination rate and connection limits for outgoing mail.
+"""
+import threading
+import time
+import uuid
+
+from mini_mailgun.exceptions import ThrottledError
+
+BUCKET_KEY = 'mini_mailgun:throttle:{0}:bucket'
+LEASES_KEY = 'mini_mailgun:throttle:{0}:leases'
+
+# Takes a token and a connection lease in one step so the limits hold
+# across every worker sharing the redis.
+# KEYS: bucket hash, leases sorted set.
+# ARGV: now, rate, burst, max_connections, lease, lease_ttl.
+# Returns 1 and '' when allowed, otherwise 0 and the reason, and the
+# seconds until a token is available as a string. Lua numbers are
+# truncated on the way out.
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local burst = tonumber(ARGV[3])
+local max_connections = tonumber(ARGV[4])
+local lease_ttl = tonumber(ARGV[6])
+if max_connections > 0 then
+    redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+    if redis.call('ZCARD', KEYS[2]) >= max_connections then
+        return {0, 'connections', '0'}
+    end
+end
+if rate > 0 then
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+    if tokens < 1 then
+        redis.call('HMSET', KEYS[1], 'tokens', tokens, 'ts', now)
+        return {0, 'rate', tostring((1 - tokens) / rate)}
+    end
+    redis.call('HMSET', KEYS[1], 'tokens', tokens - 1, 'ts', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+end
+if max_connections > 0 then
+    redis.call('ZADD', KEYS[2], now + lease_ttl, ARGV[5])
+    redis.call('EXPIRE', KEYS[2], math.ceil(lease_ttl) + 1)
+end
+return {1, '', '0'}
+"""
+
+
+class Throttle(object):
+    """
+    Token bucket rate limits and a cap on open connections per
+    destination. A destination is a recipient domain or an MX host,
+    whichever the caller keys on. With a redis url the limits are shared
+    by every process using it, otherwise each process enforces them on
+    it's own. If redis can't be reached sends go ahead unthrottled rather
+    than stall.
+    """
+
+    def __init__(self, rate=None, burst=None, max_connections=None,
+                 overrides=None, lease_ttl=300, retry_delay=1,
+                 redis_url=None):
+        """
+        Constructor for the throttle.
+        Kwargs:
+            rate (float): Messages per second per destination. None for
+                          no limit.
+            burst (int): Messages that can go at once after a quiet spell.
+                         Defaults to rate.
+            max_connections (int): Max sends in flight per destination.
+                                   None for no limit.
+            overrides (dict): Destination mapped to a dict with any of
+                              rate, burst and max_connections.
+            lease_ttl (float): Seconds before a connection that was never
+                               released, say from a crashed worker, stops
+                               counting.
+            retry_delay (float): Seconds to back off when every connection
+                                 is taken, and the least a deferral waits.
+            redis_url (str): Redis to share limits across processes.
+        """
+        self.defaults = {'rate': rate, 'burst': burst,
+                         'max_connections': max_connections}
+        self.overrides = dict((key.lower(), value)
+                              for key, value in (overrides or {}).items())
+        self.lease_ttl = lease_ttl
+        self.retry_delay = retry_delay
+        self._redis = None
+        self._script = None
+        if redis_url:
+            import redis
+            self._redis = redis.StrictRedis.from_url(redis_url)
+            self._script = self._redis.register_script(ACQUIRE_SCRIPT)
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._leases = {}
+
+    def limits(self, key):
+        """
+        Get the limits for a destination.
+        Args:
+            key (str): The destination.
+        Returns:
+            (tuple) rate, burst and max_connections. 0 means no limit.
+        """
+        limits = dict(self.defaults)
+        limits.update(self.overrides.get(key, {}))
+        rate = float(limits['rate'] or 0)
+        burst = limits['burst'] or max(rate, 1)
+        return rate, burst, limits['max_connections'] or 0
+
+    def acquire(self, key):
+        """
+        Take a token and a connection for a send.
+        Args:
+            key (str): The destination.
+        Raises:
+            mini_mailgun.exceptions.ThrottledError if the send has to wait.
+        Returns:
+            (str) A lease to hand back to release once the send is done.
+        """
+        key = key.lower()
+        rate, burst, max_connections = self.limits(key)
+        if not rate and not max_connections:
+            return ''
+        lease = uuid.uuid4().hex
+        if self._redis is not None:
+            allowed, reason, wait = self._acquire_redis(
+                key, rate, burst, max_connections, lease)
+        else:
+            allowed, reason, wait = self._acquire_local(
+                key, rate, burst, max_connections, lease)
+        if not allowed:
+            raise ThrottledError(key, reason,
+                                 max(float(wait), self.retry_delay))
+        return lease
+
+    def _acquire_redis(self, key, rate, burst, max_connections, lease):
+        import redis
+        try:
+            allowed, reason, wait = self._script(
+                keys=[BUCKET_KEY.format(key), LEASES_KEY.format(key)],
+                args=[time.time(), rate, burst, max_connections, lease,
+                      self.lease_ttl])
+        except redis.RedisError:
+            return True, '', 0
+        if isinstance(reason, bytes):
+            reason = reason.decode('utf-8')
+        return bool(allowed), reason, float(wait)
+
+    def _acquire_local(self, key, rate, burst, max_connections, lease):
+        now = time.time()
+        with self._lock:
+            leases = self._leases.setdefault(key, {})
+            if max_connections:
+                for expired in [held for held, expires in leases.items()
+                                if expires <= now]:
+                    del leases[expired]
+                if len(leases) >= max_connections:
+                    return False, 'connections', 0
+            if rate:
+                tokens, ts = self._buckets.get(key, (burst, now))
+                tokens = min(burst, tokens + max(0, now - ts) * rate)
+                if tokens < 1:
+                    self._buckets[key] = (tokens, now)
+                    return False, 'rate', (1 - tokens) / rate
+                self._buckets[key] = (tokens - 1, now)
+            if max_connections:
+                leases[lease] = now + self.lease_ttl
+        return True, '', 0
+
+    def release(self, key, lease):
+        """
+        Give back the connection taken by acquire.
+        Args:
+            key (str): The destination.
+            lease (str): What acquire returned.
+        """
+        if not lease:
+            return
+        key = key.lower()
+        if self._redis is not None:
+            import redis
+            try:
+                self._redis.zrem(LEASES_KEY.format(key), lease)
+            except redis.RedisError:
+                pass
+            return
+        with self._lock:
+            self._leases.get(key, {}).pop(lease, None)
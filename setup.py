@@ -6,12 +6,15 @@ setup(
     packages=find_packages(),
     entry_points={
         'console_scripts':
-            ['mini-mailgun = mini_mailgun.api.run:run_server']},
+            ['mini-mailgun = mini_mailgun.api.run:run_server',
+             'mini-mailgun-delivery = mini_mailgun.delivery.run:run_daemon',
+             'mini-mailgun-relay = mini_mailgun.relay.run:run_relay']},
     include_package_data=True,
     zip_safe=False,
     install_requires=['Flask-SQLAlchemy', 'jsonschema', 'dnspython',
                       'mysql-python', 'requests', 'redis', 'flanker',
-                      'celery', 'gevent', 'flask', 'alembic'],
+                      'celery', 'gevent', 'flask', 'alembic',
+                      'prometheus_client'],
     author="Conrad Weidenkeller",
     author_email="conrad@weidenkeller.com",
     url="http://conrad.weidenkeller.com"
@@ -1,11 +1,16 @@
 import json
 import os
+import threading
+import time
 import unittest
 
-from mini_mailgun.api.app import create_app
+import mock
+
+from mini_mailgun.api.app import create_app, get_email_cache
+from mini_mailgun.api.app import get_status_feed
 from mini_mailgun.api.db import db
 from mini_mailgun.api.client import Message
-from mini_mailgun.api.models import Email
+from mini_mailgun.api.models import Email, Outbox
 
 
 class APITestCase(unittest.TestCase):
@@ -84,6 +89,73 @@ class APITestCase(unittest.TestCase):
         self.assertEqual(200, rv.status_code)
         self.assertEqual(rv.data, '["' + message.uuid + '"]')
 
+    def test_get_emails_cursor(self):
+        uuids = []
+        for _ in range(3):
+            rv = self.client.post('/v1/email', data=self.good_body,
+                                  content_type='application/json')
+            uuids.append(self._get_message(rv.data).uuid)
+        rv = self.client.get('/v1/email?limit=2')
+        self.assertEqual(uuids[:2], json.loads(rv.data))
+        cursor = rv.headers['X-Next-Cursor']
+        rv = self.client.get('/v1/email?limit=2&cursor=' + cursor)
+        self.assertEqual(uuids[2:], json.loads(rv.data))
+        self.assertNotIn('X-Next-Cursor', rv.headers)
+        rv = self.client.get('/v1/email?limit=2&offset=1')
+        self.assertEqual(uuids[1:], json.loads(rv.data))
+
+    def test_get_emails_filters(self):
+        rv = self.client.post('/v1/email', data=self.good_body,
+                              content_type='application/json')
+        message = self._get_message(rv.data)
+        rv = self.client.get('/v1/email?status=SENT,FAILED')
+        self.assertEqual([], json.loads(rv.data))
+        rv = self.client.get('/v1/email?status=SENDING&'
+                             'from_addr=conrad@notkeller.com')
+        self.assertEqual([message.uuid], json.loads(rv.data))
+        rv = self.client.get('/v1/email?to_addr=nobody@weidenkeller.com')
+        self.assertEqual([], json.loads(rv.data))
+        rv = self.client.get('/v1/email?created_after=' + message.created_at)
+        self.assertEqual([message.uuid], json.loads(rv.data))
+        rv = self.client.get('/v1/email?created_before=' + message.created_at)
+        self.assertEqual([], json.loads(rv.data))
+
+    def test_get_emails_bad_args(self):
+        rv = self.client.get('/v1/email?cursor=nope')
+        self.assertEqual(400, rv.status_code)
+        rv = self.client.get('/v1/email?created_after=yesterday')
+        self.assertEqual(400, rv.status_code)
+        rv = self.client.get('/v1/email?limit=ten')
+        self.assertEqual(400, rv.status_code)
+        rv = self.client.get('/v1/email?limit=0')
+        self.assertEqual(400, rv.status_code)
+        rv = self.client.get('/v1/email?limit=-1')
+        self.assertEqual(400, rv.status_code)
+        rv = self.client.get('/v1/email?offset=-1')
+        self.assertEqual(400, rv.status_code)
+
+    def test_export_emails(self):
+        uuids = []
+        for i in range(3):
+            rv = self.client.post('/v1/email', data=self.good_body,
+                                  content_type='application/json')
+            uuids.append(self._get_message(rv.data).uuid)
+        self.client.delete('/v1/email/' + uuids[1])
+        rv = self.client.get('/v1/emails/export')
+        self.assertEqual(200, rv.status_code)
+        self.assertEqual('application/x-ndjson', rv.mimetype)
+        lines = rv.data.splitlines()
+        self.assertEqual(uuids,
+                         [self._get_message(line).uuid for line in lines])
+        rv = self.client.get('/v1/emails/export?status=SENDING&limit=1')
+        lines = rv.data.splitlines()
+        self.assertEqual([uuids[0]],
+                         [self._get_message(line).uuid for line in lines])
+        rv = self.client.get('/v1/emails/export?cursor=nope')
+        self.assertEqual(400, rv.status_code)
+        rv = self.client.get('/v1/emails/export?limit=-1')
+        self.assertEqual(400, rv.status_code)
+
     def test_send_email(self):
         rv = self.client.post('/v1/email', data=self.good_body,
                               content_type='application/json')
@@ -100,10 +172,80 @@ class APITestCase(unittest.TestCase):
         self.assertEqual(message.attempts, 0)
         self.assertIsNotNone(message.created_at)
 
+    def test_metrics(self):
+        self.client.get('/v1/email/nosuchemail')
+        rv = self.client.get('/metrics')
+        self.assertEqual(200, rv.status_code)
+        self.assertTrue(rv.content_type.startswith('text/plain'))
+        self.assertIn(b'route="/v1/email/<uuid:uuid>"', rv.data)
+        self.assertIn(b'mini_mailgun_db_commit_seconds', rv.data)
+
+    def test_send_emails(self):
+        body = '[' + ', '.join([self.good_body, self.bad_to_body,
+                                self.good_body]) + ']'
+        rv = self.client.post('/v1/emails', data=body,
+                              content_type='application/json')
+        self.assertEqual(202, rv.status_code)
+        results = json.loads(rv.data)
+        self.assertEqual(3, len(results))
+        self.assertEqual([0, 1, 2], [r['index'] for r in results])
+        self.assertEqual('SENDING', results[0]['status'])
+        self.assertIn('error', results[1])
+        self.assertEqual('to_addr', results[1]['errors'][0]['field'])
+        self.assertNotIn('uuid', results[1])
+        rv = self.client.get('/v1/email/' + results[2]['uuid'])
+        self.assertEqual(200, rv.status_code)
+        message = self._get_message(rv.data)
+        self.assertEqual(message.to_addr, 'conrad@weidenkeller.com')
+        self.assertEqual(message.attempts, 0)
+        rv = self.client.get('/v1/email')
+        self.assertEqual(2, len(json.loads(rv.data)))
+
+    def test_send_email_priority(self):
+        body = dict(json.loads(self.good_body), priority=9)
+        rv = self.client.post('/v1/email', data=json.dumps(body),
+                              content_type='application/json')
+        self.assertEqual(202, rv.status_code)
+        self.assertEqual(9, json.loads(rv.data)['priority'])
+        body['priority'] = 10
+        rv = self.client.post('/v1/email', data=json.dumps(body),
+                              content_type='application/json')
+        self.assertEqual(400, rv.status_code)
+
+    def test_send_emails_priority(self):
+        good = json.loads(self.good_body)
+        rv = self.client.post('/v1/emails', data=json.dumps(
+            [good, dict(good, priority=8)]),
+            content_type='application/json')
+        self.assertEqual(202, rv.status_code)
+        uuids = [r['uuid'] for r in json.loads(rv.data)]
+        with self.app.app_context():
+            priorities = [Email.query.get(uuid).priority for uuid in uuids]
+        self.assertEqual([2, 8], priorities)
+
+    def test_send_emails_all_invalid(self):
+        body = '[' + ', '.join([self.bad_to_body,
+                                self.missing_body_body]) + ']'
+        rv = self.client.post('/v1/emails', data=body,
+                              content_type='application/json')
+        self.assertEqual(400, rv.status_code)
+        self.assertEqual(2, len(json.loads(rv.data)))
+
+    def test_send_emails_not_a_list(self):
+        rv = self.client.post('/v1/emails', data=self.good_body,
+                              content_type='application/json')
+        self.assertEqual(400, rv.status_code)
+        rv = self.client.post('/v1/emails', data='[]',
+                              content_type='application/json')
+        self.assertEqual(400, rv.status_code)
+
     def test_send_email_bad_to(self):
         rv = self.client.post('/v1/email', data=self.bad_to_body,
                               content_type='application/json')
         self.assertEqual(400, rv.status_code)
+        errors = json.loads(rv.data)['errors']
+        self.assertEqual([('to_addr', 'format')],
+                         [(e['field'], e['validator']) for e in errors])
 
     def test_send_email_missing_to(self):
         rv = self.client.post('/v1/email', data=self.missing_to_body,
@@ -167,6 +309,100 @@ class APITestCase(unittest.TestCase):
     def test_get_email_not_found(self):
         rv = self.client.get('/v1/email/404')
         self.assertEqual(404, rv.status_code)
+        rv = self.client.get('/v1/email/00000000-0000-7000-8000-000000000000')
+        self.assertEqual(404, rv.status_code)
+
+    def test_get_email_upper_case(self):
+        rv = self.client.post('/v1/email', data=self.good_body,
+                              content_type='application/json')
+        uuid = self._get_message(rv.data).uuid
+        rv = self.client.get('/v1/email/' + uuid.upper())
+        self.assertEqual(uuid, self._get_message(rv.data).uuid)
+
+    def test_get_email_cached(self):
+        rv = self.client.post('/v1/email', data=self.good_body,
+                              content_type='application/json')
+        uuid = self._get_message(rv.data).uuid
+        cache = get_email_cache()
+        hits = cache.stats()['hits']
+        first = self.client.get('/v1/email/' + uuid).data
+        self.assertEqual(first, self.client.get('/v1/email/' + uuid).data)
+        self.assertEqual(hits + 1, cache.stats()['hits'])
+        self.client.delete('/v1/email/' + uuid)
+        rv = self.client.get('/v1/email/' + uuid)
+        self.assertEqual('DELETED', self._get_message(rv.data).status)
+
+    def test_send_email_outbox(self):
+        self.app.config['USE_OUTBOX'] = True
+        with mock.patch('mini_mailgun.api.blueprint.schedule_emails') as \
+                mock_schedule, \
+                mock.patch('mini_mailgun.api.blueprint.LOG') as mock_log:
+            rv = self.client.post('/v1/email', data=self.good_body,
+                                  content_type='application/json')
+            self.assertEqual(202, rv.status_code)
+            self.assertEqual('queued in outbox',
+                             mock_log.info.call_args[0][2])
+            rv = self.client.post('/v1/emails',
+                                  data='[' + self.good_body + ']',
+                                  content_type='application/json')
+            self.assertEqual(202, rv.status_code)
+            self.assertEqual('queued in outbox',
+                             mock_log.info.call_args[0][3])
+        self.assertFalse(mock_schedule.called)
+        with self.app.app_context():
+            self.assertEqual(2, Outbox.query.filter(
+                Outbox.dispatched_at.is_(None)).count())
+
+    def _when_waiting(self, func, *args):
+        def run():
+            while not len(get_status_feed()):
+                time.sleep(0.01)
+            func(*args)
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread
+
+    def test_get_email_wait(self):
+        rv = self.client.post('/v1/email', data=self.good_body,
+                              content_type='application/json')
+        uuid = self._get_message(rv.data).uuid
+        rv = self.client.get('/v1/email/' + uuid + '?wait=0')
+        self.assertEqual('SENDING', self._get_message(rv.data).status)
+        waiter = self._when_waiting(self.client.delete, '/v1/email/' + uuid)
+        rv = self.client.get('/v1/email/' + uuid + '?wait=10')
+        waiter.join()
+        self.assertEqual('DELETED', self._get_message(rv.data).status)
+        rv = self.client.get('/v1/email/' + uuid + '?wait=10')
+        self.assertEqual('DELETED', self._get_message(rv.data).status)
+        for wait in ('soon', 'nan', 'inf', '-inf'):
+            self.assertEqual(400, self.client.get(
+                '/v1/email/' + uuid + '?wait=' + wait).status_code)
+        self.assertEqual(404, self.client.get(
+            '/v1/email/404?wait=10').status_code)
+
+    def test_stream_status(self):
+        rv = self.client.post('/v1/email', data=self.good_body,
+                              content_type='application/json')
+        uuid = self._get_message(rv.data).uuid
+        waiter = self._when_waiting(get_status_feed().publish, uuid, 'SENT',
+                                    250, 1)
+        rv = self.client.get('/v1/email/' + uuid + '/events')
+        waiter.join()
+        self.assertEqual('text/event-stream', rv.mimetype)
+        events = [json.loads(line[len('data: '):])
+                  for line in rv.data.splitlines()
+                  if line.startswith('data: ')]
+        self.assertEqual(['SENDING', 'SENT'],
+                         [event['status'] for event in events])
+        self.assertEqual(250, events[1]['status_code'])
+        rv = self.client.get('/v1/email/404/events')
+        self.assertEqual(404, rv.status_code)
+        self.assertEqual(0, len(get_status_feed()))
+        # The body is never read, like a server closing it after HEAD.
+        rv = self.client.head('/v1/email/' + uuid + '/events')
+        self.assertEqual(200, rv.status_code)
+        rv.close()
+        self.assertEqual(0, len(get_status_feed()))
 
     def test_delete_email(self):
         rv = self.client.post('/v1/email', data=self.good_body,
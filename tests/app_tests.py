@@ -0,0 +1,33 @@
+import unittest
+
+import mock
+
+from mini_mailgun.api import app
+
+
+class AppTestCase(unittest.TestCase):
+
+    def test_config_read_once(self):
+        config = app.get_config()
+        with mock.patch('flask.Config.from_envvar') as mock_from_envvar:
+            self.assertIs(config, app.get_config())
+            app.create_app(register_blueprint=False)
+            self.assertFalse(mock_from_envvar.called)
+
+    def test_app_config_is_a_copy(self):
+        first = app.create_app(register_blueprint=False)
+        first.config['SOMETHING_NEW'] = True
+        self.assertNotIn('SOMETHING_NEW', app.get_config())
+
+    def test_get_app_shared(self):
+        self.assertIs(app.get_app(), app.get_app())
+
+    def test_create_logger_once(self):
+        logger = app.create_logger('app_tests.logger')
+        handlers = list(logger.handlers)
+        self.assertIs(logger, app.create_logger('app_tests.logger'))
+        self.assertEqual(handlers, logger.handlers)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+
+import mock
+import redis
+
+from mini_mailgun.api.cache import EmailCache
+
+
+class EmailCacheTestCase(unittest.TestCase):
+
+    @mock.patch('time.time')
+    def test_hits_and_misses(self, mock_time):
+        mock_time.return_value = 10
+        cache = EmailCache(ttl=30, negative_ttl=5)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', '{"uuid": "a"}')
+        cache.set('b', '')
+        mock_time.return_value = 14
+        self.assertEqual('{"uuid": "a"}', cache.get('a'))
+        self.assertEqual('', cache.get('b'))
+        mock_time.return_value = 16
+        self.assertIsNone(cache.get('b'))
+        mock_time.return_value = 41
+        self.assertIsNone(cache.get('a'))
+        stats = cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['negative_hits'])
+        self.assertEqual(3, stats['misses'])
+        self.assertEqual(5, stats['lookups'])
+
+    def test_invalidate(self):
+        cache = EmailCache()
+        cache.set('a', '{"uuid": "a"}')
+        cache.set('b', '')
+        cache.invalidate('a', 'b')
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(2, cache.stats()['invalidations'])
+
+    @mock.patch('time.time')
+    def test_stale_set_after_invalidate(self, mock_time):
+        mock_time.return_value = 10
+        cache = EmailCache(ttl=30, tombstone_ttl=2)
+        cache.invalidate('a')
+        cache.set('a', '{"status": "SENDING"}')
+        self.assertIsNone(cache.get('a'))
+        mock_time.return_value = 13
+        cache.set('a', '{"status": "SENT"}')
+        self.assertEqual('{"status": "SENT"}', cache.get('a'))
+        cache = EmailCache(ttl=30, tombstone_ttl=0)
+        cache.invalidate('a')
+        cache.set('a', '{"status": "SENT"}')
+        self.assertEqual('{"status": "SENT"}', cache.get('a'))
+
+    def test_disabled(self):
+        cache = EmailCache(ttl=0)
+        cache.set('a', '{"uuid": "a"}')
+        self.assertIsNone(cache.get('a'))
+        cache.invalidate('a')
+        self.assertEqual(0, cache.stats()['lookups'])
+
+    @mock.patch('time.time')
+    def test_redis(self, mock_time):
+        mock_time.return_value = 10
+        cache = EmailCache(ttl=30, negative_ttl=5,
+                           redis_url='redis://localhost:6379')
+        with mock.patch.object(cache._redis, 'set') as mock_set, \
+                mock.patch.object(cache._redis, 'get') as mock_get, \
+                mock.patch.object(cache._redis, 'pipeline') as mock_pipeline:
+            cache.set('a', '{"uuid": "a"}')
+            mock_set.assert_called_with('mini_mailgun:email:a',
+                                        '10.000:{"uuid": "a"}', px=30000,
+                                        nx=True)
+            cache.set('b', '')
+            mock_set.assert_called_with('mini_mailgun:email:b', '10.000:',
+                                        px=5000, nx=True)
+            mock_get.return_value = b'10.000:{"uuid": "a"}'
+            self.assertEqual('{"uuid": "a"}', cache.get('a'))
+            mock_get.return_value = b'10.000:'
+            self.assertEqual('', cache.get('b'))
+            mock_get.return_value = None
+            self.assertIsNone(cache.get('c'))
+            mock_get.return_value = b'-'
+            self.assertIsNone(cache.get('a'))
+            cache.invalidate('a', 'b')
+            pipe = mock_pipeline.return_value
+            self.assertEqual(
+                [mock.call('mini_mailgun:email:a', '-', px=2000),
+                 mock.call('mini_mailgun:email:b', '-', px=2000)],
+                pipe.set.call_args_list)
+            self.assertTrue(pipe.execute.called)
+        self.assertEqual(0, cache.stats()['size'])
+
+    def test_redis_down(self):
+        cache = EmailCache(redis_url='redis://localhost:6379')
+        error = redis.ConnectionError()
+        with mock.patch.object(cache._redis, 'get', side_effect=error), \
+                mock.patch.object(cache._redis, 'set', side_effect=error), \
+                mock.patch.object(cache._redis, 'pipeline',
+                                  side_effect=error):
+            cache.set('a', '{"uuid": "a"}')
+            self.assertIsNone(cache.get('a'))
+            cache.invalidate('a')
@@ -1,8 +1,10 @@
+import json
 import unittest
+import warnings
 
 import mock
 
-from mini_mailgun.api.client import Client
+from mini_mailgun.api.client import Client, ConcurrentClient
 from mini_mailgun.exceptions import ClientExceptionError, ServerExceptionError
 from mini_mailgun.exceptions import MessageAlreadySentOrFailedError
 
@@ -26,7 +28,7 @@ class ClientTestCase(unittest.TestCase):
     def tearDown(self):
         pass
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.request')
     def test_get_emails(self, mock_get):
         m_response = mock.Mock()
         m_response.status_code = 200
@@ -35,7 +37,47 @@ class ClientTestCase(unittest.TestCase):
         res = self.c.get_emails()
         self.assertEquals('asdf', res[0])
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.request')
+    def test_iter_emails(self, mock_get):
+        email = {'uuid': 'asdf', 'from_addr': 'a@b.com', 'to_addr': 'c@d.com',
+                 'subject': 'hi', 'body': 'yo', 'created_at': 'x',
+                 'deleted_at': 'None', 'last_attempt': 'None',
+                 'attempts': 0, 'status': 'SENDING', 'status_code': None}
+        m_response = mock.Mock(status_code=200)
+        m_response.iter_lines.return_value = iter(
+            [json.dumps(email), '', json.dumps(dict(email, uuid='qwer'))])
+        mock_get.return_value = m_response
+        res = self.c.iter_emails(status='SENDING')
+        self.assertFalse(mock_get.called)
+        self.assertEqual(['asdf', 'qwer'], [m.uuid for m in res])
+        mock_get.assert_called_with('GET', 'http://asdf:80/v1/emails/export',
+                                    params={'status': 'SENDING'},
+                                    stream=True, timeout=10)
+        self.assertTrue(m_response.close.called)
+
+    @mock.patch('requests.Session.request')
+    def test_get_emails_follows_cursor(self, mock_get):
+        first = mock.Mock(status_code=200, headers={'X-Next-Cursor': 'c1'})
+        first.json = mock.Mock(return_value=['a', 'b'])
+        second = mock.Mock(status_code=200, headers={})
+        second.json = mock.Mock(return_value=['c'])
+        mock_get.side_effect = [first, second]
+        res = self.c.get_emails(limit=None, page_size=2, status='SENT')
+        self.assertEquals(['a', 'b', 'c'], res)
+        mock_get.assert_called_with('GET', 'http://asdf:80/v1/email',
+                                    params={'limit': 2, 'cursor': 'c1',
+                                            'status': 'SENT'}, timeout=10)
+
+    @mock.patch('requests.Session.request')
+    def test_get_emails_limit(self, mock_get):
+        m_response = mock.Mock(status_code=200, headers={'X-Next-Cursor': 'c'})
+        m_response.json = mock.Mock(return_value=['a', 'b'])
+        mock_get.return_value = m_response
+        res = self.c.get_emails(limit=4, page_size=2)
+        self.assertEquals(['a', 'b', 'a', 'b'], res)
+        self.assertEquals(2, mock_get.call_count)
+
+    @mock.patch('requests.Session.request')
     def test_get_emails_400(self, mock_get):
         m_response = mock.Mock()
         m_response.status_code = 400
@@ -43,7 +85,7 @@ class ClientTestCase(unittest.TestCase):
         with self.assertRaises(ClientExceptionError):
             self.c.get_emails()
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.request')
     def test_get_emails_500(self, mock_get):
         m_response = mock.Mock()
         m_response.status_code = 500
@@ -51,7 +93,7 @@ class ClientTestCase(unittest.TestCase):
         with self.assertRaises(ServerExceptionError):
             self.c.get_emails()
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.request')
     def test_get_email(self, mock_get):
         m_response = mock.Mock()
         m_response.status_code = 200
@@ -70,7 +112,34 @@ class ClientTestCase(unittest.TestCase):
         self.assertEquals(res.status, 'status')
         self.assertEquals(res.status_code, 'status_code')
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.request')
+    def test_wait_for_status(self, mock_get):
+        sending = mock.Mock(status_code=200)
+        sending.json = mock.Mock(return_value=dict(self.message,
+                                                   status='SENDING'))
+        sent = mock.Mock(status_code=200)
+        sent.json = mock.Mock(return_value=dict(self.message, status='SENT'))
+        mock_get.side_effect = [sending, sent]
+        res = self.c.wait_for_status('uuid', wait=20)
+        self.assertEquals('SENT', res.status)
+        mock_get.assert_called_with('GET', 'http://asdf:80/v1/email/uuid',
+                                    params={'wait': 20}, timeout=30)
+
+    @mock.patch('time.time')
+    @mock.patch('requests.Session.request')
+    def test_wait_for_status_timeout(self, mock_get, mock_time):
+        mock_time.side_effect = [100, 100, 105]
+        sending = mock.Mock(status_code=200)
+        sending.json = mock.Mock(return_value=dict(self.message,
+                                                   status='SENDING'))
+        mock_get.return_value = sending
+        res = self.c.wait_for_status('uuid', timeout=5)
+        self.assertEquals('SENDING', res.status)
+        mock_get.assert_called_once_with(
+            'GET', 'http://asdf:80/v1/email/uuid', params={'wait': 5},
+            timeout=15)
+
+    @mock.patch('requests.Session.request')
     def test_get_email_400(self, mock_get):
         m_response = mock.Mock()
         m_response.status_code = 400
@@ -78,7 +147,7 @@ class ClientTestCase(unittest.TestCase):
         with self.assertRaises(ClientExceptionError):
             self.c.get_email('from')
 
-    @mock.patch('requests.get')
+    @mock.patch('requests.Session.request')
     def test_get_email_500(self, mock_get):
         m_response = mock.Mock()
         m_response.status_code = 500
@@ -86,7 +155,7 @@ class ClientTestCase(unittest.TestCase):
         with self.assertRaises(ServerExceptionError):
             self.c.get_email('from')
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.request')
     def test_send_email(self, mock_post):
         m_response = mock.Mock()
         m_response.status_code = 200
@@ -104,8 +173,12 @@ class ClientTestCase(unittest.TestCase):
         self.assertEquals(res.attempts, 'attempts')
         self.assertEquals(res.status, 'status')
         self.assertEquals(res.status_code, 'status_code')
+        mock_post.assert_called_with(
+            'POST', 'http://asdf:80/v1/email',
+            json={'from_addr': 'from', 'to_addr': 'to',
+                  'subject': 'sub', 'body': 'body'}, timeout=10)
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.request')
     def test_send_email_400(self, mock_post):
         m_response = mock.Mock()
         m_response.status_code = 400
@@ -113,7 +186,7 @@ class ClientTestCase(unittest.TestCase):
         with self.assertRaises(ClientExceptionError):
             self.c.send_email('from', 'to', 'sub', 'body')
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.request')
     def test_send_email_500(self, mock_post):
         m_response = mock.Mock()
         m_response.status_code = 500
@@ -121,16 +194,41 @@ class ClientTestCase(unittest.TestCase):
         with self.assertRaises(ServerExceptionError):
             self.c.send_email('from', 'to', 'sub', 'body')
 
-    @mock.patch('requests.delete')
+    @mock.patch('requests.Session.request')
+    def test_send_emails(self, mock_post):
+        m_response = mock.Mock()
+        m_response.status_code = 202
+        m_response.json = mock.Mock(return_value=[{'index': 0,
+                                                   'uuid': 'uuid',
+                                                   'status': 'SENDING'}])
+        mock_post.return_value = m_response
+        messages = [{'from_addr': 'from', 'to_addr': 'to',
+                     'subject': 'sub', 'body': 'body'}]
+        res = self.c.send_emails(messages)
+        self.assertEquals(res[0]['uuid'], 'uuid')
+        mock_post.assert_called_with('POST', 'http://asdf:80/v1/emails',
+                                     json=messages, timeout=10)
+
+    @mock.patch('requests.Session.request')
+    def test_send_emails_400(self, mock_post):
+        m_response = mock.Mock()
+        m_response.status_code = 400
+        mock_post.return_value = m_response
+        with self.assertRaises(ClientExceptionError):
+            self.c.send_emails([])
+
+    @mock.patch('requests.Session.request')
     def test_delete_email(self, mock_delete):
         m_response = mock.Mock()
         m_response.status_code = 200
         m_response.json = mock.Mock(return_value=self.message)
         mock_delete.return_value = m_response
         self.c.delete_email('from')
-        mock_delete.assert_called_with('http://asdf:80/v1/email/from')
+        mock_delete.assert_called_with('DELETE',
+                                       'http://asdf:80/v1/email/from',
+                                       timeout=10)
 
-    @mock.patch('requests.delete')
+    @mock.patch('requests.Session.request')
     def test_delete_email_400(self, mock_delete):
         m_response = mock.Mock()
         m_response.status_code = 400
@@ -138,7 +236,7 @@ class ClientTestCase(unittest.TestCase):
         with self.assertRaises(ClientExceptionError):
             self.c.delete_email('from')
 
-    @mock.patch('requests.delete')
+    @mock.patch('requests.Session.request')
     def test_delete_email_409(self, mock_delete):
         m_response = mock.Mock()
         m_response.status_code = 409
@@ -146,7 +244,7 @@ class ClientTestCase(unittest.TestCase):
         with self.assertRaises(MessageAlreadySentOrFailedError):
             self.c.delete_email('from')
 
-    @mock.patch('requests.delete')
+    @mock.patch('requests.Session.request')
     def test_delete_email_500(self, mock_delete):
         m_response = mock.Mock()
         m_response.status_code = 500
@@ -154,6 +252,39 @@ class ClientTestCase(unittest.TestCase):
         with self.assertRaises(ServerExceptionError):
             self.c.delete_email('from')
 
+    def test_session_pool(self):
+        c = Client('asdf', 80, pool_size=50, max_retries=5)
+        adapter = c.session.get_adapter('http://asdf:80/v1/email')
+        self.assertEqual(50, adapter._pool_maxsize)
+        self.assertEqual(5, adapter.max_retries.total)
+        self.assertFalse(adapter.max_retries.is_retry('POST', 503))
+        self.assertTrue(adapter.max_retries.is_retry('GET', 503))
+        c.close()
+
+
+class ConcurrentClientTestCase(unittest.TestCase):
+
+    @mock.patch('requests.Session.request')
+    def test_send_email_many(self, mock_request):
+        ok = mock.Mock(status_code=202)
+        ok.json = mock.Mock(return_value={
+            'uuid': 'uuid', 'from_addr': 'a@b.com', 'to_addr': 'c@d.com',
+            'subject': 'hi', 'body': 'yo', 'created_at': 'x',
+            'deleted_at': 'None', 'last_attempt': 'None', 'attempts': 0,
+            'status': 'SENDING', 'status_code': None})
+        mock_request.side_effect = [ok, mock.Mock(status_code=400)]
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            c = ConcurrentClient('asdf', 80, concurrency=2)
+        self.assertEqual(1, len(caught))
+        message = {'from_addr': 'a@b.com', 'to_addr': 'c@d.com',
+                   'subject': 'hi', 'body': 'yo'}
+        res = c.send_email_many([message, dict(message, to_addr='bad')])
+        self.assertEqual('uuid', res[0].uuid)
+        self.assertIsInstance(res[1], ClientExceptionError)
+        self.assertEqual(2, c.session.get_adapter(
+            'http://asdf:80/')._pool_maxsize)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,160 @@
+import os
+import smtplib
+import unittest
+from datetime import datetime
+
+import gevent
+import mock
+
+from mini_mailgun.api.app import create_app
+from mini_mailgun.api.db import db
+from mini_mailgun.api.models import Email
+from mini_mailgun.delivery.engine import DeliveryEngine
+from mini_mailgun.smtp.mx import MXCache
+from mini_mailgun.smtp.sink import SMTPSink
+
+
+class SMTPSinkTestCase(unittest.TestCase):
+
+    def test_sink(self):
+        with SMTPSink() as sink:
+            smtp = smtplib.SMTP(sink.host, sink.port)
+            smtp.sendmail('a@example.com', ['b@example.com'],
+                          'Subject: hi\r\n\r\nbody\r\n..dot\r\n')
+            smtp.quit()
+        self.assertEqual(1, len(sink.messages))
+        self.assertEqual('a@example.com', sink.messages[0]['mail_from'])
+        self.assertEqual(['b@example.com'], sink.messages[0]['rcpts'])
+        self.assertIn(b'.dot', sink.messages[0]['data'])
+
+    def test_sink_failure(self):
+        with SMTPSink(failure_rate=1, failure_code=452) as sink:
+            smtp = smtplib.SMTP(sink.host, sink.port)
+            with self.assertRaises(smtplib.SMTPDataError) as e:
+                smtp.sendmail('a@example.com', ['b@example.com'], 'hi')
+            smtp.quit()
+        self.assertEqual(452, e.exception.smtp_code)
+
+
+class DeliveryEngineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sink = SMTPSink().start()
+        self.app = create_app(register_blueprint=False)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////tmp/app.db'
+        self.app.config['SMTP_PORT'] = self.sink.port
+        self.app.config['USE_TLS'] = False
+        self.app.config['MAX_RETRIES'] = 2
+        mx_cache = MXCache()
+        mx_cache.set('weidenkeller.com', [(10, self.sink.host)], 60)
+        self.engine = DeliveryEngine(self.app, concurrency=10,
+                                     batch_size=10, mx_cache=mx_cache)
+        with self.app.app_context():
+            db.create_all()
+            emails = [Email('conrad@notkeller.com',
+                            'rcpt{0}@weidenkeller.com'.format(i),
+                            'asdf', 'foo') for i in range(3)]
+            db.session.add_all(emails)
+            db.session.commit()
+
+    def tearDown(self):
+        self.engine.smtp_pool.close_all()
+        self.sink.stop()
+        os.unlink('/tmp/app.db')
+
+    def _statuses(self):
+        with self.app.app_context():
+            return sorted((e.status, e.status_code, e.attempts)
+                          for e in Email.query.all())
+
+    def _make_due(self):
+        with self.app.app_context():
+            Email.query.update({'next_attempt_at': datetime(2000, 1, 1)})
+            db.session.commit()
+
+    def test_run_once(self):
+        self.assertEqual(3, self.engine.run_once())
+        self.assertEqual([('SENT', 250, 1)] * 3, self._statuses())
+        self.assertEqual(3, len(self.sink.messages))
+        self.assertEqual(0, self.engine.run_once())
+        self.assertEqual({}, self.engine._host_locks)
+
+    def test_host_lock(self):
+        self.engine.host_concurrency = 1
+        with self.engine.host_lock('mx.weidenkeller.com'):
+            waiter = gevent.spawn(self._hold, 'mx.weidenkeller.com')
+            gevent.sleep(0)
+            self.assertFalse(waiter.ready())
+            self.assertEqual(2, self.engine._host_locks[
+                'mx.weidenkeller.com'][1])
+        waiter.join()
+        self.assertEqual({}, self.engine._host_locks)
+
+    def _hold(self, smtp_host):
+        with self.engine.host_lock(smtp_host):
+            pass
+
+    def test_run_once_retry(self):
+        self.sink.failure_rate = 1
+        self.engine.run_once()
+        self.assertEqual([('SENDING', 451, 1)] * 3, self._statuses())
+        self.assertEqual(0, self.engine.run_once())
+        self._make_due()
+        self.engine.run_once()
+        self.assertEqual([('FAILED', 451, 2)] * 3, self._statuses())
+        self.assertEqual(0, self.engine.run_once())
+
+    def test_expired_last_attempt_fails(self):
+        with self.app.app_context():
+            email = Email.query.first()
+            email.attempts = 2
+            email.last_attempt = datetime(2000, 1, 1)
+            email.next_attempt_at = datetime(2000, 1, 1)
+            uuid = email.uuid
+            db.session.commit()
+        with self.engine.status_feed.subscribe(uuid) as subscription:
+            self.assertEqual(2, self.engine.run_once())
+            self.assertEqual('FAILED', subscription.get(0)['status'])
+        with self.app.app_context():
+            email = Email.query.filter_by(uuid=uuid).first()
+            self.assertEqual('FAILED', email.status)
+            self.assertEqual(2, email.attempts)
+            self.assertIsNone(email.next_attempt_at)
+            self.assertIsNotNone(email.finished_at)
+        self.assertEqual(2, len(self.sink.messages))
+
+    def test_run_forever_survives_errors(self):
+        self.engine.purge_interval = 60
+        calls = []
+
+        def claim(limit):
+            calls.append(limit)
+            if len(calls) == 1:
+                raise Exception('deadlock')
+            self.engine.stop()
+            return []
+        with mock.patch.object(self.engine, 'claim', side_effect=claim), \
+                mock.patch.object(self.engine, 'purge',
+                                  side_effect=Exception('gone away')), \
+                mock.patch.object(self.engine, 'flush',
+                                  side_effect=[Exception('gone away'), 0,
+                                               0]):
+            self.engine.poll_interval = 0
+            self.engine.run_forever()
+        self.assertEqual(2, len(calls))
+
+    def test_run_once_grouped(self):
+        self.engine.group_recipients = True
+        self.engine.max_recipients = 2
+        self.sink.reject.add('rcpt1@weidenkeller.com')
+        self.assertEqual(3, self.engine.run_once())
+        self.assertEqual([('SENDING', 550, 1), ('SENT', 250, 1),
+                          ('SENT', 250, 1)], self._statuses())
+        self.assertEqual(2, len(self.sink.messages))
+        self.assertEqual(['rcpt0@weidenkeller.com'],
+                         self.sink.messages[0]['rcpts'])
+        self.assertIn(b'undisclosed-recipients', self.sink.messages[0]['data'])
+
+
+if __name__ == '__main__':
+    unittest.main()
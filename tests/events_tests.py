@@ -0,0 +1,128 @@
+import json
+import os
+import threading
+import unittest
+
+import mock
+import redis
+
+from mini_mailgun.api.events import STATUS_CHANNEL, StatusFeed
+
+
+class StatusFeedTestCase(unittest.TestCase):
+
+    def test_publish_local(self):
+        feed = StatusFeed()
+        with feed.subscribe('a') as subscription:
+            other = feed.subscribe('b')
+            self.assertEqual(2, len(feed))
+            feed.publish('a', 'SENDING', status_code=451, attempts=1)
+            feed.publish('a', 'SENT', status_code=250, attempts=2)
+            self.assertEqual({'uuid': 'a', 'status': 'SENDING',
+                              'status_code': 451, 'attempts': 1},
+                             subscription.get(1))
+            self.assertEqual('SENT', subscription.get(1)['status'])
+            self.assertIsNone(subscription.get(0))
+            self.assertIsNone(other.get(0))
+        other.close()
+        self.assertEqual(0, len(feed))
+
+    def test_get_wakes_up(self):
+        feed = StatusFeed()
+        subscription = feed.subscribe('a')
+        timer = threading.Timer(0.05, feed.publish, ('a', 'SENT'))
+        timer.start()
+        self.assertEqual('SENT', subscription.get(5)['status'])
+        timer.join()
+
+    def test_publish_many(self):
+        feed = StatusFeed()
+        subscription = feed.subscribe('a')
+        feed.publish_many({'a': {'attempts': 1, 'last_attempt': None},
+                           'b': {'attempts': 1, 'status': 'SENT'}})
+        self.assertIsNone(subscription.get(0))
+        feed.publish_many({'a': {'attempts': 2, 'status': 'FAILED',
+                                 'status_code': 550}})
+        self.assertEqual({'uuid': 'a', 'status': 'FAILED',
+                          'status_code': 550, 'attempts': 2},
+                         subscription.get(0))
+
+    def test_publish_redis(self):
+        feed = StatusFeed(redis_url='redis://localhost:6379')
+        with mock.patch.object(feed._redis, 'publish') as mock_publish:
+            feed.publish('a', 'SENT', status_code=250, attempts=1)
+        channel, data = mock_publish.call_args[0]
+        self.assertEqual('mini_mailgun:status:a', channel)
+        self.assertEqual({'uuid': 'a', 'status': 'SENT', 'status_code': 250,
+                          'attempts': 1}, json.loads(data))
+        with mock.patch.object(feed._redis, 'publish',
+                               side_effect=redis.ConnectionError()):
+            feed.publish('a', 'SENT')
+
+    def test_listener_dispatches(self):
+        feed = StatusFeed(redis_url='redis://localhost:6379')
+        pubsub = mock.Mock()
+        pubsub.listen.return_value = iter([
+            {'type': 'subscribe', 'data': 1},
+            {'type': 'message', 'data': json.dumps(
+                {'uuid': 'a', 'status': 'SENT', 'status_code': 250,
+                 'attempts': 1}).encode('utf-8')}])
+        with mock.patch.object(feed._redis, 'pubsub',
+                               side_effect=[pubsub, SystemExit]):
+            with feed.subscribe('a') as subscription:
+                self.assertEqual('SENT', subscription.get(5)['status'])
+        pubsub.subscribe.assert_called_with(STATUS_CHANNEL.format('a'))
+
+    def test_follows_subscribed_emails(self):
+        feed = StatusFeed(redis_url='redis://localhost:6379')
+        # Skip starting the listener.
+        feed._pid = os.getpid()
+        pubsub = mock.Mock()
+        with mock.patch.object(feed._redis, 'pubsub',
+                               return_value=pubsub) as mock_pubsub:
+            first = feed.subscribe('a')
+            second = feed.subscribe('a')
+            other = feed.subscribe('b')
+        self.assertEqual(1, mock_pubsub.call_count)
+        self.assertEqual([mock.call(STATUS_CHANNEL.format('a')),
+                          mock.call(STATUS_CHANNEL.format('b'))],
+                         pubsub.subscribe.call_args_list)
+        first.close()
+        self.assertFalse(pubsub.unsubscribe.called)
+        second.close()
+        pubsub.unsubscribe.assert_called_once_with(STATUS_CHANNEL.format('a'))
+        pubsub.subscribe.side_effect = redis.ConnectionError()
+        pubsub.unsubscribe.side_effect = redis.ConnectionError()
+        feed.subscribe('c').close()
+        other.close()
+        self.assertEqual(0, len(feed))
+
+    def test_listener_reconnects(self):
+        feed = StatusFeed(redis_url='redis://localhost:6379',
+                          reconnect_delay=0)
+        followed = threading.Event()
+
+        def drop():
+            followed.wait(5)
+            raise redis.ConnectionError()
+        lost = mock.Mock()
+        lost.listen.side_effect = drop
+        pubsub = mock.Mock()
+        pubsub.listen.return_value = iter([
+            {'type': 'message', 'data': json.dumps(
+                {'uuid': 'a', 'status': 'SENT', 'status_code': 250,
+                 'attempts': 1}).encode('utf-8')}])
+        with mock.patch.object(feed._redis, 'pubsub',
+                               side_effect=[lost, pubsub, SystemExit]):
+            # Closed inside the patch so the listener never reaches the
+            # real redis once it's done.
+            with feed.subscribe('a') as subscription, feed.subscribe('b'):
+                followed.set()
+                self.assertEqual('SENT', subscription.get(5)['status'])
+        self.assertEqual([mock.call(STATUS_CHANNEL.format('a')),
+                          mock.call(STATUS_CHANNEL.format('b'))],
+                         lost.subscribe.call_args_list)
+        self.assertTrue(lost.close.called)
+        self.assertEqual([STATUS_CHANNEL.format('a'),
+                          STATUS_CHANNEL.format('b')],
+                         sorted(pubsub.subscribe.call_args[0]))
@@ -0,0 +1,90 @@
+import json
+import logging
+import time
+import unittest
+
+from mini_mailgun import logs
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+
+class LogsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = ListHandler()
+        self.listener = logs.QueueListener([self.handler], max_size=3,
+                                           interval=0.01)
+        self.logger = logging.getLogger('logs_tests.logger')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+        self.queue_handler = logs.QueueHandler(self.listener)
+        self.logger.addHandler(self.queue_handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.queue_handler)
+        self.listener.stop()
+
+    def _wait(self, count):
+        deadline = time.time() + 5
+        while len(self.handler.lines) < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_listener_writes_in_background(self):
+        self.logger.info('Email: %s sent.', 'asdf')
+        self._wait(1)
+        self.assertEqual(['Email: asdf sent.'], self.handler.lines)
+
+    def test_mutable_args_formatted_eagerly(self):
+        stats = {'hits': 1}
+        self.listener.start()
+        self.listener.stop()
+        self.logger.info('Stats: %s', stats)
+        stats['hits'] = 2
+        self.listener.drain()
+        self.assertEqual(["Stats: {'hits': 1}"], self.handler.lines)
+
+    def test_drops_when_full(self):
+        self.listener.start()
+        self.listener.stop()
+        for i in range(5):
+            self.logger.info('line %s', i)
+        self.assertEqual(3, len(self.listener))
+        self.assertEqual(2, self.listener.dropped)
+
+    def test_sampling_keeps_whole_emails(self):
+        sampler = logs.SamplingFilter(0.5)
+        kept = set()
+        for i in range(200):
+            uuid = 'uuid-{0}'.format(i)
+            record = self.logger.makeRecord(
+                self.logger.name, logging.INFO, __file__, 1, 'hi', (), None,
+                extra=logs.per_message(uuid))
+            if sampler.filter(record):
+                kept.add(uuid)
+                self.assertTrue(sampler.filter(record))
+        self.assertTrue(50 < len(kept) < 150)
+        record = self.logger.makeRecord(
+            self.logger.name, logging.ERROR, __file__, 1, 'hi', (), None,
+            extra=logs.per_message('uuid-0'))
+        self.assertTrue(logs.SamplingFilter(0).filter(record))
+
+    def test_json_formatter(self):
+        record = self.logger.makeRecord(
+            self.logger.name, logging.INFO, __file__, 1, 'Email: %s', ('a',),
+            None, extra=logs.per_message('a'))
+        data = json.loads(logs.JSONFormatter().format(record))
+        self.assertEqual('Email: a', data['message'])
+        self.assertEqual('a', data['uuid'])
+        self.assertEqual('INFO', data['level'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+
+import mock
+from prometheus_client import REGISTRY, Histogram
+
+from mini_mailgun import metrics
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def _sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_timed(self):
+        histogram = Histogram('mini_mailgun_test_seconds', 'Test.',
+                              ['stage'], registry=None)
+        with self.assertRaises(ValueError):
+            with metrics.timed(histogram, 'a'):
+                raise ValueError()
+        samples = histogram.collect()[0].samples
+        count = [s for s in samples if s.name.endswith('_count')][0]
+        self.assertEqual(1, count.value)
+
+    def test_domain_label(self):
+        self.assertEqual('example.com',
+                         metrics.domain_label('MX1.Example.com.'))
+        self.assertEqual('localhost', metrics.domain_label('localhost'))
+        self.assertEqual('10.0.0.1', metrics.domain_label('10.0.0.1'))
+
+    @mock.patch.object(metrics, 'MAX_DOMAINS', 0)
+    def test_domain_label_capped(self):
+        self.assertEqual(metrics.OTHER_DOMAIN,
+                         metrics.domain_label('mx.neverseen.org'))
+
+    def test_count_response(self):
+        before = self._sample('mini_mailgun_responses_total', code='554')
+        metrics.count_response(554)
+        self.assertEqual(before + 1, self._sample(
+            'mini_mailgun_responses_total', code='554'))
+
+    def test_publish_latency(self):
+        before = self._sample('mini_mailgun_broker_publish_seconds_count',
+                              task='t')
+        metrics.publish_started(sender='t')
+        metrics.publish_finished(sender='t')
+        metrics.publish_finished(sender='t')
+        self.assertEqual(before + 1, self._sample(
+            'mini_mailgun_broker_publish_seconds_count', task='t'))
+
+    def test_latest(self):
+        body, content_type = metrics.latest()
+        self.assertIn(b'mini_mailgun_smtp_seconds', body)
+        self.assertTrue(content_type.startswith('text/plain'))
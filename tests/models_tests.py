@@ -1,6 +1,9 @@
 import unittest
+import uuid
 
-from mini_mailgun.api.models import Email
+import mock
+
+from mini_mailgun.api.models import BinaryUUID, Email
 
 
 class EmailTestCase(unittest.TestCase):
@@ -13,6 +16,45 @@ class EmailTestCase(unittest.TestCase):
         self.assertEqual(e.body, 'body')
         self.assertEqual(len(e.to_msg()), 139)
 
+    def test_content_hash(self):
+        e = Email('from', 'to', 'subject', 'body')
+        self.assertEqual(e.content_hash(),
+                         Email('from', 'to', 'subject', 'body').content_hash())
+        other = Email('from', 'to', 'subject', 'bod')
+        self.assertNotEqual(e.content_hash(), other.content_hash())
+
+    @mock.patch('time.time')
+    def test_uuid_time_ordered(self, mock_time):
+        mock_time.return_value = 1500000000
+        first = Email('from', 'to', 'subject', 'body').uuid
+        mock_time.return_value = 1500000000.01
+        second = Email('from', 'to', 'subject', 'body').uuid
+        self.assertLess(first, second)
+        self.assertEqual(7, uuid.UUID(first).version)
+        self.assertEqual('015d3ef7-9800', first[:13])
+
+    def test_response_keeps_deleted(self):
+        self.assertEqual('SENT', Email.response_status(250, 1, 3))
+        self.assertEqual('DELETED',
+                         Email.response_status(250, 1, 3, 'DELETED'))
+        e = Email('from', 'to', 'subject', 'body')
+        e.attempts = 3
+        e.status = 'DELETED'
+        self.assertFalse(e.record_response(250, 3))
+        self.assertEqual('DELETED', e.status)
+        self.assertEqual(250, e.status_code)
+        self.assertIsNone(e.finished_at)
+
+    def test_binary_uuid(self):
+        column = BinaryUUID()
+        value = str(uuid.uuid4())
+        stored = column.process_bind_param(value.upper(), None)
+        self.assertEqual(16, len(stored))
+        self.assertEqual(value, column.process_result_value(stored, None))
+        self.assertIsNone(column.process_bind_param(None, None))
+        with self.assertRaises(ValueError):
+            column.process_bind_param('404', None)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,98 @@
+import unittest
+
+import dns.resolver
+import mock
+
+from mini_mailgun.common import LRUCache
+from mini_mailgun.smtp.mx import MXCache, select_mx_host
+
+
+def mx_answer(records, ttl=60):
+    answer = mock.MagicMock()
+    mxs = []
+    for preference, exchange in records:
+        mx = mock.Mock()
+        mx.preference = preference
+        mx.exchange.to_text.return_value = exchange
+        mxs.append(mx)
+    answer.__iter__.return_value = iter(mxs)
+    answer.rrset.ttl = ttl
+    return answer
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(1, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(2, len(cache))
+
+    @mock.patch('time.time')
+    def test_expiry(self, mock_time):
+        mock_time.return_value = 10
+        cache = LRUCache(2)
+        cache.set('a', 1, ttl=5)
+        self.assertEqual(1, cache.get('a'))
+        mock_time.return_value = 15
+        self.assertIsNone(cache.get('a'))
+
+
+class MXCacheTestCase(unittest.TestCase):
+
+    def test_select_mx_host(self):
+        records = [(10, 'mx1.'), (20, 'mx2.')]
+        self.assertEqual('mx1.', select_mx_host(records, 1))
+        self.assertEqual('mx2.', select_mx_host(records, 2))
+        self.assertEqual('mx1.', select_mx_host(records, 3))
+
+    @mock.patch('dns.resolver.query')
+    def test_lookup_cached(self, mock_query):
+        mock_query.return_value = mx_answer([(20, 'mx2.'), (10, 'mx1.')])
+        cache = MXCache()
+        self.assertEqual([(10, 'mx1.'), (20, 'mx2.')],
+                         cache.lookup('Example.com'))
+        self.assertEqual([(10, 'mx1.'), (20, 'mx2.')],
+                         cache.lookup('example.com'))
+        self.assertEqual(1, mock_query.call_count)
+        stats = cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+
+    @mock.patch('time.time')
+    @mock.patch('dns.resolver.query')
+    def test_lookup_honors_ttl(self, mock_query, mock_time):
+        mock_time.return_value = 10
+        mock_query.side_effect = lambda *args: mx_answer([(10, 'mx1.')], 60)
+        cache = MXCache(max_ttl=30)
+        cache.lookup('example.com')
+        mock_time.return_value = 35
+        cache.lookup('example.com')
+        mock_time.return_value = 45
+        cache.lookup('example.com')
+        self.assertEqual(2, mock_query.call_count)
+
+    @mock.patch('dns.resolver.query')
+    def test_lookup_negative(self, mock_query):
+        mock_query.side_effect = dns.resolver.NXDOMAIN()
+        cache = MXCache()
+        self.assertEqual([], cache.lookup('example.com'))
+        self.assertEqual([], cache.lookup('example.com'))
+        self.assertEqual(1, mock_query.call_count)
+        self.assertEqual(1, cache.stats()['negative_hits'])
+
+    @mock.patch('dns.resolver.query')
+    def test_lookup_error_not_cached(self, mock_query):
+        mock_query.side_effect = dns.resolver.Timeout()
+        cache = MXCache()
+        with self.assertRaises(dns.resolver.Timeout):
+            cache.lookup('example.com')
+        self.assertEqual(0, cache.stats()['size'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import unittest
+
+import mock
+
+from mini_mailgun.smtp.pool import ConnectionPool
+
+
+class FakeClient(object):
+
+    def __init__(self, host, port, use_tls=False):
+        self.key = (host, port, use_tls)
+        self.messages_sent = 0
+        self.last_used = 0
+        self.alive = True
+        self.closed = False
+
+    def is_alive(self):
+        return self.alive
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ConnectionPool(max_size=2, max_idle=30, max_messages=3,
+                                   client_class=FakeClient)
+
+    @mock.patch('time.time', return_value=10)
+    def test_reuse(self, mock_time):
+        client = self.pool.acquire('mx.example.com', 25)
+        self.pool.release(client)
+        self.assertEqual(1, self.pool.size())
+        self.assertIs(client, self.pool.acquire('mx.example.com', 25))
+        self.assertIsNot(client, self.pool.acquire('mx.example.com', 25,
+                                                   use_tls=True))
+
+    @mock.patch('time.time', return_value=10)
+    def test_max_messages(self, mock_time):
+        client = self.pool.acquire('mx.example.com', 25)
+        client.messages_sent = 3
+        self.pool.release(client)
+        self.assertTrue(client.closed)
+        self.assertEqual(0, self.pool.size())
+
+    @mock.patch('time.time', return_value=10)
+    def test_max_size(self, mock_time):
+        clients = [self.pool.acquire('mx.example.com', 25) for _ in range(3)]
+        for client in clients:
+            self.pool.release(client)
+        self.assertEqual(2, self.pool.size())
+        self.assertTrue(clients[2].closed)
+
+    @mock.patch('time.time', return_value=10)
+    def test_dead_connection_evicted(self, mock_time):
+        client = self.pool.acquire('mx.example.com', 25)
+        self.pool.release(client)
+        client.alive = False
+        new_client = self.pool.acquire('mx.example.com', 25)
+        self.assertIsNot(client, new_client)
+        self.assertTrue(client.closed)
+
+    @mock.patch('time.time')
+    def test_idle_connection_evicted(self, mock_time):
+        mock_time.return_value = 10
+        client = self.pool.acquire('mx.example.com', 25)
+        self.pool.release(client)
+        mock_time.return_value = 100
+        self.assertIsNot(client, self.pool.acquire('mx.example.com', 25))
+        self.assertTrue(client.closed)
+
+    @mock.patch('time.time', return_value=10)
+    def test_connection_not_reused_on_error(self, mock_time):
+        with self.assertRaises(ValueError):
+            with self.pool.connection('mx.example.com', 25) as client:
+                raise ValueError()
+        self.assertTrue(client.closed)
+        self.assertEqual(0, self.pool.size())
+
+    @mock.patch('os.getpid')
+    @mock.patch('time.time', return_value=10)
+    def test_fork_drops_connections(self, mock_time, mock_getpid):
+        mock_getpid.return_value = 1
+        pool = ConnectionPool(client_class=FakeClient)
+        client = pool.acquire('mx.example.com', 25)
+        pool.release(client)
+        mock_getpid.return_value = 2
+        self.assertIsNot(client, pool.acquire('mx.example.com', 25))
+        self.assertFalse(client.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
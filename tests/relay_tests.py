@@ -0,0 +1,81 @@
+import os
+import unittest
+from datetime import datetime, timedelta
+
+import mock
+
+from mini_mailgun.api import tasks
+from mini_mailgun.api.app import create_app
+from mini_mailgun.api.db import db
+from mini_mailgun.api.models import Email, Outbox
+from mini_mailgun.relay.outbox import OutboxRelay
+
+
+class OutboxRelayTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(register_blueprint=False)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////tmp/app.db'
+        self.relay = OutboxRelay(self.app, batch_size=2, keep=60)
+        with self.app.app_context():
+            db.create_all()
+            emails = [Email('conrad@notkeller.com',
+                            'rcpt{0}@weidenkeller.com'.format(i),
+                            'asdf', 'foo') for i in range(3)]
+            emails[1].status = 'DELETED'
+            db.session.add_all(emails)
+            db.session.execute(Outbox.__table__.insert(), Outbox.rows(emails))
+            db.session.commit()
+            self.uuids = [email.uuid for email in emails]
+        patch = mock.patch.object(tasks, 'schedule_email')
+        self.schedule_email = patch.start()
+        self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        os.unlink('/tmp/app.db')
+
+    def _dispatched(self):
+        with self.app.app_context():
+            return [entry.dispatched_at is not None
+                    for entry in Outbox.query.order_by(Outbox.id)]
+
+    def test_relay_in_batches(self):
+        published = []
+        self.schedule_email.side_effect = \
+            lambda email, producer: published.append(email.uuid)
+        self.assertEqual(2, self.relay.relay(2))
+        self.assertEqual([True, True, False], self._dispatched())
+        self.assertEqual([self.uuids[0]], published)
+        self.assertEqual(1, self.relay.relay(2))
+        self.assertEqual(0, self.relay.relay(2))
+        self.assertEqual([self.uuids[0], self.uuids[2]], published)
+
+    def test_publish_failure_keeps_rows(self):
+        self.schedule_email.side_effect = IOError('broker down')
+        with self.assertRaises(IOError):
+            self.relay.relay(2)
+        self.assertEqual([False, False, False], self._dispatched())
+
+    def test_purge(self):
+        self.relay.relay(2)
+        self.assertEqual(0, self.relay.purge())
+        with self.app.app_context():
+            Outbox.query.filter(Outbox.dispatched_at.isnot(None)).update(
+                {'dispatched_at': datetime.utcnow() - timedelta(hours=1)},
+                synchronize_session=False)
+            db.session.commit()
+        self.assertEqual(2, self.relay.purge())
+        self.assertEqual([False], self._dispatched())
+
+    def test_purge_failure_keeps_relaying(self):
+        self.relay.poll_interval = 0
+
+        def relay(limit):
+            self.relay.stop()
+            return 0
+        with mock.patch.object(self.relay, 'purge',
+                               side_effect=Exception('gone away')), \
+                mock.patch.object(self.relay, 'relay',
+                                  side_effect=relay) as mock_relay:
+            self.relay.run_forever()
+        self.assertTrue(mock_relay.called)
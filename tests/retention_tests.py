@@ -0,0 +1,84 @@
+import os
+import unittest
+from datetime import datetime, timedelta
+
+import mock
+
+from mini_mailgun.api import retention
+from mini_mailgun.api.app import create_app
+from mini_mailgun.api.db import db
+from mini_mailgun.api.models import Email
+
+
+class PurgeFinishedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(register_blueprint=False)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////tmp/app.db'
+        old = datetime.utcnow() - timedelta(hours=1)
+        with self.app.app_context():
+            db.create_all()
+            for i, status in enumerate(['SENT', 'FAILED', 'DELETED', 'SENT',
+                                        'SENT', 'SENDING']):
+                email = Email('conrad@notkeller.com',
+                              'rcpt{0}@weidenkeller.com'.format(i),
+                              'asdf', 'foo')
+                email.status = status
+                if status != 'SENDING':
+                    email.finished_at = old if i < 4 else datetime.utcnow()
+                db.session.add(email)
+            db.session.commit()
+
+    def tearDown(self):
+        os.unlink('/tmp/app.db')
+
+    def _statuses(self):
+        with self.app.app_context():
+            return sorted(e.status for e in Email.query.all())
+
+    @mock.patch('time.sleep')
+    def test_purge_in_chunks(self, mock_sleep):
+        self.assertEqual(4, retention.purge_finished(self.app, 60,
+                                                     chunk_size=3))
+        self.assertEqual(['SENDING', 'SENT'], self._statuses())
+        mock_sleep.assert_called_once_with(0.1)
+
+    @mock.patch('time.sleep')
+    def test_purge_max_chunks(self, mock_sleep):
+        self.assertEqual(2, retention.purge_finished(
+            self.app, 60, chunk_size=2, max_chunks=1))
+        self.assertEqual(2, retention.purge_finished(
+            self.app, 60, chunk_size=2, max_chunks=1))
+        self.assertEqual(0, retention.purge_finished(self.app, 60))
+
+    @mock.patch('time.sleep')
+    def test_purge_on_delete(self, mock_sleep):
+        deleted = []
+        retention.purge_finished(self.app, 60, chunk_size=3,
+                                 on_delete=lambda *uuids: deleted.append(
+                                     len(uuids)))
+        self.assertEqual([3, 1], deleted)
+
+
+class PartitionTestCase(unittest.TestCase):
+
+    def test_partition_end(self):
+        self.assertEqual(datetime(2018, 1, 1),
+                         retention.partition_end('p201712'))
+        self.assertIsNone(retention.partition_end('p_future'))
+
+    def test_partition_sql(self):
+        self.assertEqual(
+            "PARTITION p201712 VALUES LESS THAN (TO_DAYS('2018-01-01')), "
+            "PARTITION p_future VALUES LESS THAN MAXVALUE",
+            retention.partition_sql([datetime(2017, 12, 1)]))
+
+    def test_rotate_skips_sqlite(self):
+        app = create_app(register_blueprint=False)
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////tmp/app.db'
+        self.assertEqual([], retention.rotate_partitions(
+            app, datetime.utcnow()))
+
+
+if __name__ == '__main__':
+    unittest.main()
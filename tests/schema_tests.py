@@ -0,0 +1,58 @@
+import unittest
+
+from mini_mailgun.api.schema import is_simple_valid, send_email_errors
+from mini_mailgun.api.schema import send_email_validator
+
+GOOD = {'from_addr': 'conrad@notkeller.com',
+        'to_addr': 'conrad@weidenkeller.com',
+        'subject': 'asdf',
+        'body': 'foo'}
+
+
+def payload(**changes):
+    data = dict(GOOD)
+    for key, value in changes.items():
+        if value is None:
+            data.pop(key)
+        else:
+            data[key] = value
+    return data
+
+
+class SchemaTestCase(unittest.TestCase):
+
+    def test_fast_path_agrees_with_validator(self):
+        payloads = [GOOD, payload(to_addr='notanemail'),
+                    payload(from_addr='a@' + 'b' * 255),
+                    payload(subject='a' * 79), payload(subject='a' * 78),
+                    payload(body=None), payload(body=1),
+                    payload(body=u'\u2603'), payload(extra='x'),
+                    payload(body=None, extra='x'), [GOOD], 'nope', {},
+                    payload(priority=0), payload(priority=9),
+                    payload(priority=10), payload(priority=-1),
+                    payload(priority=True), payload(priority=5.0),
+                    payload(priority='5'), payload(priority=5, extra='x')]
+        for data in payloads:
+            valid = send_email_validator.is_valid(data)
+            if is_simple_valid(data):
+                self.assertTrue(valid, data)
+            self.assertEqual(valid, not send_email_errors(data), data)
+
+    def test_errors(self):
+        self.assertEqual([], send_email_errors(GOOD))
+        errors = send_email_errors(payload(to_addr='nope', subject=1))
+        self.assertEqual([('subject', 'type'), ('to_addr', 'format')],
+                         [(e['field'], e['validator']) for e in errors])
+        errors = send_email_errors(payload(body=None))
+        self.assertIn('required', [e['validator'] for e in errors])
+        self.assertIsNone(errors[0]['field'])
+
+    def test_unknown_field(self):
+        for data in (payload(extra='x'), payload(priority=5, extra='x')):
+            errors = send_email_errors(data)
+            self.assertEqual(['additionalProperties'],
+                             [e['validator'] for e in errors])
+
+
+if __name__ == '__main__':
+    unittest.main()
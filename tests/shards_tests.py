@@ -0,0 +1,153 @@
+import json
+import os
+import unittest
+from datetime import datetime, timedelta
+
+import mock
+from sqlalchemy import text
+
+from mini_mailgun.api import tasks
+from mini_mailgun.api.app import create_app
+from mini_mailgun.api.db import db, group_by_shard, shard_engine, shard_limit
+from mini_mailgun.api.db import shard_of
+from mini_mailgun.api.models import Email
+from mini_mailgun.api.retention import purge_finished
+from mini_mailgun.api.status import StatusWriter
+from mini_mailgun.common import shard_key
+from mini_mailgun.relay.outbox import OutboxRelay
+
+# Ids sort in the order of i and land on shard key % 2.
+UUID = '015d3ef7-98{0:02x}-70{1:02x}-8000-000000000000'
+DATABASES = ['/tmp/app.db', '/tmp/app1.db']
+
+
+class ShardsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app()
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = \
+            'sqlite:///' + DATABASES[0]
+        self.app.config['SHARD_DATABASE_URIS'] = \
+            ['sqlite:///' + path for path in DATABASES[1:]]
+        self.app.config['TESTING'] = True
+        db.init_app(self.app)
+        self.client = self.app.test_client()
+        with self.app.app_context():
+            db.create_all()
+        self.uuids = [UUID.format(i, key) for i, key in enumerate(
+            [0, 1, 3, 2])]
+        patch = mock.patch('mini_mailgun.api.models.uuid',
+                           side_effect=list(self.uuids))
+        patch.start()
+        self.addCleanup(patch.stop)
+        patch = mock.patch('mini_mailgun.api.blueprint.schedule_emails')
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        for path in DATABASES:
+            os.unlink(path)
+
+    def _post(self, count):
+        for i in range(count):
+            rv = self.client.post('/v1/email', data=json.dumps(
+                {'from_addr': 'conrad@notkeller.com',
+                 'to_addr': 'rcpt{0}@weidenkeller.com'.format(i),
+                 'subject': 'asdf', 'body': 'foo'}),
+                content_type='application/json')
+            self.assertEqual(202, rv.status_code)
+
+    def _count(self, shard, table='email'):
+        with self.app.app_context():
+            return shard_engine(shard).execute(text(
+                'SELECT COUNT(*) FROM {0}'.format(table))).scalar()
+
+    def test_shard_of(self):
+        self.assertEqual(3, shard_key(self.uuids[2]))
+        with self.app.app_context():
+            self.assertEqual([0, 1, 1, 0],
+                             [shard_of(uuid) for uuid in self.uuids])
+            self.assertEqual({0: [self.uuids[0], self.uuids[3]],
+                              1: [self.uuids[1], self.uuids[2]]},
+                             dict(group_by_shard(self.uuids)))
+            self.assertEqual(3, shard_limit(5))
+
+    def test_emails_live_on_their_shard(self):
+        self._post(4)
+        self.assertEqual(2, self._count(0))
+        self.assertEqual(2, self._count(1))
+        for uuid in self.uuids:
+            rv = self.client.get('/v1/email/' + uuid)
+            self.assertEqual(uuid, json.loads(rv.data)['uuid'])
+        self.assertEqual(200, self.client.delete(
+            '/v1/email/' + self.uuids[1]).status_code)
+        with self.app.app_context():
+            statuses = shard_engine(1).execute(text(
+                'SELECT status FROM email ORDER BY uuid')).fetchall()
+        self.assertEqual([('DELETED',), ('SENDING',)], statuses)
+
+    def test_send_emails_splits_batch(self):
+        self.app.config['USE_OUTBOX'] = True
+        rv = self.client.post('/v1/emails', data=json.dumps(
+            [{'from_addr': 'conrad@notkeller.com',
+              'to_addr': 'rcpt{0}@weidenkeller.com'.format(i),
+              'subject': 'asdf', 'body': 'foo'} for i in range(4)]),
+            content_type='application/json')
+        self.assertEqual(202, rv.status_code)
+        for shard in range(2):
+            self.assertEqual(2, self._count(shard))
+            self.assertEqual(2, self._count(shard, 'outbox'))
+        published = []
+        with mock.patch.object(tasks, 'schedule_email') as schedule_email:
+            schedule_email.side_effect = \
+                lambda email, producer: published.append(email.uuid)
+            self.assertEqual(4, OutboxRelay(self.app).relay(4))
+        self.assertEqual(sorted(self.uuids), sorted(published))
+
+    def test_queries_pinned_to_shards(self):
+        with self.app.app_context():
+            session = db.session()
+            self.assertEqual([1], session.choose_query(
+                Email.query.filter_by(uuid=self.uuids[1])))
+            self.assertEqual([0, 1], session.choose_query(
+                Email.query.filter(Email.uuid.in_(self.uuids[:2]))))
+            self.assertEqual([0], session.choose_query(Email.query.filter(
+                Email.status == 'SENDING', Email.uuid == self.uuids[0])))
+            self.assertEqual([0, 1], session.choose_query(
+                Email.query.filter((Email.uuid == self.uuids[0]) |
+                                   (Email.status == 'SENT'))))
+            self.assertEqual([0, 1], session.choose_query(Email.query))
+
+    def test_listing_merges_shards(self):
+        self._post(4)
+        rv = self.client.get('/v1/email?limit=3')
+        self.assertEqual(self.uuids[:3], json.loads(rv.data))
+        rv = self.client.get('/v1/email?limit=3&cursor=' +
+                             rv.headers['X-Next-Cursor'])
+        self.assertEqual(self.uuids[3:], json.loads(rv.data))
+        rv = self.client.get('/v1/email?limit=2&offset=1')
+        self.assertEqual(self.uuids[1:3], json.loads(rv.data))
+        rv = self.client.get('/v1/emails/export')
+        self.assertEqual(self.uuids, [json.loads(line)['uuid']
+                                      for line in rv.data.splitlines()])
+        rv = self.client.get('/v1/emails/export?limit=3')
+        self.assertEqual(self.uuids[:3], [json.loads(line)['uuid']
+                                          for line in rv.data.splitlines()])
+
+    def test_status_writer_and_purge(self):
+        self._post(4)
+        flushed = []
+        writer = StatusWriter(self.app, flush_interval=None,
+                              on_flush=flushed.append)
+        old = datetime.utcnow() - timedelta(hours=1)
+        for uuid in self.uuids[:3]:
+            writer.push(uuid, 1, status='SENT', status_code=250,
+                        finished_at=old)
+        self.assertEqual(3, writer.flush())
+        self.assertEqual(sorted(self.uuids[:3]), sorted(flushed[0]))
+        deleted = []
+        self.assertEqual(3, purge_finished(
+            self.app, 60, on_delete=lambda *uuids: deleted.extend(uuids)))
+        self.assertEqual(sorted(self.uuids[:3]), sorted(deleted))
+        self.assertEqual(1, self._count(0))
+        self.assertEqual(0, self._count(1))
@@ -0,0 +1,91 @@
+import unittest
+
+import mock
+from prometheus_client import REGISTRY
+
+from mini_mailgun.smtp.client import Client, MiniMailgunSMTP
+from mini_mailgun.smtp.sink import SMTPSink
+
+
+class MiniMailgunSMTPTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sink = SMTPSink(reject=('nobody@example.com',)).start()
+
+    def tearDown(self):
+        self.sink.stop()
+
+    def _smtp(self):
+        smtp = MiniMailgunSMTP(self.sink.host, self.sink.port)
+        self.addCleanup(smtp.close)
+        return smtp
+
+    def test_sendmail_get_status(self):
+        smtp = self._smtp()
+        self.assertEqual(250, smtp.sendmail_get_status(
+            'a@example.com', 'b@example.com', 'hi')[0])
+        self.assertEqual(250, smtp.sendmail_get_status(
+            'a@example.com', 'c@example.com', 'hi')[0])
+        self.assertNotIn('RSET', self.sink.commands)
+        self.assertEqual(2, len(self.sink.messages))
+
+    def test_sendmail_multi_pipelined(self):
+        smtp = self._smtp()
+        with mock.patch.object(smtp, 'send', wraps=smtp.send) as mock_send:
+            code, resp, statuses = smtp.sendmail_multi(
+                'a@example.com',
+                ['b@example.com', 'nobody@example.com', 'c@example.com'],
+                'hi')
+        self.assertEqual(250, code)
+        self.assertEqual(250, statuses['b@example.com'][0])
+        self.assertEqual(550, statuses['nobody@example.com'][0])
+        self.assertEqual(250, statuses['c@example.com'][0])
+        envelope = [c for c in mock_send.call_args_list
+                    if 'RCPT' in c[0][0]]
+        self.assertEqual(1, len(envelope))
+        self.assertIn('MAIL FROM', envelope[0][0][0])
+        self.assertEqual(['b@example.com', 'c@example.com'],
+                         self.sink.messages[0]['rcpts'])
+
+    def test_stage_metrics(self):
+        def count(stage):
+            return REGISTRY.get_sample_value(
+                'mini_mailgun_smtp_seconds_count',
+                {'stage': stage, 'domain': '127.0.0.1'}) or 0
+        before = dict((stage, count(stage))
+                      for stage in ('connect', 'ehlo', 'data'))
+        smtp = self._smtp()
+        smtp.sendmail_get_status('a@example.com', 'b@example.com', 'hi')
+        smtp.sendmail_get_status('a@example.com', 'b@example.com', 'hi')
+        self.assertEqual(before['connect'] + 1, count('connect'))
+        self.assertEqual(before['ehlo'] + 1, count('ehlo'))
+        self.assertEqual(before['data'] + 2, count('data'))
+
+    def test_sendmail_multi_no_pipelining(self):
+        self.sink.extensions = ['8BITMIME']
+        smtp = self._smtp()
+        code, resp, statuses = smtp.sendmail_multi(
+            'a@example.com', ['b@example.com', 'nobody@example.com'], 'hi')
+        self.assertEqual(250, code)
+        self.assertEqual(550, statuses['nobody@example.com'][0])
+
+    def test_sendmail_all_rejected(self):
+        smtp = self._smtp()
+        code, resp = smtp.sendmail_get_status('a@example.com',
+                                              'nobody@example.com', 'hi')
+        self.assertEqual(550, code)
+        self.assertEqual(['RSET'], self.sink.commands[-1:])
+        self.assertEqual(0, len(self.sink.messages))
+
+    def test_sendmail_data_failure(self):
+        self.sink.failure_rate = 1
+        client = Client(self.sink.host, self.sink.port)
+        self.addCleanup(client.close)
+        self.assertEqual(
+            {'b@example.com': (451, 'Try again later')},
+            client.send_message_multi('a@example.com', ['b@example.com'],
+                                      'hi'))
+
+
+if __name__ == '__main__':
+    unittest.main()
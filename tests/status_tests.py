@@ -0,0 +1,95 @@
+import os
+import unittest
+from datetime import datetime
+
+from mini_mailgun.api.app import create_app
+from mini_mailgun.api.db import db
+from mini_mailgun.api.models import Email
+from mini_mailgun.api.status import StatusWriter
+
+
+class StatusWriterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(register_blueprint=False)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////tmp/app.db'
+        self.writer = StatusWriter(self.app, flush_interval=None)
+        with self.app.app_context():
+            db.create_all()
+            emails = [Email('conrad@notkeller.com',
+                            'rcpt{0}@weidenkeller.com'.format(i),
+                            'asdf', 'foo') for i in range(2)]
+            db.session.add_all(emails)
+            db.session.commit()
+            self.uuids = [email.uuid for email in emails]
+
+    def tearDown(self):
+        os.unlink('/tmp/app.db')
+
+    def _rows(self):
+        with self.app.app_context():
+            return dict((e.uuid, (e.attempts, e.status, e.status_code))
+                        for e in Email.query.all())
+
+    def test_flush_merges_per_email(self):
+        first, second = self.uuids
+        self.writer.push(first, 1, last_attempt=datetime(2017, 1, 1))
+        self.writer.push(second, 1, last_attempt=datetime(2017, 1, 1))
+        self.writer.push(first, 1, status='SENT', status_code=250)
+        self.assertEqual(2, len(self.writer))
+        self.assertEqual(2, len(self.writer.statements(
+            self.writer._pending)))
+        self.assertEqual(2, self.writer.flush())
+        self.assertEqual({first: (1, 'SENT', 250),
+                          second: (1, 'SENDING', None)}, self._rows())
+        self.assertEqual(0, self.writer.flush())
+
+    def test_stale_attempts_ignored(self):
+        first = self.uuids[0]
+        self.writer.push(first, 2, status='SENDING', status_code=451)
+        self.writer.push(first, 1, status='FAILED', status_code=550)
+        self.writer.flush()
+        self.writer.push(first, 1, status='FAILED', status_code=550)
+        self.writer.flush()
+        self.assertEqual((2, 'SENDING', 451), self._rows()[first])
+
+    def test_deleted_during_attempt(self):
+        first = self.uuids[0]
+        self.writer.push(first, 1, last_attempt=datetime(2017, 1, 1))
+        self.writer.flush()
+        with self.app.app_context():
+            email = Email.query.filter_by(uuid=first).first()
+            email.status = 'DELETED'
+            email.finished_at = datetime(2017, 1, 1)
+            db.session.commit()
+        self.writer.push(first, 1, status='SENDING', status_code=450,
+                         next_attempt_at=datetime(2017, 1, 2),
+                         finished_at=None)
+        self.writer.flush()
+        self.assertEqual((1, 'DELETED', 450), self._rows()[first])
+        with self.app.app_context():
+            email = Email.query.filter_by(uuid=first).first()
+            self.assertIsNone(email.next_attempt_at)
+            self.assertEqual(datetime(2017, 1, 1), email.finished_at)
+
+    def test_on_flush(self):
+        flushed = []
+        self.writer.on_flush = flushed.append
+        self.writer.push(self.uuids[0], 1, status='SENT', status_code=250)
+        self.writer.flush()
+        self.assertEqual([{self.uuids[0]: {'attempts': 1, 'status': 'SENT',
+                                           'status_code': 250}}], flushed)
+
+    def test_unknown_field(self):
+        with self.assertRaises(ValueError):
+            self.writer.push(self.uuids[0], 1, body='nope')
+
+    def test_close_flushes(self):
+        writer = StatusWriter(self.app, flush_interval=60)
+        writer.push(self.uuids[0], 1, status='SENT', status_code=250)
+        writer.close()
+        self.assertEqual((1, 'SENT', 250), self._rows()[self.uuids[0]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,245 @@
+import os
+import unittest
+from datetime import datetime
+
+import mock
+
+from mini_mailgun.api import tasks
+from mini_mailgun.api.db import db
+from mini_mailgun.api.models import Email
+from mini_mailgun.exceptions import ThrottledError
+
+
+class TasksTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tasks.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////tmp/app.db'
+        self.ctx = tasks.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        email = Email('conrad@notkeller.com', 'conrad@weidenkeller.com',
+                      'asdf', 'foo')
+        db.session.add(email)
+        db.session.commit()
+        self.uuid = email.uuid
+        self.content_hash = email.content_hash()
+        self.smtp_client = mock.Mock()
+        self.smtp_client.send_message.return_value = (250, 'OK')
+        patches = [mock.patch.object(tasks.mx_cache, 'lookup',
+                                     return_value=[(10, 'mx.')]),
+                   mock.patch.object(tasks.smtp_pool, 'acquire',
+                                     return_value=self.smtp_client),
+                   mock.patch.object(tasks.smtp_pool, 'release'),
+                   mock.patch.object(tasks.clean_db_record, 'apply_async'),
+                   mock.patch.object(tasks, 'schedule_email')]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        db.session.remove()
+        self.ctx.pop()
+        os.unlink('/tmp/app.db')
+
+    def _email(self):
+        if tasks.status_writer is not None:
+            tasks.status_writer.flush()
+        db.session.expire_all()
+        return Email.query.filter_by(uuid=self.uuid).first()
+
+    def test_deliver_email_sent(self):
+        tasks.deliver_email.run(self.uuid, 0, self.content_hash)
+        email = self._email()
+        self.assertEqual('SENT', email.status)
+        self.assertEqual(250, email.status_code)
+        self.assertEqual(1, email.attempts)
+        tasks.smtp_pool.acquire.assert_called_with(
+            'mx.', tasks.app.config['SMTP_PORT'],
+            use_tls=tasks.app.config['USE_TLS'])
+        self.assertEqual('conrad@notkeller.com',
+                         self.smtp_client.send_message.call_args[0][0])
+        self.assertFalse(tasks.schedule_email.called)
+        self.assertIsNotNone(email.finished_at)
+        self.assertFalse(tasks.clean_db_record.apply_async.called)
+
+    def test_deliver_email_retry(self):
+        self.smtp_client.send_message.return_value = (450, 'Try later')
+        tasks.deliver_email.run(self.uuid, 0, self.content_hash)
+        email = self._email()
+        self.assertEqual('SENDING', email.status)
+        self.assertEqual(450, email.status_code)
+        self.assertGreater(email.next_attempt_at, email.last_attempt)
+        self.assertFalse(tasks.schedule_email.called)
+
+    def test_deliver_email_invalidates_cache(self):
+        tasks.email_cache.set(self.uuid, '{"status": "SENDING"}')
+        tasks.deliver_email.run(self.uuid, 0, self.content_hash)
+        self._email()
+        self.assertIsNone(tasks.email_cache.get(self.uuid))
+
+    def test_deleted_during_attempt(self):
+        tasks.update_attempts.run(self.uuid, 0)
+        email = self._email()
+        email.status = 'DELETED'
+        email.finished_at = datetime(2017, 1, 1)
+        db.session.commit()
+        tasks.update_status.run((450, 'Try later'), self.uuid, 1)
+        email = self._email()
+        self.assertEqual('DELETED', email.status)
+        self.assertIsNone(email.next_attempt_at)
+        self.assertEqual(datetime(2017, 1, 1), email.finished_at)
+        self.assertEqual(0, tasks.enqueue_due_emails.run())
+
+    def test_enqueue_due_emails(self):
+        email = self._email()
+        email.next_attempt_at = datetime(2000, 1, 1)
+        other = Email('conrad@notkeller.com', 'conrad@weidenkeller.com',
+                      'later', 'foo')
+        other.next_attempt_at = datetime(2100, 1, 1)
+        db.session.add_all([email, other])
+        db.session.commit()
+        self.assertEqual(1, tasks.enqueue_due_emails.run())
+        self.assertEqual(self.uuid,
+                         tasks.schedule_email.call_args[0][0].uuid)
+        self.assertIsNone(self._email().next_attempt_at)
+        self.assertEqual(0, tasks.enqueue_due_emails.run())
+
+    @mock.patch.dict(tasks.app.config, {'RETRY_WAIT': 60, 'RETRY_BACKOFF': 2,
+                                        'RETRY_MAX_WAIT': 200})
+    @mock.patch('random.uniform', return_value=0)
+    def test_retry_wait(self, mock_uniform):
+        self.assertEqual([60, 120, 200],
+                         [tasks.retry_wait(i) for i in (1, 2, 3)])
+
+    def test_find_smtp_host_stats(self):
+        with mock.patch.object(tasks, 'LOG') as log, \
+                mock.patch.object(tasks.mx_cache, 'stats') as stats:
+            stats.return_value = {'lookups': 0}
+            self.assertEqual('mx.', tasks.find_smtp_host.run(
+                0, 'conrad@weidenkeller.com'))
+            self.assertFalse(log.info.called)
+            stats.return_value = {'lookups': 1000}
+            tasks.find_smtp_host.run(0, 'conrad@weidenkeller.com')
+            log.info.assert_called_with('MX cache stats: %s',
+                                        {'lookups': 1000})
+
+    def test_send_message_connection_error(self):
+        tasks.smtp_pool.acquire.side_effect = IOError()
+        resp = tasks.send_message.run('mx.', self.uuid, self.content_hash)
+        self.assertEqual(-1, resp[0])
+
+    def test_send_message_interrupted(self):
+        self.smtp_client.send_message.side_effect = KeyboardInterrupt()
+        with self.assertRaises(KeyboardInterrupt):
+            tasks.send_message.run('mx.', self.uuid, self.content_hash)
+
+    def test_send_message_throttled(self):
+        tasks.send_message.push_request(called_directly=False, retries=0)
+        self.addCleanup(tasks.send_message.pop_request)
+        with mock.patch.object(tasks.throttle, 'limits',
+                               return_value=(0, 1, 1)), \
+                mock.patch.object(tasks.send_message, 'retry',
+                                  return_value=ValueError()) as mock_retry:
+            lease = tasks.throttle.acquire('weidenkeller.com')
+            with self.assertRaises(ValueError):
+                tasks.send_message.run('mx.', self.uuid, self.content_hash)
+            self.assertEqual(1, mock_retry.call_args[1]['countdown'])
+            self.assertFalse(self.smtp_client.send_message.called)
+            tasks.throttle.release('weidenkeller.com', lease)
+            self.assertEqual(250, tasks.send_message.run(
+                'mx.', self.uuid, self.content_hash)[0])
+
+    @mock.patch.dict(tasks.app.config, {'THROTTLE_MAX_DEFERRALS': 3})
+    def test_send_message_deferred_too_often(self):
+        tasks.send_message.push_request(called_directly=False, retries=3)
+        self.addCleanup(tasks.send_message.pop_request)
+        with mock.patch.object(tasks.throttle, 'acquire',
+                               side_effect=ThrottledError('a', 'rate', 1)):
+            resp = tasks.send_message.run('mx.', self.uuid,
+                                          self.content_hash)
+        self.assertEqual(-2, resp[0])
+
+    def test_render_message_cached(self):
+        tasks.message_cache.clear()
+        from_addr, to_addr, message = tasks.render_message(
+            self.uuid, self.content_hash)
+        self.assertEqual('conrad@notkeller.com', from_addr)
+        self.assertEqual('conrad@weidenkeller.com', to_addr)
+        self.assertIn('Subject: asdf', message)
+        with mock.patch.object(Email, 'query') as mock_query:
+            self.assertEqual(message, tasks.render_message(
+                self.uuid, self.content_hash)[2])
+            self.assertFalse(mock_query.filter_by.called)
+
+
+class ScheduleEmailTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.email = Email('conrad@notkeller.com', 'conrad@weidenkeller.com',
+                           'asdf', 'foo')
+
+    def tearDown(self):
+        tasks.app.config['DELIVERY_MODE'] = 'chain'
+
+    @mock.patch.object(tasks, 'deliver_email')
+    @mock.patch.object(tasks, 'chain')
+    def test_schedule_email_chain(self, mock_chain, mock_deliver):
+        tasks.app.config['DELIVERY_MODE'] = 'chain'
+        tasks.schedule_email(self.email, countdown=10)
+        mock_chain.return_value.apply_async.assert_called_with(countdown=10)
+        self.assertFalse(mock_deliver.s.called)
+
+    @mock.patch.object(tasks, 'deliver_email')
+    @mock.patch.object(tasks, 'chain')
+    def test_schedule_email_fused(self, mock_chain, mock_deliver):
+        tasks.app.config['DELIVERY_MODE'] = 'fused'
+        tasks.schedule_email(self.email, countdown=10)
+        mock_deliver.s.return_value.set.assert_called_with(
+            queue='mini_mailgun.first', priority=5)
+        mock_deliver.s.return_value.set.return_value.apply_async.\
+            assert_called_with(countdown=10)
+        self.assertFalse(mock_chain.called)
+
+    def test_route(self):
+        self.assertEqual({'queue': 'mini_mailgun.first', 'priority': 5},
+                         tasks.route(self.email))
+        self.email.priority = 2
+        self.assertEqual('mini_mailgun.bulk', tasks.route(self.email)['queue'])
+        self.email.attempts = 1
+        self.assertEqual('mini_mailgun.retry',
+                         tasks.route(self.email)['queue'])
+        with mock.patch.dict(tasks.app.config,
+                             {'CELERY_BROKER_URL': 'redis://localhost'}):
+            self.assertEqual(7, tasks.route(self.email)['priority'])
+
+    def test_queues(self):
+        self.assertEqual(
+            ['mini_mailgun.first', 'mini_mailgun.retry', 'mini_mailgun.bulk'],
+            [q.name for q in tasks.celery_app.conf.task_queues])
+        self.assertEqual('mini_mailgun.first',
+                         tasks.celery_app.conf.task_default_queue)
+        self.assertEqual(
+            list(range(10)),
+            tasks.celery_app.conf.broker_transport_options['priority_steps'])
+
+    def _purge(self):
+        with tasks.celery_app.connection_or_acquire() as conn:
+            for queue in tasks.QUEUES:
+                try:
+                    conn.default_channel.queue_purge(queue)
+                except conn.channel_errors:
+                    pass
+
+    def test_queue_depths(self):
+        self._purge()
+        self.addCleanup(self._purge)
+        with tasks.celery_app.producer_or_acquire() as producer:
+            tasks.update_attempts.s('uuid', 0).set(
+                queue='mini_mailgun.bulk').apply_async(producer=producer)
+        depths = tasks.queue_depths()
+        self.assertEqual(1, depths['mini_mailgun.bulk'])
+        self.assertEqual(0, depths['mini_mailgun.retry'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+
+import mock
+import redis
+
+from mini_mailgun.exceptions import ThrottledError
+from mini_mailgun.smtp.throttle import Throttle
+
+
+class ThrottleTestCase(unittest.TestCase):
+
+    def test_unlimited(self):
+        throttle = Throttle()
+        self.assertEqual('', throttle.acquire('example.com'))
+        throttle.release('example.com', '')
+
+    @mock.patch('time.time')
+    def test_rate(self, mock_time):
+        mock_time.return_value = 100
+        throttle = Throttle(rate=2, burst=2, retry_delay=0)
+        throttle.acquire('example.com')
+        throttle.acquire('example.com')
+        with self.assertRaises(ThrottledError) as cm:
+            throttle.acquire('example.com')
+        self.assertEqual('rate', cm.exception.reason)
+        self.assertAlmostEqual(0.5, cm.exception.wait)
+        # Other domains have their own bucket.
+        throttle.acquire('example.org')
+        mock_time.return_value = 100.5
+        throttle.acquire('example.com')
+
+    def test_retry_delay_is_the_least_wait(self):
+        throttle = Throttle(rate=1000, burst=1, retry_delay=2)
+        throttle.acquire('example.com')
+        with self.assertRaises(ThrottledError) as cm:
+            throttle.acquire('example.com')
+        self.assertEqual(2, cm.exception.wait)
+
+    @mock.patch('time.time')
+    def test_max_connections(self, mock_time):
+        mock_time.return_value = 100
+        throttle = Throttle(max_connections=1, lease_ttl=60)
+        lease = throttle.acquire('example.com')
+        with self.assertRaises(ThrottledError) as cm:
+            throttle.acquire('example.com')
+        self.assertEqual('connections', cm.exception.reason)
+        throttle.release('example.com', lease)
+        throttle.acquire('example.com')
+        # Leases that are never released expire.
+        mock_time.return_value = 161
+        throttle.acquire('example.com')
+
+    def test_overrides(self):
+        throttle = Throttle(rate=1, overrides={
+            'Gmail.com': {'rate': 50, 'max_connections': 5}})
+        self.assertEqual((50, 50, 5), throttle.limits('gmail.com'))
+        self.assertEqual((1, 1, 0), throttle.limits('example.com'))
+        self.assertEqual((0, 1, 0), Throttle().limits('example.com'))
+
+    @mock.patch('redis.StrictRedis.register_script')
+    def test_redis(self, mock_register):
+        script = mock_register.return_value
+        script.return_value = [1, b'', b'0']
+        throttle = Throttle(rate=5, max_connections=2, lease_ttl=30,
+                            redis_url='redis://localhost:6379')
+        with mock.patch.object(throttle._redis, 'zrem') as mock_zrem:
+            lease = throttle.acquire('Example.com')
+            throttle.release('example.com', lease)
+        kwargs = script.call_args[1]
+        self.assertEqual(['mini_mailgun:throttle:example.com:bucket',
+                          'mini_mailgun:throttle:example.com:leases'],
+                         kwargs['keys'])
+        self.assertEqual([5, 5, 2, lease, 30], kwargs['args'][1:])
+        mock_zrem.assert_called_with(
+            'mini_mailgun:throttle:example.com:leases', lease)
+        script.return_value = [0, b'rate', b'3.5']
+        with self.assertRaises(ThrottledError) as cm:
+            throttle.acquire('example.com')
+        self.assertEqual(('rate', 3.5),
+                         (cm.exception.reason, cm.exception.wait))
+
+    @mock.patch('redis.StrictRedis.register_script')
+    def test_redis_down(self, mock_register):
+        mock_register.return_value.side_effect = redis.ConnectionError()
+        throttle = Throttle(rate=5, redis_url='redis://localhost:6379')
+        self.assertTrue(throttle.acquire('example.com'))